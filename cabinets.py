@@ -0,0 +1,123 @@
+"""
+The cabinets driven by this controller. Each cabinet is a platform (a stepper on a motor HAT and an
+HX711 load cell) with its own lane system (described by a topology file), its own state files and its
+own MQTT topic prefix, so a single Pi can drive a bank of cabinets that vend in parallel.
+
+Cabinets are listed in cabinets.json:
+
+    {"version": 1, "cabinets": [
+        {"name": "pi1", "topology": "topology.json", "state_dir": ".",
+         "platform": {"address": 97, "channel": 0}, "hx711": {"dout": 17, "sck": 18}},
+        {"name": "pi2", "topology": "topology_pi2.json", "state_dir": "pi2",
+         "platform": {"address": 97, "channel": 1}, "hx711": {"dout": 22, "sck": 23}}]}
+
+Topology paths are relative to cabinets.json, state directories to the working directory. Without a
+cabinets.json the controller drives the single cabinet wired as below, keeping its state files where
+they have always been. Every cabinet shares the one I2C bus and GPIO header, so expander addresses
+and pins, platform channels and HX711 pins must not be reused between cabinets.
+"""
+
+import json
+import os
+
+from topology import TOPOLOGY, TopologyError, load_topology, PINS_PER_EXPANDER
+
+CABINETS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cabinets.json")
+CABINETS_VERSION = 1
+
+# Wiring of the single cabinet used without a cabinets.json
+DEFAULT_PLAT_ADDRESS = 0x61         # I2C address of the platform motor HAT (see soldered jumpers)
+DEFAULT_PLAT_CHANNEL = 0            # Motor hat channel of platform stepper motor
+DEFAULT_HX711_DOUT = 17             # dout GPIO pin of HX711
+DEFAULT_HX711_SCK = 18              # sck GPIO pin of HX711
+DEFAULT_STATE_DIR = "."
+
+
+class CabinetConfig:
+    """Wiring, topology and state location of one cabinet"""
+
+    def __init__(self, name:str, topology=TOPOLOGY, plat_address:int=DEFAULT_PLAT_ADDRESS,
+                 plat_channel:int=DEFAULT_PLAT_CHANNEL, hx711_dout:int=DEFAULT_HX711_DOUT,
+                 hx711_sck:int=DEFAULT_HX711_SCK, state_dir:str=DEFAULT_STATE_DIR):
+        self.name = name                    # Topic prefix of the cabinet's messages
+        self.topology = topology
+        self.plat_address = plat_address
+        self.plat_channel = plat_channel
+        self.hx711_dout = hx711_dout
+        self.hx711_sck = hx711_sck
+        self.state_dir = state_dir          # Where the cabinet's calibration, inventory, journal... are kept
+
+    def path(self, filename:str) -> str:
+        """Location of one of the cabinet's state files"""
+        return os.path.join(self.state_dir, filename)
+
+    def device(self, name:str) -> str:
+        """Name of one of the cabinet's devices on the shared bus arbiter"""
+        return "{}/{}".format(self.name, name)
+
+    def __repr__(self):
+        return "CabinetConfig({}, {} lanes, platform 0x{:02x}:{})".format(
+            self.name, self.topology.num_lanes, self.plat_address, self.plat_channel)
+
+
+def _cabinet(info:dict, base_dir:str) -> CabinetConfig:
+    try:
+        topology = TOPOLOGY
+        if 'topology' in info:
+            topology = load_topology(os.path.join(base_dir, info['topology']))
+        platform = info.get('platform', {})
+        hx711 = info.get('hx711', {})
+        return CabinetConfig(str(info['name']), topology,
+                             int(platform.get('address', DEFAULT_PLAT_ADDRESS)),
+                             int(platform.get('channel', DEFAULT_PLAT_CHANNEL)),
+                             int(hx711.get('dout', DEFAULT_HX711_DOUT)),
+                             int(hx711.get('sck', DEFAULT_HX711_SCK)),
+                             str(info.get('state_dir', info['name'])))
+    except TopologyError:
+        raise
+    except (KeyError, TypeError, ValueError, OSError) as e:
+        raise TopologyError("Malformed cabinet {!r}: {}".format(info, e))
+
+def check_cabinets(cabinets:list):
+    """Raises TopologyError if two cabinets would drive the same state files, bus devices or pins"""
+    def unique(what, values):
+        seen = set()
+        for value in values:
+            if value in seen:
+                raise TopologyError("Cabinets share {} {}".format(what, value))
+            seen.add(value)
+
+    if len(cabinets) == 0:
+        raise TopologyError("No cabinets configured")
+    unique("name", [c.name for c in cabinets])
+    unique("state directory", [os.path.normpath(c.state_dir) for c in cabinets])
+    unique("platform", [(c.plat_address, c.plat_channel) for c in cabinets])
+    unique("HX711 pin", [pin for c in cabinets for pin in (c.hx711_dout, c.hx711_sck)])
+    unique("expander address", [addr for c in cabinets for addr, base in c.topology.expanders])
+
+    # wiringPi pin numbers are global to the process, so every expander needs its own range
+    unique("expander pin", [base + p for c in cabinets for addr, base in c.topology.expanders
+                            for p in range(PINS_PER_EXPANDER)])
+    for c in cabinets:
+        if c.plat_channel not in (0, 1):
+            raise TopologyError("Cabinet {} platform channel must be 0 or 1".format(c.name))
+
+def load_cabinets(path:str=CABINETS_FILE, default_name:str="pi1") -> list:
+    """Returns the CabinetConfig of every cabinet, or of the single default cabinet without a cabinets file"""
+    if not os.path.exists(path):
+        return [CabinetConfig(default_name)]
+
+    try:
+        with open(path, "r") as f:
+            info = json.load(f)
+    except ValueError as e:
+        raise TopologyError("{} is not valid JSON: {}".format(path, e))
+
+    if not isinstance(info, dict) or info.get('version') != CABINETS_VERSION:
+        raise TopologyError("Unsupported cabinets version {!r}".format(
+            info.get('version') if isinstance(info, dict) else None))
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    cabinets = [_cabinet(c, base_dir) for c in info.get('cabinets', [])]
+    check_cabinets(cabinets)
+    return cabinets
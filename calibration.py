@@ -0,0 +1,225 @@
+"""
+Scripted load cell calibration and calibration-quality analysis. A calibration is a least-squares
+line through raw readings of known reference masses (zero included), so its residuals show how well
+the load cell follows a straight line. The same analysis runs on recorded CSV traces, reporting the
+accuracy, settle time and samples needed per weight class so that sampling and tolerance settings
+can be picked from data:
+
+    python3 calibration.py trace1.csv trace2.csv ... [--calibration wsens_calibration.json]
+
+Trace CSVs have a header row and the columns time (seconds since the mass was placed), raw (one
+HX711 reading) and reference (grams on the platform).
+"""
+
+import csv
+import math
+import statistics
+import time
+
+SETTLE_SAMPLES = 16             # HX711 readings per settle check
+SETTLE_TIMEOUT = 30             # Seconds to wait for a reading to settle before using it anyway
+SETTLE_TOL = 1.0                # Grams from the reference a settled reading must stay within
+SETTLE_FRACTION = 0.005         # ...or this fraction of the reference, whichever is larger
+WINDOW_SIZES = (1, 2, 4, 8, 16, 32, 64)
+WINDOW_CONFIDENCE = 0.95        # Fraction of averaged windows that must land within tolerance
+
+# (min grams, max grams) of each weight class reported by the benchmark
+WEIGHT_CLASSES = [(0, 50), (50, 200), (200, 1000), (1000, 15000)]
+
+
+class CalibrationFit:
+    """Least-squares line raw = offset + scale * grams, with the residual of every point in grams"""
+
+    def __init__(self, points:list):
+        """
+        :param points: list of (reference grams, raw reading) with at least two different references
+        """
+        grams = [g for g, r in points]
+        raws = [r for g, r in points]
+        if len(set(grams)) < 2:
+            raise ValueError("Calibration needs at least two different reference weights")
+
+        mean_g = sum(grams) / len(grams)
+        mean_r = sum(raws) / len(raws)
+        var_g = sum([(g - mean_g) ** 2 for g in grams])
+        cov = sum([(g - mean_g) * (r - mean_r) for g, r in points])
+
+        self.points = list(points)
+        self.scale = cov / var_g
+        self.offset = mean_r - self.scale * mean_g
+        self.residuals = [self.grams(r) - g for g, r in points]
+
+    def grams(self, raw:float) -> float:
+        return (raw - self.offset) / self.scale
+
+    @property
+    def quality(self) -> dict:
+        """Metrics saved with the calibration"""
+        return {
+            'points': len(self.points),
+            'max_residual': max([abs(e) for e in self.residuals]),
+            'rms_residual': math.sqrt(sum([e * e for e in self.residuals]) / len(self.residuals)),
+        }
+
+    def apply(self, sensor):
+        """Sets the offset and scale of a sensor from the fit"""
+        sensor.set_offset(self.offset)
+        sensor.set_scale(self.scale)
+        sensor.quality = self.quality
+
+
+def read_settled(sensor, num_samples:int=SETTLE_SAMPLES, timeout:float=SETTLE_TIMEOUT) -> float:
+    """
+    Reads the platform until two averaged readings in a row agree to within their noise, so no
+    fixed wait is needed after a mass is placed. Returns the last average raw reading.
+    """
+    start = time.monotonic()
+    last = None
+    while True:
+        reads = [sensor.read() for i in range(num_samples)]
+        mean = sum(reads) / num_samples
+        noise = statistics.pstdev(reads) / math.sqrt(num_samples)
+
+        if last is not None and abs(mean - last) <= 2 * math.sqrt(2) * noise:
+            return mean
+        if time.monotonic() - start > timeout:
+            print("Reading did not settle within {} seconds".format(timeout))
+            return mean
+        last = mean
+
+
+def calibrate_sensor(sensor, references:list, place, num_samples:int=SETTLE_SAMPLES) -> CalibrationFit:
+    """
+    Calibrates a sensor against known masses without prompting. place(grams) is called before each
+    reading and must return once that mass (0 for the empty platform) is on the platform, e.g. a
+    fixture or a test rig; the reading is taken once it has settled.
+    """
+    points = []
+    for grams in ([0] + [g for g in references if g != 0]):
+        place(grams)
+        points.append((grams, read_settled(sensor, num_samples)))
+
+    fit = CalibrationFit(points)
+    fit.apply(sensor)
+    print("Calibration: offset {:.1f}, scale {:.4f}, max residual {:.2f} g".format(
+        fit.offset, fit.scale, fit.quality['max_residual']))
+    return fit
+
+
+def load_traces(paths:list) -> list:
+    """Reads trace CSVs into a list of (reference grams, [(time, raw), ...]), one per placed mass"""
+    traces = []
+    for path in paths:
+        with open(path, "r", newline="") as f:
+            current = None
+            for row in csv.DictReader(f):
+                reference = float(row['reference'])
+                if current is None or current[0] != reference:
+                    current = (reference, [])
+                    traces.append(current)
+                current[1].append((float(row['time']), float(row['raw'])))
+    return traces
+
+
+def fit_traces(traces:list) -> CalibrationFit:
+    """Fits a calibration to the settled second half of every trace"""
+    points = []
+    for reference, samples in traces:
+        tail = samples[len(samples) // 2:]
+        points.append((reference, sum([r for t, r in tail]) / len(tail)))
+    return CalibrationFit(points)
+
+
+def tolerance(reference:float) -> float:
+    return max(SETTLE_TOL, SETTLE_FRACTION * reference)
+
+
+def settle_time(reference:float, readings:list) -> float:
+    """Time after which every reading stays within tolerance of the reference (None if it never does)"""
+    tol = tolerance(reference)
+    settled = None
+    for t, grams in readings:
+        if abs(grams - reference) > tol:
+            settled = None
+        elif settled is None:
+            settled = t
+    return settled
+
+
+def samples_needed(reference:float, grams:list):
+    """Smallest window of readings whose average is within tolerance often enough (None if none is)"""
+    tol = tolerance(reference)
+    for n in WINDOW_SIZES:
+        windows = [grams[i:i+n] for i in range(0, len(grams) - n + 1, n)]
+        if len(windows) == 0:
+            return None
+        hits = [abs(sum(w) / n - reference) <= tol for w in windows]
+        if sum(hits) >= WINDOW_CONFIDENCE * len(hits):
+            return n
+    return None
+
+
+def benchmark(traces:list, fit) -> dict:
+    """Returns {(min grams, max grams): metrics} for every weight class with traces in it"""
+    results = {}
+    for low, high in WEIGHT_CLASSES:
+        errors, settles, needed = [], [], []
+        for reference, samples in traces:
+            if not (low <= reference < high):
+                continue
+            readings = [(t, fit.grams(r)) for t, r in samples]
+            settled = settle_time(reference, readings)
+            settles.append(settled)
+
+            after = [g for t, g in readings if settled is not None and t >= settled]
+            errors += [g - reference for g in after]
+            needed.append(samples_needed(reference, after))
+
+        if len(settles) == 0:
+            continue
+        known = [s for s in settles if s is not None]
+        results[(low, high)] = {
+            'traces': len(settles),
+            'unsettled': len(settles) - len(known),
+            'bias': sum(errors) / len(errors) if errors else None,
+            'mean_abs_error': sum([abs(e) for e in errors]) / len(errors) if errors else None,
+            'max_settle_time': max(known) if known else None,
+            'samples_needed': max([n for n in needed if n is not None], default=None) if None not in needed else None,
+        }
+    return results
+
+
+def main():
+    import sys
+    from calibration_store import load_calibration
+
+    args = sys.argv[1:]
+    cal_path = None
+    if "--calibration" in args:
+        i = args.index("--calibration")
+        cal_path = args[i + 1]
+        del args[i:i + 2]
+
+    traces = load_traces(args)
+    if cal_path is not None:
+        record = load_calibration(cal_path)
+        fit = CalibrationFit([(0, record['offset']), (1, record['offset'] + record['scale'])])
+        print("Using calibration from {}".format(cal_path))
+    else:
+        fit = fit_traces(traces)
+        print("Fitted calibration: offset {:.1f}, scale {:.4f}".format(fit.offset, fit.scale))
+        for (g, r), e in zip(fit.points, fit.residuals):
+            print("  {:8.1f} g: residual {:+.2f} g".format(g, e))
+
+    def fmt(value, spec):
+        return "-" if value is None else format(value, spec)
+
+    print("{:>12} {:>7} {:>9} {:>8} {:>10} {:>10} {:>8}".format(
+        "class (g)", "traces", "unsettled", "bias", "mean |err|", "settle (s)", "samples"))
+    for (low, high), m in benchmark(traces, fit).items():
+        print("{:>12} {:>7} {:>9} {:>8} {:>10} {:>10} {:>8}".format(
+            "{}-{}".format(low, high), m['traces'], m['unsettled'], fmt(m['bias'], "+.2f"),
+            fmt(m['mean_abs_error'], ".2f"), fmt(m['max_settle_time'], ".2f"), fmt(m['samples_needed'], "d")))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Versioned JSON store for the load cell calibration. Only numbers are saved (offset, scale, gain, the
+pins, when and at what temperature the calibration was made, and how good it was), so the sensor is
+rebuilt from them at startup instead of unpickling a hardware object. Files are written atomically.
+"""
+
+import json
+import os
+import pickle
+import time
+
+from state_file import atomic_write_json
+
+CALIBRATION_FILE = "wsens_calibration.json"  # Filename for storing/loading weight sensor calibration data
+LEGACY_PICKLE_FILE = "wsens_state.pickle"   # Calibration saved by older versions (converted on startup)
+CALIBRATION_VERSION = 1
+
+THERMAL_FILE = "/sys/class/thermal/thermal_zone0/temp"
+
+# HX711 channel/gain setting -> number of extra clock pulses after a read (WeightSensor_HX711.GAIN)
+GAIN_PULSES = {128: 1, 64: 3, 32: 2}
+
+REQUIRED_FIELDS = ('offset', 'scale', 'gain', 'dout', 'pd_sck')
+
+
+class CalibrationError(ValueError):
+    """Raised when a calibration file cannot be used"""
+
+
+def read_temperature():
+    """Returns the board temperature in degrees C, or None where it cannot be read"""
+    try:
+        with open(THERMAL_FILE, "r") as f:
+            return int(f.read().strip()) / 1000
+    except (OSError, ValueError):
+        return None
+
+
+def sensor_calibration(sensor, quality:dict=None) -> dict:
+    """Returns the calibration record of a sensor"""
+    gain = {pulses: gain for gain, pulses in GAIN_PULSES.items()}.get(sensor.GAIN, 128)
+    return {
+        'version': CALIBRATION_VERSION,
+        'offset': sensor.OFFSET,
+        'scale': sensor.SCALE,
+        'gain': gain,
+        'dout': sensor.DOUT,
+        'pd_sck': sensor.PD_SCK,
+        'max_cap': sensor.MAX_CAP,
+        'min_cap': sensor.MIN_CAP,
+        'timestamp': time.time(),
+        'temperature': read_temperature(),
+        'quality': quality if quality is not None else getattr(sensor, 'quality', {}),
+    }
+
+
+def save_calibration(sensor, path:str=CALIBRATION_FILE, quality:dict=None) -> dict:
+    """Writes the calibration of a sensor, replacing any earlier one. Returns the record written"""
+    return write_calibration(sensor_calibration(sensor, quality), path)
+
+
+def write_calibration(record:dict, path:str=CALIBRATION_FILE) -> dict:
+    atomic_write_json(path, record, indent=2)
+    return record
+
+
+def load_calibration(path:str=CALIBRATION_FILE) -> dict:
+    """Reads a calibration record, raising CalibrationError if it is unreadable or from a newer version"""
+    try:
+        with open(path, "r") as f:
+            record = json.load(f)
+    except ValueError as e:
+        raise CalibrationError("{} is not valid JSON: {}".format(path, e))
+
+    if not isinstance(record, dict):
+        raise CalibrationError("{} does not hold a calibration".format(path))
+    if record.get('version') != CALIBRATION_VERSION:
+        raise CalibrationError("Unsupported calibration version {!r}".format(record.get('version')))
+
+    missing = [field for field in REQUIRED_FIELDS if field not in record]
+    if len(missing) > 0:
+        raise CalibrationError("Calibration is missing {}".format(missing))
+    if record['gain'] not in GAIN_PULSES or not record['scale']:
+        raise CalibrationError("Calibration has gain {} and scale {}".format(record['gain'], record['scale']))
+    return record
+
+
+def build_sensor(record:dict):
+    """Creates a WeightSensor_HX711 (setting up its pins) from a calibration record"""
+    from weight_sensor import WeightSensor_HX711
+
+    sensor = WeightSensor_HX711(dout=record['dout'], pd_sck=record['pd_sck'], gain=record['gain'],
+                                MAX_CAP=record.get('max_cap', 100), MIN_CAP=record.get('min_cap', 0))
+    sensor.set_offset(record['offset'])
+    sensor.set_scale(record['scale'])
+    sensor.quality = record.get('quality', {})
+    return sensor
+
+
+def migrate_pickle(pickle_path:str=LEGACY_PICKLE_FILE, path:str=CALIBRATION_FILE):
+    """
+    Converts a calibration pickled by older versions into a calibration record (the pickle is left in
+    place). Returns the record, or None if there is no pickle to convert.
+    """
+    if not os.path.exists(pickle_path):
+        return None
+
+    # Older versions appended every calibration to the file but always loaded the first one
+    try:
+        with open(pickle_path, "rb") as f:
+            sensor = pickle.load(f)
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+        raise CalibrationError("Could not read {}: {}".format(pickle_path, e))
+
+    record = sensor_calibration(sensor)
+    record['timestamp'] = os.path.getmtime(pickle_path)
+    record['temperature'] = None        # Not known for the time the pickle was made
+    write_calibration(record, path)
+    print("Converted {} to {}".format(pickle_path, path))
+    return record
@@ -0,0 +1,230 @@
+"""
+MQTT connection manager shared by main.py and client.py. Connects in the background and keeps
+reconnecting with exponential backoff (so a network outage at startup no longer kills the process),
+renews subscriptions on every connect, checks the result of every publish, and keeps status
+messages published while offline in a bounded on-disk outbox that is flushed in order on reconnect.
+"""
+
+import json
+import os
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from state_file import atomic_write
+
+BROKER_HOST = "ec2-3-87-77-241.compute-1.amazonaws.com"
+BROKER_PORT = 1884
+KEEPALIVE = 60
+USERNAME = "lenatest"
+PASSWORD = "password"
+
+MIN_BACKOFF = 1                 # Seconds before the first reconnect attempt
+MAX_BACKOFF = 120               # Reconnect delay doubles up to this many seconds
+
+OUTBOX_FILE = "outbox.jsonl"
+OUTBOX_LIMIT = 500              # Messages kept while offline (oldest are dropped first)
+
+
+class Outbox:
+    """Bounded, append-only file of messages waiting to be published"""
+
+    def __init__(self, path:str=OUTBOX_FILE, limit:int=OUTBOX_LIMIT):
+        self.path = path
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.messages = []
+
+        if os.path.exists(self.path):
+            # A power cut during an append can leave a truncated last line--it is skipped, not fatal
+            skipped = 0
+            with open(self.path, "r") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        self.messages.append(json.loads(line))
+                    except ValueError:
+                        skipped += 1
+            self.messages = self.messages[-self.limit:]
+            if skipped > 0:
+                print("Skipped {} unreadable outbox messages".format(skipped))
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, topic:str, payload:str, qos:int):
+        with self.lock:
+            self.messages.append({'topic': topic, 'payload': payload, 'qos': qos})
+            if len(self.messages) > self.limit:
+                self.messages = self.messages[-self.limit:]
+                self._rewrite()
+            else:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(self.messages[-1]) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def flush(self, publish) -> int:
+        """
+        Publishes the queued messages in order with publish(topic, payload, qos) -> bool, stopping at
+        the first failure. Returns the number of messages sent.
+        """
+        with self.lock:
+            sent = 0
+            for msg in self.messages:
+                if not publish(msg['topic'], msg['payload'], msg['qos']):
+                    break
+                sent += 1
+
+            if sent > 0:
+                self.messages = self.messages[sent:]
+                self._rewrite()
+            return sent
+
+    def _rewrite(self):
+        atomic_write(self.path, "".join([json.dumps(msg) + "\n" for msg in self.messages]))
+
+
+class ConnectionManager:
+    """Owns the MQTT client of a process and keeps it connected"""
+
+    def __init__(self, client_id:str, host:str=BROKER_HOST, port:int=BROKER_PORT, clean_session:bool=False,
+                 outbox_path:str=OUTBOX_FILE, client=None):
+        """
+        :param client: paho-compatible client to use instead of creating one (e.g. an in-process fake)
+        """
+        self.client_id = client_id
+        self.host = host
+        self.port = port
+        self.outbox = Outbox(outbox_path)
+        self.subscriptions = {}         # Topic -> (callback, qos), renewed on every connect
+        self.connected = threading.Event()
+        self.on_connect = None          # Called with no arguments after every (re)connect
+
+        if client is None:
+            client = mqtt.Client(client_id=client_id, clean_session=clean_session)
+            client.username_pw_set(USERNAME, PASSWORD)
+        self.client = client
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+        self.client.reconnect_delay_set(min_delay=MIN_BACKOFF, max_delay=MAX_BACKOFF)
+
+    def will_set(self, topic:str, payload:str, qos:int=0):
+        self.client.will_set(topic, payload=payload, qos=qos)
+
+    def subscribe(self, topic:str, callback, qos:int=0):
+        """Subscribes to a topic now (if connected) and after every reconnect"""
+        self.subscriptions[topic] = (callback, qos)
+        self.client.message_callback_add(topic, callback)
+        if self.connected.is_set():
+            self.client.subscribe(topic, qos)
+
+    def start(self):
+        """Starts connecting in the background--returns immediately even if the broker is down"""
+        self.client.connect_async(self.host, self.port, KEEPALIVE)
+        self.client.loop_start()
+
+    def loop_forever(self):
+        """Blocks processing network traffic, retrying the first connection as well as later ones"""
+        self.client.connect_async(self.host, self.port, KEEPALIVE)
+        self.client.loop_forever(retry_first_connection=True)
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def publish(self, topic:str, payload:str, qos:int=0, persist:bool=False) -> bool:
+        """
+        Publishes a message. With persist set, a message that cannot be handed to the client (or
+        that is published while offline) goes to the outbox instead of being lost. Older outbox
+        messages are always sent first so the broker sees them in order.
+        """
+        if self.connected.is_set():
+            if len(self.outbox) > 0:
+                self.outbox.flush(self._send)
+            if len(self.outbox) == 0 and self._send(topic, payload, qos):
+                return True
+
+        if persist:
+            self.outbox.add(topic, payload, qos)
+        else:
+            print("Dropped message on {} while offline".format(topic))
+        return False
+
+    def _send(self, topic:str, payload, qos:int) -> bool:
+        info = self.client.publish(topic, payload=payload, qos=qos)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            print("Publish to {} failed: {}".format(topic, mqtt.error_string(info.rc)))
+            return False
+        return True
+
+    def _on_connect(self, client, userdata, flags, rc):
+        print("Connected with result code "+str(rc))
+        if rc != 0:
+            return
+
+        # Subscribing in on_connect() means that if we lose the connection and
+        # reconnect then subscriptions will be renewed.
+        for topic, (callback, qos) in self.subscriptions.items():
+            client.subscribe(topic, qos)
+
+        self.connected.set()
+        sent = self.outbox.flush(self._send)
+        if sent > 0:
+            print("Sent {} messages queued while offline".format(sent))
+
+        if self.on_connect is not None:
+            self.on_connect()
+
+    # The callback for when a PUBLISH message is received on a topic without its own callback
+    def _on_message(self, client, userdata, msg):
+        print(msg.topic+" "+str(msg.payload))
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected.clear()
+        if rc != 0:
+            print("Unexpected disconnect (code {}), reconnecting...".format(rc))
+
+
+def main():
+    # Throughput/latency check against a broker (e.g. a local mosquitto): python3 connection.py localhost 1883
+    import sys
+
+    host = sys.argv[1] if len(sys.argv) > 1 else "localhost"
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 1883
+    num_msgs = 1000
+
+    conn = ConnectionManager("bench-" + str(os.getpid()), host, port, clean_session=True,
+                             outbox_path="/tmp/bench_outbox.jsonl")
+    received = []
+    done = threading.Event()
+
+    def on_echo(client, userdata, msg):
+        received.append(time.monotonic() - float(msg.payload))
+        if len(received) == num_msgs:
+            done.set()
+
+    conn.subscribe("bench/echo", on_echo, qos=1)
+    conn.start()
+    if not conn.connected.wait(10):
+        print("Could not reach broker at {}:{}".format(host, port))
+        return
+
+    start = time.monotonic()
+    for i in range(num_msgs):
+        conn.publish("bench/echo", str(time.monotonic()), qos=1)
+    done.wait(30)
+    elapsed = time.monotonic() - start
+    conn.stop()
+
+    received.sort()
+    print("{} of {} messages in {:.2f}s ({:.0f} msg/s)".format(len(received), num_msgs, elapsed, len(received) / elapsed))
+    if received:
+        print("latency p50 {:.1f} ms, p99 {:.1f} ms".format(received[len(received) // 2] * 1e3,
+                                                          received[int(len(received) * 0.99)] * 1e3))
+
+if __name__ == '__main__':
+    main()
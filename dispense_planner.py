@@ -0,0 +1,112 @@
+"""
+Plans which item lanes are fired together when dispensing a row and works out which of them
+actually dropped from the change in weight on the platform.
+
+Lanes on different MCP23017 expanders can run at the same time (see topology.py). A batch
+of lanes is only fired together if every combination of its items has a total weight that cannot
+be mistaken for another combination, so a single weight reading is enough to tell which items fell.
+The weight window of an item runs from its min_weight to its max_weight (never narrower than
+MIN_WEIGHT_TOL), and "nothing fell" covers up to half the lightest item of the batch.
+
+An item too light to be told apart from nothing at all is fired on its own, and judged by whether
+the weight went past half of its nominal weight.
+"""
+
+from topology import TOPOLOGY
+from weight_attribution import SubsetIndex, mask_to_indices
+
+MIN_WEIGHT_TOL = 2.0        # Smallest tolerance (grams) applied to any weight, covers sensor noise
+
+
+def expander_of(channel:int, topology=TOPOLOGY) -> int:
+    """Returns the index of the expander board that drives a lane channel"""
+    return topology.expander_of[channel]
+
+def parallel_safe(items:list) -> bool:
+    """Checks that no two of the items' lanes share an expander (and therefore that none repeat)"""
+    expanders = [i.expander for i in items]
+    return len(set(expanders)) == len(expanders)
+
+def weight_tol(item) -> float:
+    """Returns the tolerance (grams) allowed around the nominal weight of an item"""
+    return max(item.max_weight - item.weight, item.weight - item.min_weight, MIN_WEIGHT_TOL)
+
+def empty_tol(items:list) -> float:
+    """Returns the change (grams) still read as nothing having fallen from a group of items"""
+    return max(min([i.min_weight for i in items]) / 2, MIN_WEIGHT_TOL) if len(items) > 0 else MIN_WEIGHT_TOL
+
+def build_index(items:list) -> SubsetIndex:
+    """Indexes the weight of every combination of the items"""
+    return SubsetIndex([i.weight for i in items], [weight_tol(i) for i in items], empty_tol(items))
+
+def distinguishable(items:list) -> bool:
+    """Checks that no two combinations of the items have overlapping weight windows"""
+    return build_index(items).unambiguous()
+
+def plan_batch(items:list, max_weight:float, max_volume:float, exclude:set=None) -> list:
+    """
+    Picks the largest group of items (one unit each) that can be dropped in a single settle cycle:
+    every lane on its own expander, every combination distinguishable by weight, and all of it
+    fitting in the remaining weight and volume of the platform. Heavier items are placed first
+    since they are the easiest to tell apart. A single item is always a batch of its own, however
+    light. Lanes in exclude (e.g. faulted ones) are never picked.
+    """
+    batch = []
+    weight = 0
+    volume = 0
+
+    for item in sorted(items, key=lambda i: i.weight, reverse=True):
+        if item.quantity <= 0:
+            continue
+        if exclude is not None and item.channel in exclude:
+            continue
+        if weight + item.weight > max_weight or volume + item.volume > max_volume:
+            continue
+        if not parallel_safe(batch + [item]):
+            continue
+        if len(batch) > 0 and not distinguishable(batch + [item]):
+            continue
+
+        batch.append(item)
+        weight += item.weight
+        volume += item.volume
+
+    return batch
+
+class BatchAttributor:
+    """
+    Works out which items of a batch dropped from the weight added to the platform. The index of
+    the batch is built once and reused for every retry, restricted to the lanes still stuck.
+    """
+
+    def __init__(self, items:list):
+        self.items = list(items)
+        self.index = build_index(self.items)
+        self.empty_tol = empty_tol(self.items)
+
+    def attribute(self, added_weight:float, pending:list):
+        """
+        Returns (items, confidence) for the subset of the pending items that most likely dropped,
+        or (None, 0.0) if the change does not fit any combination of them.
+        """
+        if len(pending) == 1 and not distinguishable(pending):
+            return self.attribute_light(added_weight, pending[0])
+
+        mask = 0
+        for item in pending:
+            mask |= 1 << self.items.index(item)
+
+        found, confidence = self.index.attribute(added_weight, mask)
+        if found is None:
+            return (None, 0.0)
+
+        return ([self.items[i] for i in mask_to_indices(found)], confidence)
+
+    def attribute_light(self, added_weight:float, item):
+        """
+        Judges a lone item too light for its weight window to clear the noise: it fell if the weight
+        went up by at least half of its nominal weight (and not past its window)
+        """
+        if added_weight < -self.empty_tol or added_weight > item.weight + weight_tol(item):
+            return (None, 0.0)
+        return ([item] if added_weight >= item.weight / 2 else [], 1.0)
@@ -0,0 +1,300 @@
+"""
+Arbiter for the I2C bus shared by the platform MotorKits (0x61), the lane expanders (0x20/0x21) of
+every cabinet and the RGB1602 LCD. Every access is a short transaction on a named device. When several devices are
+waiting, the one with the most urgent priority goes next, so a platform step never queues behind a
+run of LCD writes. Transaction counts and the time each device held the bus are kept per device.
+
+The lane expanders are written from the native module's own threads, so a lane rotation cannot be
+split into transactions. It reserves a share of the bus time instead (its step rate times the time of
+one expander write) for its whole length: rotations of several cabinets run side by side while their
+shares fit in STREAM_CAPACITY, the rest of the bus is left to platform steps, and less urgent devices
+(the LCD) wait until the rotations are over. SimulatedBus stands in for an SMBus in tests.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+I2C_BUS_NUM = 1
+
+# Priorities, most urgent first
+MOTOR = 0                       # Step writes--late writes show up as motor jitter
+SENSOR = 1
+DISPLAY = 2                     # Best effort (LCD)
+
+BYTE_TIME = 9 / 100000          # Seconds to clock one byte (plus ACK) at 100 kHz
+WRITE_TIME = 3 * BYTE_TIME      # Seconds of one register write (address, register, data)
+STREAM_CAPACITY = 0.7           # Share of the bus time reservations may hold together--the rest is kept for transactions
+
+
+def bus_share(writes_per_second:float) -> float:
+    """Share of the bus time taken by a stream of register writes"""
+    return writes_per_second * WRITE_TIME
+
+
+class BusArbiter:
+    """
+    Grants the bus to one transaction at a time, most urgent waiting priority first, alongside
+    reservations that share the bus for the length of a native lane rotation
+    """
+
+    def __init__(self, capacity:float=STREAM_CAPACITY):
+        self.cond = threading.Condition()
+        self.busy = False
+        self.waiting = []               # Heap of (priority, ticket) of waiting transactions
+        self.capacity = capacity
+        self.streams = {}               # Ticket -> (priority, share) of reservations holding the bus
+        self.stream_queue = []          # Heap of (priority, ticket) of reservations waiting for room
+        self.tickets = itertools.count()
+        self.started = time.monotonic()
+        self.counts = {}                # Device -> transactions
+        self.busy_time = {}             # Device -> seconds spent holding the bus
+        self.wait_time = {}             # Device -> seconds spent waiting for the bus
+
+    def acquire(self, priority:int=DISPLAY):
+        ticket = (priority, next(self.tickets))
+        with self.cond:
+            heapq.heappush(self.waiting, ticket)
+            while self.busy or self.waiting[0] != ticket or self._held_off(priority):
+                self.cond.wait()
+            heapq.heappop(self.waiting)
+            self.busy = True
+
+    def _held_off(self, priority:int) -> bool:
+        # Less urgent devices keep off the bus while a more urgent reservation is running
+        return any([p < priority for p, share in self.streams.values()])
+
+    def reserve(self, share:float, priority:int=MOTOR):
+        """Waits (first come first served) until a share of the bus fits, and returns its ticket"""
+        ticket = (priority, next(self.tickets))
+        with self.cond:
+            heapq.heappush(self.stream_queue, ticket)
+            while self.stream_queue[0] != ticket or not self._fits(share):
+                self.cond.wait()
+            heapq.heappop(self.stream_queue)
+            self.streams[ticket] = (priority, share)
+            self.cond.notify_all()      # The next reservation may fit as well
+        return ticket
+
+    def _fits(self, share:float) -> bool:
+        # A share bigger than the whole capacity still gets the bus once nothing else is reserved
+        reserved = sum([s for p, s in self.streams.values()])
+        return len(self.streams) == 0 or reserved + share <= self.capacity
+
+    def unreserve(self, ticket):
+        with self.cond:
+            del self.streams[ticket]
+            self.cond.notify_all()
+
+    def release(self):
+        with self.cond:
+            self.busy = False
+            self.cond.notify_all()
+
+    def transaction(self, device:str, priority:int=DISPLAY):
+        """Context manager holding the bus for one transaction on a device"""
+        return _Transaction(self, device, priority)
+
+    def reservation(self, device:str, share:float, priority:int=MOTOR):
+        """Context manager holding a share of the bus (see bus_share) for a device writing it from elsewhere"""
+        return _Reservation(self, device, share, priority)
+
+    def device_bus(self, device:str, priority:int=DISPLAY, bus=None):
+        """Returns an SMBus-compatible bus (opening /dev/i2c-1 if none is given) whose accesses go through the arbiter"""
+        if bus is None:
+            from smbus import SMBus
+            bus = SMBus(I2C_BUS_NUM)
+        return ArbitratedBus(self, bus, device, priority)
+
+    def snapshot(self) -> dict:
+        """Copy of the counters, to get the stats() and utilisation() of what happens after it"""
+        with self.cond:
+            return {'time': time.monotonic(), 'counts': dict(self.counts), 'busy': dict(self.busy_time),
+                    'wait': dict(self.wait_time)}
+
+    def utilisation(self, since:dict=None) -> float:
+        """Fraction of the time since the arbiter was created (or reset, or the since snapshot) that the bus was held"""
+        with self.cond:
+            start = self.started if since is None else since['time']
+            busy = sum(self.busy_time.values()) - (0.0 if since is None else sum(since['busy'].values()))
+        elapsed = time.monotonic() - start
+        return busy / elapsed if elapsed > 0 else 0.0
+
+    def stats(self, since:dict=None) -> dict:
+        """
+        Returns {device: {"transactions", "busy", "wait"}} with times in seconds, only counting what
+        happened after the since snapshot if one is given. Busy times of reservations are their share
+        of the time they were held.
+        """
+        base = since if since is not None else {'counts': {}, 'busy': {}, 'wait': {}}
+        with self.cond:
+            return {dev: {'transactions': n - base['counts'].get(dev, 0),
+                          'busy': round(self.busy_time[dev] - base['busy'].get(dev, 0.0), 6),
+                          'wait': round(self.wait_time[dev] - base['wait'].get(dev, 0.0), 6)}
+                    for dev, n in self.counts.items() if n > base['counts'].get(dev, 0)}
+
+    def reset_stats(self):
+        with self.cond:
+            self.started = time.monotonic()
+            self.counts = {}
+            self.busy_time = {}
+            self.wait_time = {}
+
+    def _record(self, device:str, waited:float, held:float):
+        with self.cond:
+            self.counts[device] = self.counts.get(device, 0) + 1
+            self.wait_time[device] = self.wait_time.get(device, 0.0) + waited
+            self.busy_time[device] = self.busy_time.get(device, 0.0) + held
+
+
+class _Transaction:
+    def __init__(self, arbiter:BusArbiter, device:str, priority:int):
+        self.arbiter = arbiter
+        self.device = device
+        self.priority = priority
+
+    def __enter__(self):
+        self.requested = time.monotonic()
+        self.arbiter.acquire(self.priority)
+        self.granted = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        held = time.monotonic() - self.granted
+        self.arbiter.release()
+        self.arbiter._record(self.device, self.granted - self.requested, held)
+        return False
+
+
+class _Reservation:
+    def __init__(self, arbiter:BusArbiter, device:str, share:float, priority:int):
+        self.arbiter = arbiter
+        self.device = device
+        self.share = share
+        self.priority = priority
+
+    def __enter__(self):
+        self.requested = time.monotonic()
+        self.ticket = self.arbiter.reserve(self.share, self.priority)
+        self.granted = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        held = time.monotonic() - self.granted
+        self.arbiter.unreserve(self.ticket)
+        self.arbiter._record(self.device, self.granted - self.requested, held * min(self.share, 1.0))
+        return False
+
+
+class ArbitratedBus:
+    """SMBus wrapper that makes every access a transaction on the arbiter"""
+
+    def __init__(self, arbiter:BusArbiter, bus, device:str, priority:int=DISPLAY):
+        self.arbiter = arbiter
+        self.bus = bus
+        self.device = device
+        self.priority = priority
+
+    def write_byte_data(self, addr:int, reg:int, value:int):
+        with self.arbiter.transaction(self.device, self.priority):
+            self.bus.write_byte_data(addr, reg, value)
+
+    def read_byte_data(self, addr:int, reg:int) -> int:
+        with self.arbiter.transaction(self.device, self.priority):
+            return self.bus.read_byte_data(addr, reg)
+
+
+class SimulatedBus:
+    """Stand-in for an SMBus that records every write and takes as long as a real bus would"""
+
+    def __init__(self, byte_time:float=BYTE_TIME):
+        self.byte_time = byte_time
+        self.writes = []                # (addr, reg, value) in the order they hit the bus
+        self.registers = {}
+
+    def write_byte_data(self, addr:int, reg:int, value:int):
+        time.sleep(3 * self.byte_time)  # Address, register, data
+        self.writes.append((addr, reg, value))
+        self.registers[(addr, reg)] = value
+
+    def read_byte_data(self, addr:int, reg:int) -> int:
+        time.sleep(4 * self.byte_time)  # Address, register, repeated start address, data
+        return self.registers.get((addr, reg), 0)
+
+
+def main():
+    # Simulated step jitter of a platform motor sharing the bus with a busy LCD, and with the lanes of
+    # another cabinet: python3 i2c_bus.py
+    step_interval = 0.002
+    num_steps = 500
+
+    def step(motor) -> list:
+        lateness = []
+        deadline = time.monotonic()
+        for i in range(num_steps):
+            deadline += step_interval
+            time.sleep(max(0, deadline - time.monotonic()))
+            motor.write_byte_data(0x61, 0x26, i & 0xff)
+            lateness.append(time.monotonic() - deadline)
+        lateness.sort()
+        return lateness
+
+    def show(label, lateness, arbiter):
+        print("{}: step lateness p50 {:.0f} us, p99 {:.0f} us, bus utilisation {:.0%}".format(
+            label, lateness[len(lateness) // 2] * 1e6, lateness[int(len(lateness) * 0.99)] * 1e6,
+            arbiter.utilisation()))
+        print("  {}".format(arbiter.stats()))
+
+    def run(motor_priority):
+        arbiter = BusArbiter()
+        bus = SimulatedBus()
+        motor = arbiter.device_bus('platform', motor_priority, bus)
+        lcd = arbiter.device_bus('lcd', DISPLAY, bus)
+        stopping = threading.Event()
+
+        def flood_lcd():
+            while not stopping.is_set():
+                lcd.write_byte_data(0x3e, 0x40, ord('x'))
+
+        lcd_threads = [threading.Thread(target=flood_lcd) for i in range(2)]
+        for t in lcd_threads:
+            t.start()
+
+        lateness = step(motor)
+
+        stopping.set()
+        for t in lcd_threads:
+            t.join()
+
+        show("motor priority {}".format(motor_priority), lateness, arbiter)
+
+    def run_beside_lanes(reserved):
+        arbiter = BusArbiter()
+        bus = SimulatedBus()
+        motor = arbiter.device_bus('pi1/platform', MOTOR, bus)
+
+        # A one second lane rotation of another cabinet, at 1000 steps/s
+        def rotate_lanes():
+            if reserved:
+                hold = arbiter.reservation('pi2/lanes', bus_share(1000))
+            else:
+                hold = arbiter.transaction('pi2/lanes', MOTOR)
+            with hold:
+                time.sleep(1.0)
+
+        lanes = threading.Thread(target=rotate_lanes)
+        lanes.start()
+        time.sleep(0.01)
+        lateness = step(motor)
+        lanes.join()
+
+        show("lanes {}".format("reserved" if reserved else "as one transaction"), lateness, arbiter)
+
+    run(MOTOR)
+    run(DISPLAY)
+    run_beside_lanes(False)
+    run_beside_lanes(True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Keeps count of the items left in every lane so that orders for empty lanes are turned away before
+the platform or any lane motor moves. Counts are kept in memory (keyed by lane channel) and saved
+to a JSON file after every change.
+
+Lanes that have never been stocked are untracked and always reported as available, so a machine
+without an inventory file behaves the same as before.
+"""
+
+import json
+import os
+import threading
+
+from topology import TOPOLOGY
+from state_file import atomic_write_json
+
+INVENTORY_FILE = "inventory.json"
+LOW_STOCK = 2                       # Lane counts at or below this are reported as low
+
+# Motor channel -> (row, column) of the lane, both counted from 1
+LANE_POSITIONS = TOPOLOGY.lane_positions
+
+
+def lane_channel(row:int, column:int, topology=TOPOLOGY) -> int:
+    """Returns the motor channel of the lane at a row and column (both counted from 1)"""
+    return topology.channels[(row, column)]
+
+
+class Inventory:
+    """Per-lane stock counts with O(1) availability checks"""
+
+    def __init__(self, path:str=INVENTORY_FILE, low_stock:int=LOW_STOCK, on_low_stock=None, topology=TOPOLOGY):
+        """
+        :param path: JSON file the counts are persisted to
+        :param low_stock: count at or below which on_low_stock(channel, count) is called
+        :param topology: Topology of the cabinet, for lanes given by row and column
+        """
+        self.path = path
+        self.topology = topology
+        self.low_stock = low_stock
+        self.on_low_stock = on_low_stock
+        self.lock = threading.Lock()
+        self.stock = {}                 # Lane channel -> items left
+
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.stock = {int(ch): count for ch, count in json.load(f)['lanes'].items()}
+
+    def count(self, channel:int):
+        """Returns the number of items left in a lane, or None if the lane is untracked"""
+        return self.stock.get(channel)
+
+    def available(self, channel:int, quantity:int=1) -> bool:
+        """Checks whether a lane holds at least quantity items"""
+        count = self.stock.get(channel)
+        return count is None or count >= quantity
+
+    def shortages(self, items:list) -> list:
+        """Returns the items whose lanes cannot cover the quantity ordered"""
+        wanted = {}
+        for item in items:
+            wanted[item.channel] = wanted.get(item.channel, 0) + item.quantity
+
+        return [i for i in items if not self.available(i.channel, wanted[i.channel])]
+
+    def remove(self, channel:int, quantity:int=1):
+        """Takes confirmed drops off the count of a lane"""
+        with self.lock:
+            if channel not in self.stock:
+                return
+            self.stock[channel] = max(self.stock[channel] - quantity, 0)
+            count = self.stock[channel]
+            self._save()
+
+        if count <= self.low_stock and self.on_low_stock is not None:
+            self.on_low_stock(channel, count)
+
+    def restock(self, message:dict):
+        """
+        Applies a restock message: {"lanes": [{"row": r, "column": c, "count": n}, ...]}, where each
+        lane may also be given by "channel". Counts replace the current ones unless "add" is true.
+        Raises ValueError, without changing any count, if a lane is not in the topology or a count is
+        negative.
+        """
+        add = message.get('add', False)
+        counts = []
+        for lane in message['lanes']:
+            if 'channel' in lane:
+                channel = lane['channel']
+                if channel not in self.topology.lane_positions:
+                    raise ValueError("No lane on channel {}".format(channel))
+            elif (lane['row'], lane['column']) in self.topology.channels:
+                channel = lane_channel(lane['row'], lane['column'], self.topology)
+            else:
+                raise ValueError("No lane at row {}, column {}".format(lane['row'], lane['column']))
+            count = int(lane['count'])
+            if count < 0:
+                raise ValueError("Negative count {} for lane {}".format(count, channel))
+            counts.append((channel, count))
+
+        with self.lock:
+            for channel, count in counts:
+                self.stock[channel] = (self.stock.get(channel, 0) + count) if add else count
+            self._save()
+
+    def _save(self):
+        atomic_write_json(self.path, {'lanes': {str(ch): count for ch, count in self.stock.items()}})
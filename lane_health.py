@@ -0,0 +1,148 @@
+"""
+Jam detection and the lane-health table. Lanes are turned in chunks while dispensing, and after
+every chunk the weight stream tells which items have dropped. JamDetector gives every lane a time
+budget from how long its drops usually take (LaneSpeedModel history) and a rotation budget; a lane
+whose item has not dropped within either is aborted instead of being turned again and again.
+
+Aborted lanes are marked faulted in LaneHealth, which is saved to a JSON file so a jammed lane stays
+out of service across restarts until it is cleared (after the jam has been fixed).
+"""
+
+import json
+import os
+import threading
+import time
+
+from inventory import lane_channel
+from topology import TOPOLOGY
+from state_file import atomic_write_json
+
+LANE_HEALTH_FILE = "lane_health.json"
+
+OK = "OK"
+FAULTED = "FAULTED"
+
+JAM_FACTOR = 2.5                # Multiple of a lane's average drop time after which it is jammed
+MIN_JAM_TIME = 4.0              # Shortest time budget (seconds) given to any lane
+MAX_JAM_TIME = 15.0             # Longest time budget (seconds) given to any lane
+DEFAULT_JAM_TIME = 10.0         # Time budget of lanes with no drop history
+MAX_EXTRA_ROTATIONS = 3         # Rotations a lane may take beyond the first pass before it is jammed
+
+
+class JamDetector:
+    """Tracks how long and how far the lanes of one drop have turned without their items dropping"""
+
+    def __init__(self, model=None, first_rotations:float=0, max_extra:float=MAX_EXTRA_ROTATIONS):
+        """
+        :param model: LaneSpeedModel whose average drop times set the time budgets (None for defaults)
+        :param first_rotations: rotations of the first pass, after which items are expected to drop
+        """
+        self.model = model
+        self.max_rotations = first_rotations + max_extra
+        self.elapsed = {}               # Channel -> seconds of the turns the lane was fired in
+        self.rotations = {}             # Channel -> rotations so far
+
+    def start(self, channels:list):
+        for ch in channels:
+            self.elapsed[ch] = 0.0
+            self.rotations[ch] = 0
+
+    def rotated(self, channels:list, rotations:float, seconds:float=0.0):
+        """Charges the lanes fired in one turn with its rotations and its seconds (a lane waiting while
+        others are fired on their own is not charged)"""
+        for ch in channels:
+            self.rotations[ch] += rotations
+            self.elapsed[ch] += seconds
+
+    def budget(self, channel:int) -> float:
+        """Seconds a lane may turn before its item counts as jammed"""
+        expected = self.model.average_time(channel) if self.model is not None else None
+        if expected is None:
+            return DEFAULT_JAM_TIME
+        return min(max(expected * JAM_FACTOR, MIN_JAM_TIME), MAX_JAM_TIME)
+
+    def jammed(self, channel:int):
+        """Returns why a lane is jammed ("timeout" or "rotations"), or None if it may keep turning"""
+        if self.elapsed[channel] > self.budget(channel):
+            return "timeout"
+        if self.rotations[channel] >= self.max_rotations:
+            return "rotations"
+        return None
+
+
+class LaneHealth:
+    """Persistent per-lane fault state, with jam and drop counts"""
+
+    def __init__(self, path:str=LANE_HEALTH_FILE, on_fault=None, topology=TOPOLOGY):
+        """
+        :param path: JSON file the table is persisted to
+        :param on_fault: called with (channel, reason) when a lane is marked faulted
+        :param topology: Topology of the cabinet, for lanes given by row and column
+        """
+        self.path = path
+        self.topology = topology
+        self.on_fault = on_fault
+        self.lock = threading.Lock()
+        self.lanes = {}                 # Channel -> {"state", "reason", "since", "jams", "drops"}
+
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.lanes = {int(ch): lane for ch, lane in json.load(f)['lanes'].items()}
+
+    def _lane(self, channel:int) -> dict:
+        if channel not in self.lanes:
+            self.lanes[channel] = {'state': OK, 'reason': None, 'since': None, 'jams': 0, 'drops': 0}
+        return self.lanes[channel]
+
+    def is_faulted(self, channel:int) -> bool:
+        lane = self.lanes.get(channel)
+        return lane is not None and lane['state'] == FAULTED
+
+    def faulted(self) -> set:
+        """Returns the channels of every faulted lane"""
+        return {ch for ch, lane in self.lanes.items() if lane['state'] == FAULTED}
+
+    def faults(self, items:list) -> list:
+        """Returns the items whose lanes are faulted"""
+        return [i for i in items if self.is_faulted(i.channel)]
+
+    def record_drop(self, channel:int):
+        with self.lock:
+            self._lane(channel)['drops'] += 1
+
+    def record_jam(self, channel:int, reason:str):
+        """Marks a lane faulted after it was aborted"""
+        with self.lock:
+            lane = self._lane(channel)
+            lane['jams'] += 1
+            lane['state'] = FAULTED
+            lane['reason'] = reason
+            lane['since'] = time.time()
+            self._save()
+
+        if self.on_fault is not None:
+            self.on_fault(channel, reason)
+
+    def clear(self, message:dict) -> list:
+        """
+        Puts lanes back in service: {"lanes": [{"row": r, "column": c}, ...]}, where each lane may
+        also be given by "channel". Returns the channels cleared.
+        """
+        cleared = []
+        with self.lock:
+            for lane in message['lanes']:
+                channel = lane['channel'] if 'channel' in lane else lane_channel(lane['row'], lane['column'], self.topology)
+                entry = self._lane(channel)
+                entry['state'] = OK
+                entry['reason'] = None
+                entry['since'] = None
+                cleared.append(channel)
+            self._save()
+        return cleared
+
+    def report(self) -> dict:
+        with self.lock:
+            return {ch: dict(lane) for ch, lane in self.lanes.items()}
+
+    def _save(self):
+        atomic_write_json(self.path, {'lanes': {str(ch): lane for ch, lane in self.lanes.items()}})
@@ -0,0 +1,105 @@
+"""
+Per-lane speed model. A lane is driven slower the more weight it has to push (the weight of one
+item times the items left in the lane) and bulky items are given a little extra margin, since
+steppers have more torque at lower step rates. Each lane also keeps a derating factor learned from
+its history: a stall (an item that needed another rotation) slows the lane and softens its ramp,
+and clean dispenses slowly win the speed back. Lane history, including the average time to
+dispense an item, is saved to a JSON file.
+"""
+
+import json
+import os
+import threading
+
+from state_file import atomic_write_json
+
+LANE_MODEL_FILE = "lane_model.json"
+
+MAX_STEP_HZ = 2500                      # Fastest step rate of a lane (MAX_STEP_RATE in ItemLaneSystem.cpp)
+MIN_STEP_HZ = 400                       # Slowest step rate the model picks
+HEAVY_LOAD = 2000                       # Grams of lane load at which the slowest rate is used
+BULKY_VOLUME = 2000                     # Volume of one item above which the rate is cut by BULKY_FACTOR
+BULKY_FACTOR = 0.9
+
+DEFAULT_ACCEL = 4000                    # Ramp acceleration (steps/s^2) of a lane with no stalls
+STALL_DERATE = 0.8                      # Derating factor applied on every stall
+RECOVER_STEP = 0.02                     # Derating recovered on every clean dispense
+MIN_DERATE = 0.4
+
+
+def base_step_hz(weight:float, volume:float=0, count:int=1) -> float:
+    """Step rate for a lane holding count items of the given weight (grams) and volume"""
+    load = weight * max(count, 1)
+    hz = MAX_STEP_HZ - (MAX_STEP_HZ - MIN_STEP_HZ) * min(load / HEAVY_LOAD, 1.0)
+    if volume > BULKY_VOLUME:
+        hz *= BULKY_FACTOR
+    return max(hz, MIN_STEP_HZ)
+
+
+class LaneSpeedModel:
+    """Learns a speed derating per lane from stalls and keeps per-lane dispense statistics"""
+
+    def __init__(self, path:str=LANE_MODEL_FILE, accel:float=DEFAULT_ACCEL):
+        self.path = path
+        self.accel = accel
+        self.lock = threading.Lock()
+        self.lanes = {}                 # Channel -> {"derate", "dispenses", "stalls", "time"}
+
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.lanes = {int(ch): lane for ch, lane in json.load(f)['lanes'].items()}
+
+    def _lane(self, channel:int) -> dict:
+        if channel not in self.lanes:
+            self.lanes[channel] = {'derate': 1.0, 'dispenses': 0, 'stalls': 0, 'time': 0.0}
+        return self.lanes[channel]
+
+    def derate(self, channel:int) -> float:
+        lane = self.lanes.get(channel)
+        return lane['derate'] if lane is not None else 1.0
+
+    def step_hz(self, channel:int, weight:float, volume:float=0, count:int=1) -> float:
+        """Step rate for a lane, as taken by ItemLaneSystem.rotate_at"""
+        return max(base_step_hz(weight, volume, count) * self.derate(channel), MIN_STEP_HZ)
+
+    def average_time(self, channel:int):
+        """Average seconds a lane has taken to drop an item (None without history)"""
+        lane = self.lanes.get(channel)
+        if lane is None or lane['dispenses'] == 0:
+            return None
+        return lane['time'] / lane['dispenses']
+
+    def lane_accel(self, channel:int) -> float:
+        """Ramp acceleration for a lane--lanes that stall are ramped more gently"""
+        return self.accel * self.derate(channel)
+
+    def record(self, channel:int, seconds:float, stalls:int=0):
+        """Records one item dispensed from a lane, taking seconds and needing stalls extra rotations"""
+        with self.lock:
+            lane = self._lane(channel)
+            lane['dispenses'] += 1
+            lane['time'] += seconds
+            lane['stalls'] += stalls
+            if stalls > 0:
+                lane['derate'] = max(lane['derate'] * STALL_DERATE ** stalls, MIN_DERATE)
+            else:
+                lane['derate'] = min(lane['derate'] + RECOVER_STEP, 1.0)
+
+    def record_stall(self, channel:int):
+        """Records an item that did not drop at all"""
+        with self.lock:
+            lane = self._lane(channel)
+            lane['stalls'] += 1
+            lane['derate'] = max(lane['derate'] * STALL_DERATE, MIN_DERATE)
+
+    def report(self) -> dict:
+        """Returns {channel: {"dispenses", "avg_time", "stalls", "derate"}}"""
+        with self.lock:
+            return {ch: {'dispenses': lane['dispenses'],
+                         'avg_time': round(lane['time'] / lane['dispenses'], 3) if lane['dispenses'] else None,
+                         'stalls': lane['stalls'],
+                         'derate': round(lane['derate'], 3)} for ch, lane in self.lanes.items()}
+
+    def save(self):
+        with self.lock:
+            atomic_write_json(self.path, {'lanes': {str(ch): lane for ch, lane in self.lanes.items()}})
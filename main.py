@@ -1,20 +1,39 @@
-import paho.mqtt.client as mqtt
 import json
+import sys
 
-from os import path
+from os import path, makedirs
 import RPi.GPIO as GPIO
-import pickle
 
 import time 
+import contextlib
+import queue
+import threading
 import movement.lane_stepper.build.ItemLaneSystem as ils
 from movement.platform_stepper import *
 from weight_sensor import *
+from order import *
+from dispense_planner import plan_batch, BatchAttributor
+from platform_load import PlatformLoad, plan_loads, profile_index
+from pickup_monitor import PickupMonitor, RECEIVED
+import order_journal as oj
+from inventory import Inventory, INVENTORY_FILE
+from cabinets import CabinetConfig, load_cabinets, CABINETS_FILE
+from telemetry import TelemetryPublisher
+from connection import ConnectionManager
+from status_reporter.status_display import StatusDisplay
+from i2c_bus import BusArbiter, MOTOR, DISPLAY, bus_share
+from zero_tracker import ZeroTracker
+from weight_trace import TraceRecorder
+from motion_sampler import Motion, MotionSampler
+from lane_model import LaneSpeedModel, MAX_STEP_HZ, LANE_MODEL_FILE
+from lane_health import LaneHealth, JamDetector, LANE_HEALTH_FILE
+from order_watchdog import OrderWatchdog, OrderAborted, ORDER_BUDGET
+from calibration import calibrate_sensor
+from calibration_store import load_calibration, save_calibration, build_sensor, migrate_pickle, CalibrationError, \
+  CALIBRATION_FILE, LEGACY_PICKLE_FILE
 #from weight_sensing_test import basic_tests
 
-CLIENT_ID = "pi1"                   # Identifier for machine
-
-NUM_ROWS = 4                        # Number of rows in machine
-NUM_COLS = 3                        # Number of columns in machine
+CLIENT_ID = "pi1"                   # Identifier for machine (the MQTT client, and the cabinet without a cabinets.json)
 
 BASE_WEIGHT = 0                     # Weight of inner platform on senors
 MAX_WEIGHT = 14000                  # Max weight (grams) of order that can be handled at one time
@@ -23,104 +42,93 @@ MAX_PLAT_VOL = 2000000              # Total volume of available space on the pla
 SUCCESS = True                      # Indicates if order handled successfully
 FAILURE = False                     # Indicates if an order fails
 
-PLAT_CHANNEL = 0                    # Motor hat channel of platform stepper motor
-
-HX711_DOUT_PIN = 17                 # dout GPIO pin of HX711 
-HX711_SDK_PIN = 18                  # sdk GPIO pin of HX711 
 HX711_GAIN = 128
-WEIGHT_FILE = "wsens_state.pickle"  # Filename for storing/loading weight sensor calibration data
+CALIBRATION_REFERENCES = [500, 2000] # Known masses (grams) placed on the platform to calibrate a new load cell
 
-# Platform stepper motor positions by row
-ROW1_POS = 11.8
-ROW2_POS = 5.9
-ZERO_POS = 0
-ROW3_POS = -5.8
+MIN_DROP_CONFIDENCE = 0.9           # Confidence needed to attribute a weight change to a set of items
 
-WEIGHT_VAR_TOL = 0.2                # Fraction of weight variation tolerated
+PLAT_STEP_SPEED = 35                # Speed of platform stepper rotations under the heaviest loads
 
-PLAT_STEP_SPEED = 35                # Speed of platform stepper rotations
-LANE_STEP_SPEED = 1                 # Speed of lane stepper rotations
+# Platform speed profiles by load: (max grams on the platform, speed, glide). Glide speeds are capped
+# at MAX_GLIDE_SPEED; an empty platform has nothing to shake loose so it moves linearly at full speed,
+# ramping up to it and back down at PLAT_STEP_ACCEL so the motor does not skip steps starting or stopping.
+PLAT_SPEED_PROFILES = [(0, 500, False),
+                       (500, MAX_GLIDE_SPEED, True),
+                       (2000, 50, True),
+                       (MAX_WEIGHT, PLAT_STEP_SPEED, True)]
+PLAT_EMPTY_TOL = 5                  # Grams on the platform still treated as empty
+PLAT_STEP_ACCEL = 1000              # Ramp acceleration (steps/s^2) of linear (not glide) platform moves
+LANE_STEP_RATE = MAX_STEP_HZ        # Step rate (steps/s) of lane stepper rotations when none is given
+LANE_STEP_ACCEL = 4000              # Ramp acceleration (steps/s^2) of lane stepper rotations without stalls
+LANE_HOLD_POLICY = ils.RELEASE      # What lane coils do after a rotation (RELEASE, HOLD, HOLD_IDLE)
+LANE_HOLD_IDLE_MS = 500             # Time a lane is held after a rotation under HOLD_IDLE
 
 LANE_ROTATIONS = 6                  # Number of rotations needed to dispense one item (will change)
 
-NUM_ATTEMPTS = 2                    # Number of attempts to drop an item before giving up
-
-MOTOR_CHANNELS = [[0, 3],
-                  [1, 4],
-                  [2, 5]]
+JAM_CHECK_ROTATIONS = 1             # Rotations between weight checks once the first pass has not dropped an item
+SENSOR_CHECK_SAMPLES = 8            # HX711 readings taken to check the sensor is alive before a lane is called jammed
+DROP_SETTLE_TIME = 1.5              # Seconds to wait for dropped items to settle on the platform
+SETTLE_TIMEOUT = 4.0                # Longest wait for the filtered weight to go flat before a drop is judged
+MOTION_SAMPLING = True              # Sample the weight continuously and confirm drops as soon as they settle
 
+PICKUP_TIMEOUT = 120                # Seconds before a delivery that is not picked up is reported
+PICKUP_WAIT = 300                   # Seconds an order waits for the platform to be cleared before failing
 
-# Holds all of the information related to an item that is ordered
-class Item(): 
-  def __init__(self, info:dict):
-    self.quantity = info['quantity']  # Amount to be dispensed
-    self.weight = info['weight']      # Weight of one unit
-    self.volume = info['volume']      # Volume of one unit
-    self.row = info['row']
-    self.column = info['column']
-    self.channel = MOTOR_CHANNELS[self.row-1][self.column-1]
+RECOVERY_MODE = "resume"            # What to do with interrupted orders on startup ("resume" or "refund")
 
-  def decrement(self):
-    """Decrement item quantity and return new value"""
-    self.quantity = self.quantity - 1
-    return self.quantity
-
-  def get_lane_speed(self):
-    """
-    Determines the rotation speed of the item lane stepper motors based on the weight of the items
-    held.
-    """
-    pass
-  
-  def get_lane_rotations(self):
-    """
-    Determines the expected number of rotations to drop one item given the volume of the item.
-    """
-    pass
+TRACE_DIR = None                    # Directory to record a raw weight trace of every order to (None to disable)
 
 
-class Order():
-  """Holds the information associated with an order (i.e. the list of items to dispense)"""
-  def __init__(self, ID, items:list):
-    
-    def schedule_order(order):
-      """Determines the order in which items should be dispensed based on location
-      Returns sorted list of item objects.
-      """
-      row_num = 1
-      sorted_order = []
-      
-      while len(sorted_order) < len(order):
-        for i in order:
-          if i.row == row_num:
-            sorted_order.append(i)
-        row_num += 1
-      
-      return sorted_order
-    
-    self.ID = ID 
-    self.items = schedule_order(items)  # list of sorted items to dispense
-  
-  def remove_item(self, item:Item):
-    """Removes an item from the list of items"""
-    self.items.remove(item)
-
 class Machine():
   """
-  Wrapper class that brings together all of the hardware modules (motors, sensors) and is used
-  to respond to the orders that are brought in from the backend
+  Wrapper class that brings together all of the hardware modules (motors, sensors) of one cabinet and
+  is used to respond to the orders that are brought in from the backend
   """
-  def __init__(self, max_plat_vol=MAX_PLAT_VOL, max_weight=MAX_WEIGHT):
+  def __init__(self, max_plat_vol=MAX_PLAT_VOL, max_weight=MAX_WEIGHT, bus=None, cabinet:CabinetConfig=None):
+    # Wiring, topology and state files of the cabinet (the single default cabinet if none is given)
+    self.cabinet = cabinet if cabinet is not None else CabinetConfig(CLIENT_ID)
+    self.topology = self.cabinet.topology
+    
+    # Arbiter for the I2C bus shared by the platforms, lanes and LCD of every cabinet (optional)
+    self.bus = bus
+    self.bus_mark = None                # Bus counters at the start of the current order
+    
+    # Which motors are stepping, so weight samples taken meanwhile can be filtered
+    self.motion = Motion()
+    
     # Lane initializations
-    self.lane_sys = ils.ItemLaneSystem()
+    self.lane_sys = ils.ItemLaneSystem(*self.topology.native_tables())
+    self.lane_sys.set_hold_policy(LANE_HOLD_POLICY, LANE_HOLD_IDLE_MS)
+    self.lane_model = LaneSpeedModel(self.cabinet.path(LANE_MODEL_FILE), accel=LANE_STEP_ACCEL)  # Lane speeds learned from stalls
     
     # Platform initializations
-    self.items_on_plat = []
-    self.plat_stepper = PlatformStepper(PLAT_CHANNEL)
+    self.items_on_plat = PlatformLoad()  # Items on the platform, with running weight and volume totals
+    self.plat_stepper = PlatformStepper(self.cabinet.plat_channel, bus=bus, motion=self.motion,
+                                        address=self.cabinet.plat_address,
+                                        pos_file=self.cabinet.path("channel{}_pos.txt".format(self.cabinet.plat_channel)),
+                                        device=self.cabinet.device('platform'))
     self.plat_vol = max_plat_vol        # Maximum item volume capacity of platform
     self.plat_weight = max_weight       # Maximum weight capacity of platform
     self.plat_full = False              # Indicates whether platform has reached max capacity
-    self.plat_location = ZERO_POS              # Current row location of platform
+    self.plat_location = self.topology.zero_position  # Current position of the platform (rotations from zero)
+    self.pickup = None                  # Monitor for the last delivery that has not been picked up
+    self.pickup_callback = None         # Called with (order ID, pickup state, grams removed)
+    self.sensor_fault_callback = None   # Called with the error when the weight sensor is found dead
+    self.current_order = None           # ID of the order being dispensed
+    self.journal = None                 # Optional OrderJournal that records dispensing progress
+    self.inventory = None               # Optional Inventory of the items left in each lane
+    self.lane_health = None             # Optional LaneHealth table--faulted lanes are never fired
+    self.telemetry = None               # Optional TelemetryPublisher for timings and motor counts
+    self.display = None                 # Optional StatusDisplay showing order progress on the LCD
+    self.zero_tracker = None            # Optional ZeroTracker keeping the load cell zeroed between orders
+    self.dispensing = False             # Whether an order is being dispensed (the zero tracker stays paused)
+    self.state_lock = threading.Lock()  # Guards dispensing against pickups finishing on the monitor thread
+    self.watchdog = None                # OrderWatchdog of the order being dispensed
+    self.aborted = None                 # OrderAborted of the last order, if its watchdog fired
+    self.order_budget = ORDER_BUDGET    # Seconds an order may take before it is aborted
+    self.platform_steps = 0             # Platform steps taken during the current order
+    self.lane_rotations = {}            # Lane rotations per channel during the current order
+    self.trace_dir = TRACE_DIR          # Where weight traces of orders are recorded (None to disable)
 
     # move platform to zero position
     self.plat_stepper.rotate('ccw', 750, 6)
@@ -132,322 +140,945 @@ class Machine():
     # Required setup for pins
     GPIO.setmode(GPIO.BCM)
 
-    # Create new sensor if we cannot load a file w/ the calibration data
-    if not (path.exists(WEIGHT_FILE)):
+    # Rebuild the sensor from the saved calibration, or calibrate it if there is none yet
+    record = None
+    calibration_file = self.cabinet.path(CALIBRATION_FILE)
+    try:
+      if path.exists(calibration_file):
+        record = load_calibration(calibration_file)
+      else:
+        record = migrate_pickle(self.cabinet.path(LEGACY_PICKLE_FILE), calibration_file)
+    except CalibrationError as e:
+      print("Ignoring saved calibration: {}".format(e))
+    
+    if record is None:
+        # A new load cell can only be calibrated by someone placing the reference masses, so a controller
+        # started as a service refuses to run rather than vend with an uncalibrated sensor
+        if not sys.stdin.isatty():
+          raise CalibrationError("No weight sensor calibration for cabinet {} ({}); start the controller from a "
+                                 "terminal once to calibrate it".format(self.cabinet.name, calibration_file))
         print("Generating weight sensor calibration...")
-        self.sensor = WeightSensor_HX711(dout=HX711_DOUT_PIN, pd_sck=HX711_SDK_PIN, gain=HX711_GAIN)
-        self.sensor.calibrate()
-        #basic_tests(3, self.sensor)
-        #calib_good = input("Satisfied with calibration? y/n? ")
-        #while (calib_good != 'y'):
-        #  self.sensor.calibrate()
-        #  calib_good = input("Satisfied with calibration? y/n? ")
-        
-        pl_file = open(WEIGHT_FILE, 'ab')
-        pickle.dump(self.sensor, pl_file)
-        pl_file.close()
+        self.sensor = WeightSensor_HX711(dout=self.cabinet.hx711_dout, pd_sck=self.cabinet.hx711_sck, gain=HX711_GAIN)
+        fit = calibrate_sensor(self.sensor, CALIBRATION_REFERENCES, self.place_reference)
+        save_calibration(self.sensor, calibration_file, fit.quality)
     else:
         print("Loading existing weight sensor calibration...")
-        pl_file = open(WEIGHT_FILE, 'rb')
-        self.sensor = pickle.load(pl_file)
-
-        # In order to make sure that the loaded state is usable, we need to setup the
-        # GPIO pins for the sensor before continuing
-        GPIO.setup(self.sensor.PD_SCK, GPIO.OUT)
-        GPIO.setup(self.sensor.DOUT, GPIO.IN)
+        self.sensor = build_sensor(record)
 
-        pl_file.close()
+    # Continuous, motion-filtered weight samples (only run while an order is being dispensed)
+    self.sampler = MotionSampler(self.sensor, self.motion) if MOTION_SAMPLING else None
+    
+    # Upper load limit of each speed profile, for bisecting
+    self.profile_limits = [limit for limit, speed, glide in PLAT_SPEED_PROFILES]
 
     print("Resetting platform position...")
     self.plat_stepper.reset_position()
-    self.plat_location = ZERO_POS
+    self.plat_location = self.topology.zero_position
  
   
+  def place_reference(self, grams):
+    """Has the operator put a calibration mass on the platform (grams=0 to empty it)"""
+    if grams == 0:
+      input("Remove any items from the platform of cabinet {}, then press Enter.".format(self.cabinet.name))
+    else:
+      input("Place exactly {} g on the platform of cabinet {}, then press Enter.".format(grams, self.cabinet.name))
+  
   def move_platform(self, row) -> bool:
     """Controls motor to move platform to desired row"""
-    pos = ROW1_POS if row == 1 else ROW2_POS if row == 2 else ROW3_POS  # desired platform position
+    pos = self.topology.row_positions[row]  # desired platform position
     cur = self.plat_location
     dir = 'ccw' if (pos > cur) else 'cw'
     dif = pos - cur
     num_rotate = abs(dif)  # number of rotations
     
+    speed, glide = self.adjust_platform_speed()
+    start = time.monotonic()
+    self.annotate('move_start', row=row, rotations=round(num_rotate, 2), speed=speed, glide=glide)
     try:
       print("Moving the platform {} steps".format(num_rotate))
-      self.plat_stepper.rotate(dir, PLAT_STEP_SPEED, num_rotate, True)
+      self.plat_stepper.rotate(dir, speed, num_rotate, glide, accel=0 if glide else PLAT_STEP_ACCEL)
     except:
       print("Failed call to move platform")
       return FAILURE
     
     self.plat_location = pos
+    self.platform_steps += int(num_rotate * DOUBLE_STEP)
+    self.emit('move', row=row, rotations=round(num_rotate, 2), speed=speed, glide=glide,
+              duration=round(time.monotonic() - start, 3))
     
     return SUCCESS
     
   @property
   def available_space(self):
     """Returns the available volume of the platform"""
-    used_volume = 0
-    for i in self.items_on_plat:
-      used_volume += i.volume
-    
-    return self.plat_vol - used_volume
+    return self.plat_vol - self.items_on_plat.volume
   
   @property
   def available_weight(self):
     """Returns the available weight of the platform"""
-    used_weight = 0
-    for i in self.items_on_plat:
-      used_weight += i.weight
-    
-    return self.plat_weight - used_weight
+    return self.plat_weight - self.items_on_plat.weight
   
   def adjust_platform_speed(self):
     """
     Adjusts the speed of rotation of the platform stepper motor based on the weight on the platform.
+    The load is the larger of the items known to be on the platform and the live weight reading (when
+    one is being taken). Returns (speed, glide) of the profile for that load.
     """
-    pass
+    load = self.items_on_plat.weight
+    if self.sampler is not None and self.sampler.running:
+      grams, valid = self.sampler.estimate()
+      if grams is not None:
+        load = max(load, grams)
+    
+    limit, speed, glide = PLAT_SPEED_PROFILES[profile_index(self.profile_limits, load, PLAT_EMPTY_TOL)]
+    return speed, glide
+
+  def emit(self, kind:str, **fields):
+    """Sends a telemetry event if telemetry is enabled"""
+    if self.telemetry is not None:
+      self.telemetry.emit(kind, **fields)
+    self.annotate(kind, **fields)
+
+  def annotate(self, kind:str, **fields):
+    """Marks what the machine is doing in the weight trace, if one is being recorded"""
+    if self.sensor.recorder is not None:
+      self.sensor.recorder.annotate(kind, **fields)
+
+  def resume_zero_tracking(self):
+    """Lets the zero tracker correct the offset again once the platform is known to be empty. Never while
+    an order is being dispensed (a pickup often finishes while the next order waits for it)--the end of the
+    order resumes it instead, if the platform is clear by then.
+    """
+    with self.state_lock:
+      if self.zero_tracker is not None and not self.dispensing:
+        self.zero_tracker.resume()
+
+  def show_status(self, *lines):
+    """Puts a status on the LCD if there is one--only updates a framebuffer, never waits on I2C"""
+    if self.display is not None:
+      self.display.show(*lines)
 
   def dispense(self, order:Order) -> bool:
     """Controls the main dispensing workflow. Given an order, rotate the platform and item lane motors to
     dispense the items according to the sorted order. Updates the order object progressively. Delivers
     the items when dispensing is complete.
     """
-    next_items = []
+    start = time.monotonic()
+    self.platform_steps = 0
+    self.lane_rotations = {}
+    if self.bus is not None:
+      # Other cabinets share the bus, so its counters are never reset--only what happens from here is reported
+      self.bus_mark = self.bus.snapshot()
     
+    # The offset must not move while items are being weighed
+    with self.state_lock:
+      self.dispensing = True
+      if self.zero_tracker is not None:
+        self.zero_tracker.pause()
+    
+    if self.trace_dir is not None:
+      trace_path = path.join(self.trace_dir, "{}-{}.wtr".format(order.ID, int(time.time())))
+      self.sensor.recorder = TraceRecorder(trace_path, self.sensor, order_id=order.ID)
+    
+    total = sum([item.quantity for item in order.items])
+    self.show_status("Order {}".format(order.ID), "Starting")
+    self.aborted = None
+    self.watchdog = OrderWatchdog(self.order_budget, abort_hooks=[self.abort_motion]).start()
+    if self.sampler is not None:
+      self.sampler.start()
+    try:
+      result = self._dispense(order, total)
+    except OrderAborted as e:
+      print("Order {} aborted: {}".format(order.ID, e))
+      self.aborted = e
+      result = FAILURE
+    finally:
+      self.watchdog.stop()
+      phases = self.watchdog.report()
+      self.watchdog = None
+      if self.sampler is not None:
+        self.sampler.stop()
+      if self.sensor.recorder is not None:
+        self.sensor.recorder.close()
+        self.sensor.recorder = None
+      with self.state_lock:
+        self.dispensing = False
+    
+    if self.aborted is not None:
+      self.emit('abort', order_id=order.ID, phase=self.aborted.phase, elapsed=round(self.aborted.elapsed, 3),
+                budget=self.aborted.budget)
+      self.recover()
+    if not result:
+      self.show_status("Order {}".format(order.ID), "Failed")
+    elif self.pickup is None:
+      self.show_status("Ready")
+    
+    # Nothing is left to be picked up, so the platform is empty
+    if (self.pickup is None or not self.pickup.pending) and len(self.items_on_plat) == 0:
+      self.resume_zero_tracking()
+    
+    self.lane_model.save()
+    self.emit('lanes', report=self.lane_model.report())
+    self.emit('order', order_id=order.ID, success=result, duration=round(time.monotonic() - start, 3),
+              platform_steps=self.platform_steps, lane_rotations=self.lane_rotations,
+              pin_writes=self.lane_sys.get_pin_writes(),
+              bus=None if self.bus is None else self.bus.stats(self.bus_mark),
+              bus_utilisation=None if self.bus is None else round(self.bus.utilisation(self.bus_mark), 3),
+              phases=phases)
+    return result
+
+  def phase(self, name:str):
+    """Runs a block as a phase of the order being dispensed, under the order's watchdog"""
+    if self.watchdog is None:
+      return contextlib.nullcontext()
+    return self.watchdog.phase(name)
+  
+  def checkpoint(self):
+    """Raises OrderAborted if the watchdog of the order being dispensed has fired"""
+    if self.watchdog is not None:
+      self.watchdog.check()
+  
+  def abort_motion(self):
+    """Watchdog hook: cuts short whatever motor move or sensor read is in progress"""
+    self.lane_sys.abort()
+    self.plat_stepper.abort()
+    self.sensor.abort()
+  
+  def recover(self):
+    """Returns the machine to service after an aborted or failed order: motors released, the platform back
+    home, anything already dropped handed over to the customer and zero tracking back on if it is empty.
+    """
+    self.lane_sys.clear_abort()
+    self.plat_stepper.clear_abort()
+    self.sensor.clear_abort()
+    try:
+      self.lane_sys.zero_all_pins()
+      if self.pickup is not None and self.pickup.pending:
+        # Still waiting for the last delivery to be picked up, so only bring the platform home
+        self.plat_stepper.reset_position()
+        self.plat_location = self.topology.zero_position
+      else:
+        self.deliver()
+    except OSError as e:
+      print("Could not recover from the order: {}".format(e))
+    
+    if (self.pickup is None or not self.pickup.pending) and len(self.items_on_plat) == 0:
+      self.resume_zero_tracking()
+
+  def _dispense(self, order:Order, total:int) -> bool:
+    self.current_order = order.ID
+    
+    # Fail fast on empty lanes instead of spinning them before giving up
+    if self.inventory is not None:
+      short = self.inventory.shortages(order.items)
+      if len(short) > 0:
+        print("Not enough stock for items: {}".format(short))
+        return FAILURE
+    
+    if self.lane_health is not None:
+      faults = self.lane_health.faults(order.items)
+      if len(faults) > 0:
+        print("Lanes are out of service for items: {}".format(faults))
+        return FAILURE
+    
+    if self.journal is not None:
+      self.journal.set_status(order.ID, oj.DISPENSING)
+    
+    # Split the order into platform loads up front, so every trip to hand items over is known before
+    # the first drop. Items left on the platform (from a resumed order) count towards the first load,
+    # unless they are a delivery that will be picked up before the platform moves
+    with self.phase('prepare'):
+      used = self.items_on_plat if self.pickup is None or not self.pickup.pending else PlatformLoad()
+      loads = plan_loads(order.items, self.plat_weight, self.plat_vol, used.weight, used.volume)
+      if loads is None:
+        print("Items do not fit on an empty platform")
+        return FAILURE
+      self.emit('plan', order_id=order.ID, loads=[sum(load.values()) for load in loads])
+      load = loads.pop(0)
+    
+      # Plan the first drop while the last delivery may still be waiting to be picked up (the platform
+      # cannot move until it has been cleared), against the room left next to whatever stays on it. An
+      # empty first load means nothing fits next to it, and the loop hands that over first.
+      planned = None
+      pending = [x for x in order.items if load.get(x, 0) > 0]
+      if len(pending) > 0:
+        first_row = [x for x in pending if x.row == pending[0].row]
+        planned = plan_batch(first_row, self.plat_weight - used.weight, self.plat_vol - used.volume,
+                             self.faulted_lanes())
+    
+    if not self.wait_for_pickup():
+      print("Items from the last delivery are still on the platform")
+      return FAILURE
+    
+    def update_order(item):
+      # Called as soon as a drop is confirmed, before the watchdog can cut the drop short
+      print("Updating order")
+      load[item] -= 1
+      if self.journal is not None:
+        self.journal.item_dropped(order.ID, item.key)
+      if self.inventory is not None:
+        self.inventory.remove(item.channel)
+      if item.decrement() == 0:
+        order.remove_item(item)
+    
+    jammed = []
     while(len(order.items) > 0):
-      if len(next_items) == 0:
-        row = order.items[0].row
-        next_items = [x for x in order.items if x.row == row]
+      pending = [x for x in order.items if load.get(x, 0) > 0]
+      if len(pending) == 0:
+        # This load is done, hand it over before starting on the next one
+        load = loads.pop(0) if len(loads) > 0 else {x: x.quantity for x in order.items}
+        if len(self.items_on_plat) > 0 and not self.deliver(wait=True):
+          print("Items were not picked up")
+          return FAILURE
+        continue
+      
+      row = pending[0].row
+      row_items = [x for x in pending if x.row == row]
       
       # Move platform
-      print("Items to drop: {}".format(next_items))
-      if self.plat_location != row:
+      print("Items to drop: {}".format(row_items))
+      if self.plat_location != self.topology.row_positions[row]:
         print("About to try to move the platform")
-        try:
-          assert self.move_platform(row=row) == True
-        except:
-          print("Failed to move platform")
+        with self.phase('move'):
+          try:
+            assert self.move_platform(row=row) == True
+          except AssertionError:
+            print("Failed to move platform")
+            return FAILURE
+      
+      # Pick the lanes to fire together this settle cycle
+      if planned is not None:
+        batch, planned = planned, None
+      else:
+        batch = plan_batch(row_items, self.available_weight, self.available_space,
+                           self.faulted_lanes())
+      
+      if len(batch) == 0:
+        if len(self.items_on_plat) == 0:
+          print("Items do not fit on an empty platform")
+          return FAILURE
+        
+        # Platform is full sooner than planned (items heavier than their nominal weight), hand over
+        # what is on it before continuing with the row
+        if not self.deliver(wait=True):
+          print("Items were not picked up")
           return FAILURE
+        continue
       
       # Release order
       print("Preparing to drop items")
-      items_dropped = self.drop_items(next_items)
+      done = total - sum([item.quantity for item in order.items])
+      self.show_status("Order {}".format(order.ID), "Row {} • {}/{} items".format(row, done, total))
+      try:
+        with self.phase('drop'):
+          items_dropped = self.drop_items(batch, on_drop=update_order)
+      finally:
+        # One group commit per settle cycle--also when the watchdog cut it short, so that items already
+        # on the platform are never vended again by a resumed order
+        if self.journal is not None:
+          self.journal.commit()
       print("Items dropped")
       
-      # Update order
-      for item in next_items:
-        print("Updating order")
-        item.decrement()
-        if item.quantity == 0:
-          order.remove_item(item)
-        next_items = []
+      # Jammed lanes are taken out of the order and the rest of it is dispensed around them
+      failed = [x for x in batch if x not in items_dropped]
+      for item in [x for x in failed if x.channel in self.faulted_lanes()]:
+        jammed.append(item)
+        order.remove_item(item)
+        failed.remove(item)
+      
+      if len(failed) > 0:
+        print("Failed to drop items: {}".format(failed))
+        self.deliver()
+        return FAILURE
     
     self.deliver()
+    if len(jammed) > 0:
+      print("Items not dispensed from jammed lanes: {}".format(jammed))
+      return FAILURE
     return SUCCESS
 
-  def drop_items(self, items:list):
-    """Releases an item from its item lane onto the platform"""
-    print("Dropping items")
-    
-    tol = 0 # percent tolerance of weight difference to confirm successful item drop
-    #TODO adjust tolerance to be relative to the item's weight i.e. use percentage. 
+  def faulted_lanes(self) -> set:
+    """Returns the channels of the lanes that are out of service"""
+    return self.lane_health.faulted() if self.lane_health is not None else set()
 
-    min_expected_weight = 0  
-    w = self.available_weight
-    v = self.available_space
-    items_to_drop = []
-    for item in items:
-      w -= item.weight
-      v -= item.volume
-      if w < 0 or v < 0:
-        break
-      min_expected_weight += item.weight - (item.weight * WEIGHT_VAR_TOL)
-      items_to_drop.append(item)
-        
-    added_weight = 0                    # grams of weight added onto the platform
-    
-    print("Checking weight sensor")
-    print("Added weight: {}, min_expected_weight: {}".format(added_weight, min_expected_weight))
+  def drop_items(self, items:list, on_drop=None):
+    """Releases one unit of each item in a batch from its item lane onto the platform. All of the lanes
+    are rotated together and the change in weight tells which items fell; only the lanes that are still
+    stuck are rotated again, a little at a time, until they drop or the JamDetector gives up on them (the
+    lane is then marked faulted). A rise in weight that fits no combination of the stuck items is set
+    aside and the lanes are fired one at a time; once each has been tried, the grams set aside are
+    matched against the lanes that still have not dropped. Every item is put on the platform (and
+    on_drop(item) called) as soon as its drop is confirmed. Returns the list of items that dropped, or raises
+    SensorFault if nothing has dropped and the weight sensor turns out to be dead rather than the lanes jammed.
+    """
+    print("Dropping {} items".format(len(items)))
     
+    attributor = BatchAttributor(items)
+    self.annotate('expect', channels=[item.channel for item in items], weights=[item.weight for item in items])
+    items_to_drop = list(items)
     items_dropped = []
-    print("Dropping {} items".format(len(items_to_drop)))
-    if (len(items_to_drop) == 1):
-      if (self.single_item_drop(items_to_drop[0], NUM_ATTEMPTS) == True):
-        print("Item dropped successfully")
-        items_dropped.append(items_to_drop[0])
-
-    # If items are very close in weight, don't drop them at the same time
-    elif (len(items_to_drop) == 2 and abs(items_to_drop[0].weight - items_to_drop[1].weight) < 10):
-      print("Dropping two items with similar weights")
-      if (self.single_item_drop(items_to_drop[0], NUM_ATTEMPTS) == True):
-        print("Successfully dropped first item")
-        items_dropped.append(items_to_drop[0])
-      if (self.single_item_drop(items_to_drop[1], NUM_ATTEMPTS) == True):
-        print("Successfully dropped second item")
-        items_dropped.append(items_to_drop[1])
-    
-    # If items have sufficient difference in weights, drop at same time
-    else:      
-      print("Dropping two items with different weights")
-      while (added_weight < min_expected_weight):
-        channels = [item.channel for item in items_to_drop]  # get motor channels
-        print("About to rotate: {}".format(channels))
-        dirs = ['cw' for i in range(len(channels))]
-        speeds = [LANE_STEP_SPEED for i in range(len(channels))]
-        num_steps = [LANE_ROTATIONS for i in range(len(channels))]
+    num_rotate = LANE_ROTATIONS
+    attempts = 0
+    start = time.monotonic()
+    detector = JamDetector(self.lane_model, LANE_ROTATIONS)
+    detector.start([item.channel for item in items])
+    lane_tries = {item.channel: 0 for item in items}    # Turns that fired the lane without its item dropping
+    solo = False                      # Fire the stuck lanes one at a time
+    unexplained = 0.0                 # Grams added by a change that fit no combination of the stuck items
+    untried = []                      # Lanes not yet fired on their own since the unexplained change
+    turn = 0
+    
+    def dropped(item):
+      print("Item detected. Channel: {}".format(item.channel))
+      items_dropped.append(item)
+      items_to_drop.remove(item)
+      self.lane_model.record(item.channel, detector.elapsed[item.channel], stalls=lane_tries[item.channel])
+      if self.lane_health is not None:
+        self.lane_health.record_drop(item.channel)
+      self.items_on_plat.append(item)
+      if (self.available_weight <= 0 or self.available_space <= 0):
+        self.plat_full = True
+      if on_drop is not None:
+        on_drop(item)
+    
+    # Heavier lanes (and lanes that have stalled before) turn slower and ramp more gently
+    speeds = {}
+    for item in items:
+      count = self.inventory.count(item.channel) if self.inventory is not None else None
+      speeds[item.channel] = item.get_lane_speed(self.lane_model, count if count is not None else 1)
+    
+    while (len(items_to_drop) > 0):
+      self.checkpoint()
+      turn_start = time.monotonic()
+      was_solo = solo
+      if solo:
+        firing = [items_to_drop[turn % len(items_to_drop)]]
+        turn += 1
+      else:
+        firing = list(items_to_drop)
+      channels = [item.channel for item in firing]  # get motor channels
+      print("About to rotate: {}".format(channels))
+      lane_speeds = [speeds[ch] for ch in channels]
       
+      if self.sampler is not None:
+        # Only a flat estimate is a baseline--one still moving would carry its error into this drop
+        baseline, valid = self.sampler.wait_for_estimate(None, SETTLE_TIMEOUT)
+        if baseline is None or not valid:
+          baseline = self.sensor.get_grams(verbose=False)
+        achieved = self.rotate_lanes(channels, num_rotate, lane_speeds)
+        added_weight, fell, confidence = self.measure_drop(attributor, firing, baseline)
+      else:
         self.sensor.set_prev_read(self.sensor.get_grams())
-        change = 0
-        while (change == 0):
-          self.lane_sys.rotate_n(channels, dirs, speeds, num_steps)
-          time.sleep(1)  # give items time to fall/settle
-          change = self.sensor.detect_change(5)
-          
-        added_weight += change
-        print("Initial added weight: {}".format(added_weight))
+        achieved = self.rotate_lanes(channels, num_rotate, lane_speeds)
+        time.sleep(DROP_SETTLE_TIME)  # give items time to fall/settle
+        added_weight = self.sensor.detect_change(1)
+        
+        # Work out which combination of the stuck items fell from the weight added
+        fell, confidence = attributor.attribute(added_weight, firing)
+      print("Added weight: {}".format(added_weight))
+      
+      # Lanes are charged only for their own turns, not for waiting on the other lanes' retries
+      detector.rotated(channels, num_rotate, time.monotonic() - turn_start)
+      
+      self.emit('drop', channels=channels, rotations=num_rotate, attempt=attempts, added_weight=round(added_weight, 2),
+                fell=None if fell is None else [i.channel for i in fell], confidence=round(confidence, 3),
+                rates=[round(r) for r in lane_speeds], achieved=achieved)
+      if fell is None or confidence < MIN_DROP_CONFIDENCE:
+        if solo or len(firing) == 1 or added_weight <= attributor.empty_tol:
+          print("Weight change does not match a combination of the items (confidence {:.2f})".format(confidence))
+          break
         
-        # Handle scenario where only 1/2 items dropped successfully
-        if (added_weight > 0 and added_weight < min_expected_weight):
-          # Determine which item is stuck
-          if abs(added_weight - items_to_drop[0].weight) < abs(added_weight - items_to_drop[1].weight):
-            stuck_item = items_to_drop[1]
-            items_dropped.append(items_to_drop[0])
-            items_to_drop.remove(items_to_drop[0])
+        # Something fell but it is not clear what--set the weight aside and try the lanes one at a time
+        print("Weight change does not match a combination of the items, firing the lanes one at a time")
+        self.emit('unattributed', channels=channels, added_weight=round(added_weight, 2))
+        solo = True
+        unexplained = added_weight
+        untried = list(items_to_drop)
+        fell = []
+      
+      for item in fell:
+        dropped(item)
+      
+      if was_solo:
+        for item in firing:
+          if item in untried:
+            untried.remove(item)
+        
+        # Every lane has had a turn of its own, so the grams set aside belong to lanes that are still
+        # waiting--the ones whose item fell together with the others. A single lane left gets them if
+        # they are nearer one of its items than none or two (its item was out of its weight window).
+        if unexplained > 0 and len(untried) == 0:
+          found, confidence = (None, 0.0)
+          if len(items_to_drop) == 1 and abs(unexplained - items_to_drop[0].weight) < items_to_drop[0].weight / 2:
+            found, confidence = (list(items_to_drop), 1.0)
+          elif len(items_to_drop) > 0:
+            found, confidence = BatchAttributor(items_to_drop).attribute(unexplained, items_to_drop)
+          if found is not None and confidence >= MIN_DROP_CONFIDENCE:
+            for item in found:
+              dropped(item)
           else:
-            stuck_item = items_to_drop[0]
-            items_dropped.append(items_to_drop[1])
-            items_to_drop.remove(items_to_drop[1])
-
-          # Attempt to drop the stuck item
-          if (self.single_item_drop(stuck_item, NUM_ATTEMPTS-1) == True):
-            items_dropped.append(stuck_item)
-            items_to_drop.remove(stuck_item)
+            print("{:.1f} grams on the platform could not be matched to any item".format(unexplained))
+          unexplained = 0.0
+      
+      # Abort the lanes that have run out of time or rotations instead of turning them again (not while
+      # set-aside grams may still turn out to be theirs)
+      for item in list(items_to_drop):
+        if unexplained > 0:
+          break
+        reason = detector.jammed(item.channel)
+        if reason is None:
+          continue
+        
+        # Nothing registering on a dead sensor looks like every lane jamming--fail the order on the sensor
+        # instead of taking working lanes out of service
+        if len(items_dropped) == 0 and not self.sensor_alive(start):
+          self.sensor_fault(SensorFault("Weight sensor readings do not vary, not marking lane {} jammed".format(
+            item.channel)))
+        print("Lane {} jammed ({}), taking it out of service".format(item.channel, reason))
+        items_to_drop.remove(item)
+        self.lane_model.record_stall(item.channel)
+        self.emit('jam', channel=item.channel, reason=reason, rotations=detector.rotations[item.channel],
+                  seconds=round(detector.elapsed[item.channel], 2), budget=round(detector.budget(item.channel), 2))
+        if self.lane_health is not None:
+          self.lane_health.record_jam(item.channel, reason)
+      
+      for item in firing:
+        lane_tries[item.channel] += 1
+      attempts += 1
+      num_rotate = JAM_CHECK_ROTATIONS
     
     print("Finished dropping items")
-    
-    for item in items_dropped:
-      self.items_on_plat.append(item)
-      if (self.available_weight <= 0 or self.available_space <= 0):
-        self.plat_full = True
-        self.deliver()
+    for item in items_to_drop:
+      self.lane_model.record_stall(item.channel)
     
     return items_dropped
   
-  def single_item_drop(self, item:Item, num_tries:int)->bool:
-    """Rotates a motor to drop a single item. Returns success or failure"""
-    attempts = 0
-    self.sensor.set_prev_read(self.sensor.get_grams())
-    print("Now attempting to drop one item. Channel: {}".format(item.channel))
-    num_rotate = LANE_ROTATIONS
-    while (attempts < num_tries):
-      self.lane_sys.rotate(item.channel, 'cw', LANE_STEP_SPEED, num_rotate)
-      time.sleep(1.5)  # settling time
-      if (self.sensor.detect_change(1) >= item.weight - (item.weight*WEIGHT_VAR_TOL)):
-        print("Item detected")
-        return SUCCESS
-      attempts += 1
-      num_rotate = 1
-      print("Item not detected")
-    return FAILURE
-
+  def sensor_alive(self, since:float) -> bool:
+    """Whether the weight sensor's readings since the given time vary, as a working load cell's always do"""
+    if self.sampler is not None:
+      return self.sampler.live(since)
+    try:
+      reads = [self.sensor.read() for i in range(SENSOR_CHECK_SAMPLES)]
+    except OSError:
+      return False
+    return len(set(reads)) > 1
+  
+  def sensor_fault(self, error:SensorFault):
+    """Reports a dead weight sensor and raises the error, failing the order"""
+    print(error)
+    self.emit('sensor_fault', error=str(error))
+    if self.sensor_fault_callback is not None:
+      self.sensor_fault_callback(error)
+    raise error
+  
+  def measure_drop(self, attributor:BatchAttributor, pending:list, baseline:float):
+    """Watches the filtered weight after the lanes have turned until it settles on a combination of the
+    pending items, or until DROP_SETTLE_TIME is up and the weight is flat (waiting up to SETTLE_TIMEOUT
+    for that). Returns (added weight, items that fell, confidence)--no items and no confidence if the
+    weight never went flat.
+    """
+    since = time.monotonic()
+    deadline = since + DROP_SETTLE_TIME
+    timeout = since + SETTLE_TIMEOUT
+    while True:
+      grams, valid = self.sampler.wait_for_estimate(since, max(deadline - time.monotonic(), 0))
+      added_weight = (grams if grams is not None else baseline) - baseline
+      fell, confidence = attributor.attribute(added_weight, pending)
+      
+      # Items can still be falling when the weight first looks steady, so only stop early on a match
+      if valid and fell is not None and len(fell) > 0 and confidence >= MIN_DROP_CONFIDENCE:
+        return added_weight, fell, confidence
+      now = time.monotonic()
+      if now >= deadline and valid:
+        return added_weight, fell, confidence
+      if now >= timeout:
+        return added_weight, None, 0.0
+      self.sampler.wait_for_sample(timeout - now if now >= deadline else deadline - now)
 
-  def deliver(self):
-    """Moves platform to center and waits for user to take items"""
-    print("Resetting platform to deliver items")
-    self.plat_stepper.reset_position()
-    self.plat_location = ZERO_POS
-    self.ItemsReceived()
-    self.plat_full = False
-    return
-
-  def ItemsReceived(self) -> bool:
-    """Checks that items have been removed from the platform and the weight has returned to initial"""
-    weight_on_plat = sum([item.weight - (item.weight*WEIGHT_VAR_TOL) for item in self.items_on_plat]) 
-    # TODO: Account for situation where items not received after a long period of time
-    print("Waiting for items to be received")
-    self.sensor.set_prev_read(self.sensor.get_grams())
-    while (self.sensor.detect_change(0.1) < weight_on_plat):
-      # wait some amount of time and then check weight again
-      print("Grams on plat: {}".format(self.sensor.get_grams()))
+  def rotate_lanes(self, channels:list, num_rotate:float, speeds:list=None) -> list:
+    """Rotates the lanes on the given channels together, at the given step rates (LANE_STEP_RATE by default).
+    Returns the step rate each lane actually achieved.
+    """
+    if speeds is None:
+      speeds = [LANE_STEP_RATE] * len(channels)
+    accels = [self.lane_model.lane_accel(ch) for ch in channels]
     
-    self.items_on_plat = []
+    for ch in channels:
+      self.lane_rotations[ch] = self.lane_rotations.get(ch, 0) + num_rotate
+    self.annotate('lanes', channels=channels, rotations=num_rotate, speeds=speeds)
     
-    print("Items received")
-    return SUCCESS
+    with self.motion.during('lanes', max(speeds)):
+      if self.bus is None:
+        self._rotate_lanes(channels, num_rotate, speeds, accels)
+      else:
+        # The expanders are written from native threads, so the rotation reserves its share of the bus
+        # (about one expander write per step) for its whole length--platforms of other cabinets keep stepping
+        with self.bus.reservation(self.cabinet.device('lanes'), bus_share(sum(speeds)), MOTOR):
+          self._rotate_lanes(channels, num_rotate, speeds, accels)
+    
+    achieved = []
+    for ch, rate in zip(channels, speeds):
+      move = self.lane_sys.get_last_move(ch)
+      achieved.append(round(move['rate']) if move else None)
+      if move and move['late_steps'] > 0:
+        print("Lane {} ran at {:.0f} of {:.0f} steps/s ({:.0f} late steps, up to {:.0f} us)".format(
+          ch, move['rate'], move['target_rate'], move['late_steps'], move['max_late_us']))
+    return achieved
   
+  def _rotate_lanes(self, channels:list, num_rotate:float, speeds:list, accels:list):
+    if len(channels) == 1:
+      self.lane_sys.rotate_at(channels[0], 'cw', speeds[0], num_rotate, accels[0])
+    else:
+      n = len(channels)
+      self.lane_sys.rotate_n_at(channels, ['cw'] * n, speeds, [num_rotate] * n, accels)
 
-# Define global machine object
-MACHINE = Machine()
 
-def parse_payload(payload):
-  """Reads JSON payload and organizes information in Item dataclass.
-  Returns a list of item objects.
-  """
-  order = []
-  item_info = json.loads(payload)
-  order_ID = item_info['orderID']
+  def deliver(self, wait:bool=False) -> bool:
+    """Moves platform to center and starts watching for the user to take the items. Set wait to block
+    until they have been taken (e.g. when the platform has to be cleared before continuing an order).
+    """
+    print("Resetting platform to deliver items")
+    with self.phase('deliver'):
+      self.plat_stepper.reset_position()
+      self.plat_location = self.topology.zero_position
+      self.ItemsReceived()
+    
+    if wait:
+      return self.wait_for_pickup()
+    return SUCCESS
+
+  def ItemsReceived(self) -> PickupMonitor:
+    """Starts watching for the items to be removed from the platform in the background. The platform is
+    marked empty once the weight of the delivered items has come off. Returns the pickup monitor.
+    """
+    if len(self.items_on_plat) == 0:
+      self.pickup = None
+      return None
+    
+    weight_on_plat = self.items_on_plat.min_weight
+    order_id = self.current_order
+    
+    def notify(state, removed):
+      if self.pickup_callback is not None:
+        self.pickup_callback(order_id, state, removed)
+    
+    def on_complete(state, removed):
+      if state == RECEIVED:
+        print("Items received")
+        self.items_on_plat.clear()
+        self.plat_full = False
+        self.show_status("Ready")
+        self.resume_zero_tracking()
+      if self.telemetry is not None:
+        self.telemetry.trace('pickup', monitor.samples, order_id=order_id, state=state)
+      notify(state, removed)
+    
+    def on_partial(removed):
+      print("Partial pickup: {:.1f} of {:.1f} grams removed".format(removed, weight_on_plat))
+      notify("PARTIAL", removed)
+    
+    def on_timeout(removed):
+      print("Items not received after {} seconds".format(PICKUP_TIMEOUT))
+      notify("TIMEOUT", removed)
+    
+    print("Waiting for items to be received")
+    self.show_status("Please take", "your items")
+    monitor = PickupMonitor(self.sensor, weight_on_plat, PICKUP_TIMEOUT, on_complete=on_complete,
+                            on_partial=on_partial, on_timeout=on_timeout)
+    self.pickup = monitor
+    return monitor.start()
   
-  for i in item_info['orderList']:
-    order.append(Item(item_info['orderList'][i]))
+  def wait_for_pickup(self, timeout:float=PICKUP_WAIT) -> bool:
+    """Waits for the last delivery to be picked up. Returns whether the platform is clear"""
+    if self.pickup is None:
+      return SUCCESS
+    
+    with self.phase('pickup_wait'):
+      if self.watchdog is not None:
+        timeout = min(timeout, self.watchdog.remaining())
+      return self.pickup.wait(timeout) == RECEIVED
   
-  return order  
 
-def on_order(client, userdata, msg):
-    try:
-      order = json.loads(msg.payload)
-      print("Recieved order: " + str(order))
-      order_id = order['orderID']
+class Cabinet():
+  """
+  One cabinet driven by this controller: its Machine, its own order queue and hardware worker (so
+  cabinets vend in parallel), and its journal, inventory and lane-health table. Its messages are
+  published and subscribed under its own name.
+  """
+  def __init__(self, config:CabinetConfig, bus:BusArbiter, conn:ConnectionManager):
+    self.config = config
+    self.name = config.name
+    self.conn = conn
+    makedirs(config.state_dir, exist_ok=True)
+    
+    self.machine = Machine(bus=bus, cabinet=config)
+    
+    # Orders waiting for the hardware worker
+    self.queue = queue.Queue()
     
-      response_body = {
-          "status": "SUCCESS",
-          "order_id": order_id,
-      }
+    # Record of every order received, used to resume interrupted orders and drop redelivered ones
+    self.journal = oj.OrderJournal(config.path(oj.JOURNAL_FILE))
+    self.machine.journal = self.journal
+    
+    # Items left in every lane
+    self.inventory = Inventory(config.path(INVENTORY_FILE), on_low_stock=self.on_low_stock, topology=config.topology)
+    self.machine.inventory = self.inventory
+    
+    # Lanes taken out of service after a jam, kept across restarts until they are cleared
+    self.lane_health = LaneHealth(config.path(LANE_HEALTH_FILE), on_fault=self.on_lane_fault, topology=config.topology)
+    self.machine.lane_health = self.lane_health
+    
+    self.machine.pickup_callback = self.on_pickup
+    self.machine.sensor_fault_callback = self.on_sensor_fault
+  
+  def publish_status(self, topic, body, qos=1):
+    """Publishes a status message under this cabinet's topic, keeping it if the broker is unreachable"""
+    self.conn.publish(self.name+topic, json.dumps(body), qos=qos, persist=True)
+  
+  def subscribe(self):
+    self.conn.subscribe(self.name+"/order/vend", self.on_order)
+    self.conn.subscribe(self.name+"/inventory/restock", self.on_restock)
+    self.conn.subscribe(self.name+"/lanes/reset", self.on_lane_reset)
     
-      order = Order(order_id, parse_payload(msg.payload))
-      print("Items in order: {}".format(order.items))
-      vend_successful = MACHINE.dispense(order)
+    # Timings, drop results, and motor counts for fleet monitoring (best effort, never blocks a vend)
+    self.machine.telemetry = TelemetryPublisher(self.conn, self.name+"/telemetry").start()
+  
+  def start(self):
+    """Picks up interrupted orders, then starts zero tracking and the hardware worker"""
+    self.recover_orders()
     
+    # Keeps the load cell zeroed between orders, starting now unless recovered items are on the platform
+    self.machine.zero_tracker = ZeroTracker(self.machine.sensor, on_drift=self.on_zero_drift).start(
+      paused=len(self.machine.items_on_plat) > 0)
+    threading.Thread(target=self.hardware_worker, name="{}-worker".format(self.name), daemon=True).start()
+  
+  def on_low_stock(self, channel, count):
+    """Publishes a low-stock event for a lane"""
+    row, column = self.config.topology.lane_positions[channel]
+    body = {
+        "channel": channel,
+        "row": row,
+        "column": column,
+        "count": count,
+    }
+    self.publish_status("/inventory/low", body)
+  
+  def on_lane_fault(self, channel, reason):
+    """Publishes a lane that has been taken out of service"""
+    row, column = self.config.topology.lane_positions[channel]
+    body = {
+        "channel": channel,
+        "row": row,
+        "column": column,
+        "reason": reason,
+    }
+    self.publish_status("/lanes/fault", body)
+  
+  def on_zero_drift(self, drift):
+    """Reports a load cell whose zero has moved further than normal--it may need recalibrating"""
+    self.publish_status("/sensor/drift", {"drift_grams": round(drift, 1)})
+  
+  def on_sensor_fault(self, error):
+    """Reports a weight sensor that has stopped giving real readings--it needs checking before lanes are trusted"""
+    self.publish_status("/sensor/fault", {"error": str(error)})
+  
+  def hardware_worker(self):
+    """Dispenses queued orders one at a time so that the MQTT network loop never waits on the hardware"""
+    while True:
+      order = self.queue.get()
+      print("{}: items in order: {}".format(self.name, order.items))
+      error = None
+      try:
+        vend_successful = self.machine.dispense(order)
+      except Exception as e:
+        print("Dispense failed with error: {}".format(e))
+        error = e
+        vend_successful = FAILURE
+        
+        # Same as after an aborted order: motors released, the platform home and anything dropped handed over
+        try:
+          self.machine.recover()
+          self.machine.show_status("Order {}".format(order.ID), "Failed")
+        except Exception as e:
+          print("Could not recover from the failed order: {}".format(e))
+      
+      self.journal.set_status(order.ID, oj.SUCCESS if vend_successful else oj.FAILED)
+      
       # publish success message
       if(vend_successful): 
-          print("Vend successful")
-          client.publish(CLIENT_ID+"/order/status", payload=json.dumps(response_body), qos=1)
+        print("Vend successful")
+        response_body = {
+            "status": "SUCCESS",
+            "order_id": order.ID,
+        }
+        self.publish_status("/order/status", response_body)
       else:
         print("Vend unsuccessful")
+        if error is not None:
+          response_body = {
+              "status": "FAILED",
+              "order_id": order.ID,
+              "error": str(error),
+          }
+          self.publish_status("/order/status", response_body)
+        elif self.machine.aborted is not None:
+          response_body = {
+              "status": "TIMEOUT",
+              "order_id": order.ID,
+              "phase": self.machine.aborted.phase,
+              "elapsed": round(self.machine.aborted.elapsed, 1),
+          }
+          self.publish_status("/order/status", response_body)
+      self.queue.task_done()
+  
+  def on_pickup(self, order_id, state, removed):
+    """Publishes the progress of a delivery being picked up"""
+    body = {
+        "status": state,
+        "order_id": order_id,
+        "grams_removed": round(removed, 1),
+    }
+    self.publish_status("/order/pickup", body)
+    
+    if state == RECEIVED:
+      self.journal.platform_cleared(order_id)
+  
+  def recover_orders(self):
+    """Resumes or refunds the orders that were interrupted the last time the cabinet ran"""
+    for order_id, payload in self.journal.unfinished():
+      progress = self.journal.progress(order_id)
+      items = parse_payload(payload, self.config.topology)
+      on_plat = []
+      for item in items:
+        ordered, dropped, plat = progress[str(item.key)]
+        item.quantity = ordered - dropped
+        on_plat += [item] * plat
+      
+      if RECOVERY_MODE == "resume":
+        # Items already on the platform are delivered together with the rest of the order
+        print("Resuming interrupted order {}".format(order_id))
+        self.machine.items_on_plat.extend(on_plat)
+        self.queue.put(Order(order_id, [i for i in items if i.quantity > 0]))
+      else:
+        print("Refunding interrupted order {}".format(order_id))
+        self.journal.set_status(order_id, oj.REFUNDED)
+        body = {
+            "status": "REFUND",
+            "order_id": order_id,
+            "dispensed": {key: p[1] for key, p in progress.items()},
+            "refund": {key: p[0] - p[1] for key, p in progress.items()},
+        }
+        self.publish_status("/order/status", body)
+  
+  def on_order(self, client, userdata, msg):
+    try:
+      # Everything is validated here, before the order gets anywhere near the motors
+      try:
+        order = parse_order(msg.payload, self.config.topology)
+      except OrderError as e:
+        print("Rejected order: {}".format(e))
+        response_body = {
+            "status": "REJECTED",
+            "order_id": e.order_id,
+            "error": str(e),
+        }
+        self.publish_status("/order/status", response_body)
+        return
+      
+      print("{}: recieved order: {}".format(self.name, order.items))
+      order_id = order.ID
+      
+      # The broker redelivers orders that were in flight when we went down--never vend twice
+      if self.journal.seen(order_id):
+        print("Ignoring duplicate order {}".format(order_id))
+        if self.journal.status(order_id) == oj.SUCCESS:
+          response_body = {
+              "status": "SUCCESS",
+              "order_id": order_id,
+          }
+          self.publish_status("/order/status", response_body)
+        return
+      
+      short = self.inventory.shortages(order.items)
+      if len(short) > 0:
+        print("Rejected order: not enough stock for {}".format(short))
+        response_body = {
+            "status": "OUT_OF_STOCK",
+            "order_id": order_id,
+            "items": [i.key for i in short],
+        }
+        self.publish_status("/order/status", response_body)
+        return
+      
+      faults = self.lane_health.faults(order.items)
+      if len(faults) > 0:
+        print("Rejected order: lanes out of service for {}".format(faults))
+        response_body = {
+            "status": "LANE_FAULT",
+            "order_id": order_id,
+            "items": [i.key for i in faults],
+        }
+        self.publish_status("/order/status", response_body)
+        return
+      
+      self.journal.record_order(order_id, msg.payload.decode(), order.items)
+      self.queue.put(order)
     except KeyboardInterrupt:
       GPIO.cleanup()
+  
+  def on_restock(self, client, userdata, msg):
+    """Updates the lane counts from a restock message"""
+    try:
+      self.inventory.restock(json.loads(msg.payload))
+      print("Restocked lanes of {}: {}".format(self.name, self.inventory.stock))
+    except (ValueError, KeyError, TypeError, IndexError) as e:
+      print("Invalid restock message: {}".format(e))
+  
+  def on_lane_reset(self, client, userdata, msg):
+    """Puts lanes back in service once their jams have been cleared"""
+    try:
+      print("Lanes of {} back in service: {}".format(self.name, self.lane_health.clear(json.loads(msg.payload))))
+    except (ValueError, KeyError, TypeError, IndexError) as e:
+      print("Invalid lane reset message: {}".format(e))
 
-# The callback for when the client receives a CONNACK response from the server.
-def on_connect(client, userdata, flags, rc):
-    print("Connected with result code "+str(rc))
-    # Subscribing in on_connect() means that if we lose the connection and
-    # reconnect then subscriptions will be renewed.
-    client.subscribe(CLIENT_ID+"/order/vend")
-    connectStatus = "READY"
-    client.publish(CLIENT_ID+"/status", payload=json.dumps({"status": connectStatus}), qos=2)
- 
-# The callback for when a PUBLISH message is received from the server.
-def on_message(client, userdata, msg):
-    """Processes and dispenses order. Returns success or failure message upon completion
-    Published message consists of UUID for order and indication of success or failure
-    """
-    print(msg.topic+" "+str(msg.payload))
 
+# Every device on the I2C bus goes through one arbiter--motor steps first, the LCD when the bus is free.
+# It is shared by every cabinet, so the lanes of one never hold up the platform of another
+BUS = BusArbiter()
+
+# Connection to the broker--connects (and reconnects) in the background, status messages published
+# while offline are kept in an outbox and sent once the connection is back
+CONN = ConnectionManager(CLIENT_ID)
 
-client = mqtt.Client(client_id=CLIENT_ID, clean_session=False)
-client.username_pw_set("lenatest", "password")
-client.on_connect = on_connect
-client.on_message = on_message
+# Every cabinet driven from this Pi (see cabinets.py), each with its own queue and worker
+CABINETS = [Cabinet(config, BUS, CONN) for config in load_cabinets(CABINETS_FILE, CLIENT_ID)]
 
-client.will_set(CLIENT_ID+"/status", payload=json.dumps({"status": "LWT"}), qos=2)
+# Called after every (re)connect to the broker
+def on_connect():
+    connectStatus = "READY"
+    for cabinet in CABINETS:
+      cabinet.publish_status("/status", {"status": connectStatus}, qos=2)
 
-client.connect("ec2-3-87-77-241.compute-1.amazonaws.com", 1884, 60)
+# The broker keeps one will per connection, so a lost connection is reported under CLIENT_ID only
+CONN.will_set(CLIENT_ID+"/status", payload=json.dumps({"status": "LWT"}), qos=2)
+CONN.on_connect = on_connect
+for cabinet in CABINETS:
+  cabinet.subscribe()
+
+# Order progress on the LCD, drawn from its own thread (the machine runs without it if it is missing).
+# There is one LCD per Pi, it follows the first cabinet
+try:
+  CABINETS[0].machine.display = StatusDisplay(bus=BUS.device_bus('lcd', DISPLAY)).start()
+  CABINETS[0].machine.show_status("Ready")
+except (OSError, ImportError) as e:
+  print("No status display: {}".format(e))
 
-client.message_callback_add(CLIENT_ID+"/order/vend", on_order)
+for cabinet in CABINETS:
+  cabinet.start()
 
 # Blocking call that processes network traffic, dispatches callbacks and
-# handles reconnecting.
-# Other loop*() functions are available that give a threaded interface and a
-# manual interface.
+# handles reconnecting (including when the broker cannot be reached at startup).
 try:
-  client.loop_forever()
+  CONN.loop_forever()
 except KeyboardInterrupt:
   GPIO.cleanup()
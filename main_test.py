@@ -1,4 +1,32 @@
-from main import *
+import copy
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+import types
+from order import *
+from dispense_planner import plan_batch, BatchAttributor
+import order_journal as oj
+from order_watchdog import OrderWatchdog, OrderAborted
+from telemetry import TelemetryPublisher, decode_batch, downsample
+from platform_load import plan_loads, profile_index
+from pickup_monitor import PickupMonitor, RECEIVED, PENDING, CANCELLED
+from weight_sensor import WeightSensor_HX711
+from inventory import Inventory
+from calibration_store import save_calibration, load_calibration, migrate_pickle, CalibrationError
+from zero_tracker import ZeroTracker
+from calibration import CalibrationFit, calibrate_sensor, settle_time
+from weight_trace import TraceRecorder, ReplaySensor, read_trace
+from topology import Topology, TopologyError, TOPOLOGY_FILE
+from cabinets import load_cabinets
+from lane_model import LaneSpeedModel, MAX_STEP_HZ, MIN_STEP_HZ, MIN_DERATE
+from lane_health import JamDetector, DEFAULT_JAM_TIME, MIN_JAM_TIME, MAX_JAM_TIME
+from i2c_bus import BusArbiter, SimulatedBus, bus_share, MOTOR, DISPLAY
+from status_reporter import RGB1602
+from status_reporter.status_display import StatusDisplay
+
 
 # Create test items
 item1_info = {'UID':1, 'name':'Cheetos', 'quantity':'2', 'weight':99.2233,
@@ -23,4 +51,753 @@ try:
 except:
     print("***FAILED test for schedule order***")
     print("\tExpected [Cheetos, Hershey, Skittles] or [Hershey, Cheetos, Skittles]\n")
-    print("Actual: {}, {}, {}".format(order1.items, order2.items, order3.items))
\ No newline at end of file
+    print("Actual: {}, {}, {}".format(order1.items, order2.items, order3.items))
+
+# tests for parse_order ********************************
+bad_payloads = ['not json',
+                '{"orderList": {}}',
+                '{"orderID": "4", "orderList": {}}',
+                '{"orderID": "5", "orderList": {"0": {"quantity": 1, "weight": 45, "volume": 46.512, "row": 9, "column": 1}}}',
+                '{"orderID": "6", "orderList": {"0": {"quantity": "two", "weight": 45, "volume": 46.512, "row": 1, "column": 1}}}',
+                '{"orderID": "6", "orderList": {"0": {"quantity": "\u00b2", "weight": 45, "volume": 46.512, "row": 1, "column": 1}}}',
+                '{"orderID": "6", "orderList": {"0": {"quantity": 1, "weight": "inf", "volume": 46.512, "row": 1, "column": 1}}}',
+                '{"orderID": "6", "orderList": {"0": {"quantity": 1, "weight": 45, "volume": 1e999, "row": 1, "column": 1}}}',
+                '{"orderID": "6", "orderList": {"0": {"quantity": 1, "weight": NaN, "volume": 46.512, "row": 1, "column": 1}}}']
+try:
+    for payload in bad_payloads:
+        try:
+            parse_order(payload)
+            raise AssertionError(payload)
+        except OrderError:
+            pass
+    order7 = parse_order('{"orderID": "7", "orderList": {"0": ' + json.dumps(item1_info) + '}}')
+    assert (order7.items[0].quantity == 2 and order7.items[0].channel == 0)
+    print("***PASSED test for parse order***")
+except:
+    print("***FAILED test for parse order***")
+
+def make_item(weight, row, column, quantity=1, volume=10):
+    return Item({'quantity': quantity, 'weight': weight, 'volume': volume, 'row': row, 'column': column})
+
+# tests for weight attribution *************************
+# 100 g and 60 g lanes on different expanders: every combination has its own weight window
+heavy = make_item(100, 1, 1)
+light = make_item(60, 1, 2)
+try:
+    attributor = BatchAttributor([heavy, light])
+    assert (attributor.attribute(101, [heavy, light])[0] == [heavy])
+    assert (attributor.attribute(58, [heavy, light])[0] == [light])
+    assert (sorted(attributor.attribute(163, [heavy, light])[0], key=lambda i: i.weight) == [light, heavy])
+    assert (attributor.attribute(3, [heavy, light])[0] == [])            # Nothing fell
+    assert (attributor.attribute(400, [heavy, light])[0] is None)        # Fits no combination
+
+    # Partial drop: once the heavy item is down only the light one can still fall
+    assert (attributor.attribute(61, [light])[0] == [light])
+    assert (attributor.attribute(100, [light])[0] is None)
+
+    # Items whose windows overlap are never fired together, and cannot be told apart if they are
+    close = make_item(95, 1, 2)
+    assert (plan_batch([heavy, close], 1e5, 1e5) == [heavy])
+    fell, confidence = BatchAttributor([heavy, close]).attribute(97, [heavy, close])
+    assert (fell is None or confidence < 0.9)
+
+    # A lone item too light to clear the noise is judged against half its weight
+    crumb = make_item(3, 1, 1)
+    assert (BatchAttributor([crumb]).attribute(2.6, [crumb])[0] == [crumb])
+    assert (BatchAttributor([crumb]).attribute(0.8, [crumb])[0] == [])
+    print("***PASSED test for weight attribution***")
+except:
+    print("***FAILED test for weight attribution***")
+
+# tests for plan_batch *********************************
+try:
+    same_expander = make_item(61.5, 2, 1)
+    assert (plan_batch([heavy, light], 1e5, 1e5) == [heavy, light])
+    assert (plan_batch([heavy, same_expander], 1e5, 1e5) == [heavy])    # Lanes 0 and 1 share expander 0
+    assert (plan_batch([heavy, light], 1e5, 1e5, exclude={heavy.channel}) == [light])
+    assert (plan_batch([heavy, light], 120, 1e5) == [heavy])            # Both would overload the platform
+    assert (plan_batch([heavy, light], 1e5, 15) == [heavy])             # ...or overfill it
+    assert (len(plan_batch([make_item(3, 1, 1), make_item(2, 1, 2)], 1e5, 1e5)) == 1)  # Too light to pair
+    print("***PASSED test for plan batch***")
+except:
+    print("***FAILED test for plan batch***")
+
+# tests for journal recovery ***************************
+try:
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, oj.JOURNAL_FILE)
+        journal = oj.OrderJournal(db)
+        assert (journal.record_order("8", "{}", [heavy]))
+        assert (not journal.record_order("8", "{}", [heavy]))          # Redelivered by the broker
+        journal.set_status("8", oj.DISPENSING)
+        journal.item_dropped("8", heavy.key)
+        journal.commit()
+        journal.item_dropped("8", heavy.key)                            # Never committed before the "crash"
+        journal.conn.close()
+
+        journal = oj.OrderJournal(db)
+        assert (journal.seen("8") and journal.status("8") == oj.DISPENSING)
+        assert ([order_id for order_id, payload in journal.unfinished()] == ["8"])
+        assert (journal.progress("8")[str(heavy.key)] == (1, 1, 1))
+        journal.platform_cleared("8")
+        journal.set_status("8", oj.SUCCESS)
+        assert (journal.unfinished() == [] and journal.progress("8")[str(heavy.key)] == (1, 1, 0))
+        journal.close()
+    print("***PASSED test for journal recovery***")
+except:
+    print("***FAILED test for journal recovery***")
+
+# tests for order watchdog *****************************
+try:
+    stopped = []
+    watchdog = OrderWatchdog(budget=5.0, phases={'drop': 0.05}, abort_hooks=[lambda: stopped.append(True)]).start()
+    with watchdog.phase('move'):
+        pass
+    try:
+        with watchdog.phase('drop'):
+            time.sleep(0.3)
+            raise OSError("read cut short by the abort hook")
+        raise AssertionError("drop was not aborted")
+    except OrderAborted as e:
+        assert (e.phase == 'drop' and stopped == [True])
+    watchdog.stop()
+    assert ('move' in watchdog.report() and watchdog.report()['drop'] >= 0.05)
+    print("***PASSED test for order watchdog***")
+except:
+    print("***FAILED test for order watchdog***")
+# tests for plan_loads *********************************
+try:
+    five = make_item(100, 1, 1, quantity=5)
+    loads = plan_loads([five], 250, 1e5)
+    assert ([load[five] for load in loads] == [2, 2, 1])
+    # The first trip is the one already on the platform, kept (empty) when nothing more fits on it
+    assert ([load.get(five, 0) for load in plan_loads([five], 250, 1e5, used_weight=200)] == [0, 2, 2, 1])
+    assert ([load.get(five, 0) for load in plan_loads([five], 250, 100, used_volume=95)] == [0, 2, 2, 1])
+    assert ([load[five] for load in plan_loads([five], 250, 1e5, used_weight=100)] == [1, 2, 2])
+    assert (plan_loads([make_item(300, 1, 1)], 250, 1e5) is None)       # One unit is over capacity
+    assert (plan_loads([make_item(10, 1, 1, volume=500)], 1e5, 400) is None)
+    mixed = plan_loads([five, make_item(40, 1, 2, quantity=2)], 250, 1e5)
+    assert (sum([w.weight * n for load in mixed for w, n in load.items()]) == 580)
+    assert (all([sum([w.weight * n for w, n in load.items()]) <= 250 for load in mixed]))
+    print("***PASSED test for plan loads***")
+except:
+    print("***FAILED test for plan loads***")
+
+
+class RecordingClient:
+    """Local stand-in for the MQTT client that records every publish"""
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload, qos))
+
+# tests for telemetry **********************************
+try:
+    client = RecordingClient()
+    telemetry = TelemetryPublisher(client, "pi1/telemetry", batch_size=3, max_rate=0.001, burst=2)
+    for i in range(7):
+        telemetry.emit('drop', channel=i, added_weight=99.5)
+    assert (telemetry.flush() and telemetry.flush())
+    assert (not telemetry.flush())                                       # Token bucket is empty
+    assert (len(client.published) == 2 and len(telemetry.queue) == 1)
+    topic, payload, qos = client.published[0]
+    events = decode_batch(payload)
+    assert (topic == "pi1/telemetry" and qos == 0 and isinstance(payload, bytes))
+    assert ([e['channel'] for e in events] == [0, 1, 2] and events[0]['kind'] == 'drop')
+    assert (events[1]['added_weight'] == 99.5 and 't' in events[1])
+
+    # Full queue drops the oldest events instead of blocking
+    small = TelemetryPublisher(client, "pi1/telemetry", max_queue=5)
+    for i in range(8):
+        small.emit('move', row=i)
+    assert (small.dropped == 3 and small.queue[0]['row'] == 3)
+
+    # The background thread sends a partial batch after the flush interval, and the rest on stop
+    client = RecordingClient()
+    telemetry = TelemetryPublisher(client, "pi1/telemetry", batch_size=2, flush_interval=0.05,
+                                   max_rate=0.001, burst=1).start()
+    telemetry.emit('order', success=True)
+    time.sleep(0.3)
+    assert (len(client.published) == 1)
+    for i in range(4):
+        telemetry.emit('move', row=i)
+    telemetry.stop()
+    assert (sum([len(decode_batch(p)) for t, p, q in client.published]) == 5)
+    assert (len(downsample(list(range(1000)), 50)) == 50 and downsample([1, 2], 50) == [1, 2])
+    print("***PASSED test for telemetry***")
+except:
+    print("***FAILED test for telemetry***")
+
+# tests for connection manager *************************
+class FakeMQTTClient(RecordingClient):
+    """Local stand-in for a paho client: connects when told to and fails publishes while offline"""
+    def __init__(self):
+        super().__init__()
+        self.online = False
+        self.subscribed = []
+
+    def reconnect_delay_set(self, min_delay, max_delay):
+        pass
+
+    def message_callback_add(self, topic, callback):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        self.subscribed.append(topic)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if not self.online:
+            return types.SimpleNamespace(rc=connection.mqtt.MQTT_ERR_NO_CONN)
+        super().publish(topic, payload, qos)
+        return types.SimpleNamespace(rc=connection.mqtt.MQTT_ERR_SUCCESS)
+
+    def connect(self):
+        self.online = True
+        self.on_connect(self, None, {}, 0)
+
+    def drop(self):
+        self.online = False
+        self.on_disconnect(self, None, 1)
+
+try:
+    import connection
+except ImportError:
+    connection = None
+    print("***SKIPPED test for connection manager (paho-mqtt is not installed)***")
+
+if connection is not None:
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            outbox_path = os.path.join(tmp, connection.OUTBOX_FILE)
+            client = FakeMQTTClient()
+            conn = connection.ConnectionManager("pi1", outbox_path=outbox_path, client=client)
+            conn.subscribe("pi1/order/vend", lambda *args: None)
+
+            # Offline: status messages are queued, everything else is dropped
+            assert (not conn.publish("pi1/order/status", "1", qos=1, persist=True))
+            assert (not conn.publish("pi1/telemetry", "t"))
+            assert (not conn.publish("pi1/order/status", "2", qos=1, persist=True))
+            assert (len(conn.outbox) == 2)
+
+            # Queued messages survive a restart, a truncated last line (power cut) included
+            with open(outbox_path, "a") as f:
+                f.write('{"topic": "pi1/order/sta')
+            client = FakeMQTTClient()
+            conn = connection.ConnectionManager("pi1", outbox_path=outbox_path, client=client)
+            conn.subscribe("pi1/order/vend", lambda *args: None)
+            assert ([m['payload'] for m in conn.outbox.messages] == ["1", "2"])
+
+            # Reconnecting renews the subscriptions and replays the outbox in order before new messages
+            client.connect()
+            assert (client.subscribed == ["pi1/order/vend"])
+            assert (conn.publish("pi1/order/status", "3", qos=1, persist=True))
+            assert ([p for t, p, q in client.published] == ["1", "2", "3"] and client.published[0][2] == 1)
+            assert (len(conn.outbox) == 0 and len(connection.Outbox(outbox_path)) == 0)
+
+            client.drop()
+            assert (not conn.publish("pi1/order/status", "4", qos=1, persist=True) and len(conn.outbox) == 1)
+
+            # The outbox keeps only the newest messages once it reaches its limit
+            outbox = connection.Outbox(os.path.join(tmp, "small.jsonl"), limit=3)
+            for i in range(5):
+                outbox.add("pi1/order/status", str(i), 1)
+            assert ([m['payload'] for m in connection.Outbox(outbox.path, limit=3).messages] == ["2", "3", "4"])
+            assert (outbox.flush(lambda topic, payload, qos: payload != "3") == 1 and len(outbox) == 2)
+        print("***PASSED test for connection manager***")
+    except:
+        print("***FAILED test for connection manager***")
+
+# tests for status display *****************************
+class FakeSMBus:
+    """Local stand-in for smbus.SMBus that records every register write"""
+    def __init__(self):
+        self.writes = []
+
+    def write_byte_data(self, addr, reg, value):
+        self.writes.append((addr, reg, value))
+
+try:
+    bus = FakeSMBus()
+    display = StatusDisplay(bus=bus)
+    del bus.writes[:]
+    display.show("Order 12", "Row 1 - 0/3")
+    assert (display.render() == 32)                                     # Nothing known on the screen yet
+    chars = [v for a, r, v in bus.writes if a == RGB1602.LCD_ADDRESS and r == 0x40]
+    assert (bytes(chars).decode() == "Order 12".ljust(16) + "Row 1 - 0/3".ljust(16))
+
+    # Only the changed cells are written, after one cursor move per run of them
+    del bus.writes[:]
+    display.show("Order 12", "Row 2 - 1/3")
+    assert (display.render() == 2)
+    assert (bus.writes == [(RGB1602.LCD_ADDRESS, 0x80, 0xC4), (RGB1602.LCD_ADDRESS, 0x40, ord('2')),
+                           (RGB1602.LCD_ADDRESS, 0x80, 0xC8), (RGB1602.LCD_ADDRESS, 0x40, ord('1'))])
+
+    # Nothing changed, nothing written--the backlight is only set when its color changes
+    del bus.writes[:]
+    display.show("Order 12", "Row 2 - 1/3")
+    display.set_color(0, 255, 0)
+    display.render()
+    display.set_color(0, 255, 0)
+    assert (display.render() == 0 and len(bus.writes) == 3)
+    assert (display.cells_written == 34)
+    print("***PASSED test for status display***")
+except:
+    print("***FAILED test for status display***")
+
+# tests for i2c bus arbiter ****************************
+class CountingBus(SimulatedBus):
+    """Simulated bus that notes the most accesses it has seen at the same time"""
+    def __init__(self):
+        super().__init__()
+        self.inside = 0
+        self.most_inside = 0
+
+    def write_byte_data(self, addr, reg, value):
+        self.inside += 1
+        self.most_inside = max(self.most_inside, self.inside)
+        super().write_byte_data(addr, reg, value)
+        self.inside -= 1
+
+try:
+    # Transactions from several threads never overlap, and every one is counted for its device
+    arbiter = BusArbiter()
+    bus = CountingBus()
+    devices = [arbiter.device_bus(name, priority, bus) for name, priority in
+               (('pi1/platform', MOTOR), ('pi2/platform', MOTOR), ('lcd', DISPLAY))]
+    before = arbiter.snapshot()
+    threads = [threading.Thread(target=lambda d=d: [d.write_byte_data(0x61, 0x26, i) for i in range(40)])
+               for d in devices]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stats = arbiter.stats(before)
+    assert (bus.most_inside == 1 and len(bus.writes) == 120)
+    assert (sorted(stats) == ['lcd', 'pi1/platform', 'pi2/platform'])
+    assert (all([s['transactions'] == 40 and s['busy'] > 0 for s in stats.values()]))
+    assert (abs(sum([s['busy'] for s in stats.values()]) - sum(arbiter.busy_time.values())) < 1e-3)
+    assert (0 < arbiter.utilisation() <= 1)
+    assert (arbiter.stats(arbiter.snapshot()) == {})
+
+    # A lane reservation holds the LCD off until it ends, but not the platform steps
+    arbiter = BusArbiter()
+    order = []
+    lcd = threading.Thread(target=lambda: arbiter.device_bus('lcd', DISPLAY, bus).write_byte_data(0x3e, 0x40, 1)
+                           or order.append('lcd'))
+    with arbiter.reservation('pi2/lanes', bus_share(2500)):
+        lcd.start()
+        arbiter.device_bus('pi1/platform', MOTOR, bus).write_byte_data(0x61, 0x26, 1)
+        order.append('platform')
+        time.sleep(0.1)
+        order.append('lanes done')
+    lcd.join()
+    assert (order == ['platform', 'lanes done', 'lcd'])
+
+    # A second reservation waits until the bus has room for both
+    order = []
+    def other_cabinet():
+        with arbiter.reservation('pi3/lanes', 0.5):
+            order.append('pi3')
+    lanes = threading.Thread(target=other_cabinet)
+    with arbiter.reservation('pi2/lanes', 0.5):
+        lanes.start()
+        time.sleep(0.1)
+        order.append('pi2 done')
+    lanes.join()
+    assert (order == ['pi2 done', 'pi3'])
+    assert (arbiter.stats()['pi2/lanes']['transactions'] == 2 and arbiter.stats()['pi3/lanes']['wait'] >= 0.05)
+    print("***PASSED test for i2c bus arbiter***")
+except:
+    print("***FAILED test for i2c bus arbiter***")
+
+# tests for pickup monitor *****************************
+class ScriptedScale:
+    """Sensor stand-in that returns scripted readings (None for an untrustworthy one, OSError to fail)"""
+    def __init__(self, readings, last=None):
+        self.readings = list(readings)
+        self.last = last
+
+    def read_grams(self, num_samples=16, verbose=False):
+        reading = self.readings.pop(0) if self.readings else self.last
+        if isinstance(reading, Exception):
+            raise reading
+        return reading
+
+try:
+    events = []
+    monitor = PickupMonitor(ScriptedScale([300, 300, 240, 0]), 250, poll_interval=0.01,
+                            on_partial=lambda removed: events.append(('partial', removed)),
+                            on_complete=lambda state, removed: events.append((state, removed))).start()
+    assert (monitor.wait(2) == RECEIVED and events == [('partial', 60), (RECEIVED, 300)])
+
+    # Readings with no valid samples (saturated or stuck sensor) are neither a pickup nor a reason to stop
+    timeouts = []
+    monitor = PickupMonitor(ScriptedScale([300], last=None), 250, timeout=0.05, poll_interval=0.01,
+                            on_timeout=timeouts.append).start()
+    assert (monitor.wait(0.3) == PENDING and monitor.removed == 0 and timeouts == [0])
+    assert (monitor.bad_reads > 5)
+    monitor.cancel()
+    assert (monitor.wait(1) == CANCELLED)
+
+    # A failed starting read is taken from the first good reading instead of escaping start()
+    monitor = PickupMonitor(ScriptedScale([OSError("HX711 had no data"), None, 310, 310, 20]), 250,
+                            poll_interval=0.01).start()
+    assert (monitor.wait(2) == RECEIVED and monitor.baseline == 310 and monitor.samples == [310, 310, 20])
+
+    # The sensor itself refuses to vouch for a reading with every sample out of range or identical
+    fake_chip = types.SimpleNamespace(OFFSET=0, SCALE=1, MIN_CAP=0, MAX_CAP=15000)
+    fake_chip.read = iter([20000, 20001, 20002, 20003, 7, 7, 7, 7, 100, 102, 98, 100]).__next__
+    assert (WeightSensor_HX711.read_grams(fake_chip, 4) is None)
+    assert (WeightSensor_HX711.read_grams(fake_chip, 4) is None)
+    assert (WeightSensor_HX711.read_grams(fake_chip, 4) == 100)
+    print("***PASSED test for pickup monitor***")
+except:
+    print("***FAILED test for pickup monitor***")
+
+# tests for lane speed model ***************************
+try:
+    with tempfile.TemporaryDirectory() as tmp:
+        model = LaneSpeedModel(os.path.join(tmp, "lane_model.json"))
+        assert (model.step_hz(0, 10) > model.step_hz(0, 10, count=50) >= MIN_STEP_HZ)
+        assert (model.step_hz(0, 10, volume=5000) < model.step_hz(0, 10) <= MAX_STEP_HZ)
+        model.record(0, 2.0)
+        model.record(1, 4.0, stalls=2)                                  # Needed two extra turns
+        assert (model.derate(0) == 1.0 and abs(model.derate(1) - 0.64) < 1e-9)
+        assert (model.step_hz(1, 10) < model.step_hz(0, 10) and model.lane_accel(1) < model.lane_accel(0))
+        for i in range(20):
+            model.record_stall(2)
+        assert (model.derate(2) == MIN_DERATE)
+        for i in range(5):
+            model.record(1, 2.0)                                        # Clean drops win the speed back
+        assert (abs(model.derate(1) - 0.74) < 1e-9 and model.average_time(1) == 14.0 / 6)
+        assert (model.average_time(3) is None)
+        model.save()
+        assert (LaneSpeedModel(model.path).report() == model.report())
+    print("***PASSED test for lane speed model***")
+except:
+    print("***FAILED test for lane speed model***")
+
+# tests for jam detector *******************************
+try:
+    model = LaneSpeedModel(os.path.join(tempfile.mkdtemp(), "lane_model.json"))
+    model.record(0, 2.0)
+    model.record(1, 0.5)
+    model.record(2, 60.0)
+    detector = JamDetector(model, first_rotations=1, max_extra=2)
+    assert (detector.budget(0) == 5.0 and detector.budget(1) == MIN_JAM_TIME)
+    assert (detector.budget(2) == MAX_JAM_TIME and detector.budget(3) == DEFAULT_JAM_TIME)
+    detector.start([0, 1, 3])
+    detector.rotated([0, 1, 3], 1, 3.0)
+    assert ([detector.jammed(ch) for ch in [0, 1, 3]] == [None, None, None])
+    # Lanes fired on their own are charged their turns; the lanes waiting meanwhile are not
+    for i in range(4):
+        detector.rotated([1], 0.25, 0.5)
+    assert (detector.elapsed[0] == 3.0 and detector.jammed(0) is None)
+    assert (detector.elapsed[1] == 5.0 and detector.jammed(1) == "timeout")
+    detector.rotated([3], 2, 1.0)
+    assert (detector.jammed(3) == "rotations")
+    print("***PASSED test for jam detector***")
+except:
+    print("***FAILED test for jam detector***")
+
+# tests for inventory **********************************
+try:
+    with tempfile.TemporaryDirectory() as tmp:
+        low = []
+        inventory = Inventory(os.path.join(tmp, "inventory.json"), low_stock=1,
+                              on_low_stock=lambda ch, count: low.append((ch, count)))
+        assert (inventory.shortages(order1.items) == [])                 # Untracked lanes are always available
+        inventory.restock({'lanes': [{'row': 1, 'column': 1, 'count': 1}, {'channel': Hershey.channel, 'count': 3}]})
+        assert (inventory.shortages(order1.items) == [Cheetos])         # Two Cheetos ordered, one left
+        inventory.restock({'add': True, 'lanes': [{'row': 1, 'column': 1, 'count': 2}]})
+        assert (inventory.count(Cheetos.channel) == 3 and inventory.shortages(order1.items) == [])
+        inventory.remove(Cheetos.channel, 2)
+        assert (low == [(Cheetos.channel, 1)])
+        for bad in [{'channel': 99, 'count': 1}, {'row': 9, 'column': 9, 'count': 1}, {'channel': 0, 'count': -1}]:
+            try:
+                inventory.restock({'lanes': [{'channel': Hershey.channel, 'count': 7}, bad]})
+                assert (False)
+            except ValueError:
+                pass
+        assert (inventory.count(Hershey.channel) == 3)                  # Nothing applied from a bad message
+        assert (Inventory(inventory.path).stock == {Cheetos.channel: 1, Hershey.channel: 3})
+    print("***PASSED test for inventory***")
+except:
+    print("***FAILED test for inventory***")
+
+# tests for calibration store **************************
+try:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "wsens_calibration.json")
+        chip = types.SimpleNamespace(OFFSET=8123.5, SCALE=-412.25, GAIN=3, DOUT=5, PD_SCK=6, MAX_CAP=15000, MIN_CAP=0)
+        saved = save_calibration(chip, path, quality={'r2': 0.9999})
+        record = load_calibration(path)
+        assert (record == saved and record['gain'] == 64 and record['scale'] == -412.25)
+
+        # Corrupt or foreign files are refused instead of being read as a calibration
+        for text in [json.dumps(saved)[:40], "[1, 2]", json.dumps(dict(saved, version=2)),
+                     json.dumps(dict(saved, gain=100)), json.dumps(dict(saved, scale=0)),
+                     json.dumps({k: v for k, v in saved.items() if k != 'offset'})]:
+            with open(path, "w") as f:
+                f.write(text)
+            try:
+                load_calibration(path)
+                assert (False)
+            except CalibrationError:
+                pass
+
+        # A calibration pickled by older versions is converted; a truncated pickle is refused
+        legacy = os.path.join(tmp, "wsens_state.pickle")
+        with open(legacy, "wb") as f:
+            pickle.dump(chip, f)
+        assert (migrate_pickle(legacy, path)['offset'] == 8123.5 and load_calibration(path)['dout'] == 5)
+        with open(legacy, "rb") as f:
+            data = f.read()
+        with open(legacy, "wb") as f:
+            f.write(data[:len(data) // 2])
+        try:
+            migrate_pickle(legacy, path)
+            assert (False)
+        except CalibrationError:
+            pass
+        assert (migrate_pickle(os.path.join(tmp, "missing.pickle"), path) is None)
+    print("***PASSED test for calibration store***")
+except:
+    print("***FAILED test for calibration store***")
+
+
+class DriftingScale:
+    """Local stand-in for WeightSensor_HX711 whose empty-platform reading drifts a raw unit per read"""
+    def __init__(self, offset=1000.0, scale=10.0):
+        self.offset = offset
+        self.scale = scale
+        self.raw = offset
+        self.reads = 0
+
+    def get_offset(self):
+        return self.offset
+
+    def set_offset(self, offset):
+        self.offset = offset
+
+    def get_scale(self):
+        return self.scale
+
+    def read_average(self, times=3):
+        self.reads += 1
+        self.raw += 1
+        return self.raw
+
+# tests for zero tracker *******************************
+try:
+    drifts = []
+    scale = DriftingScale()
+    tracker = ZeroTracker(scale, alpha=0.5, drift_limit=1.0, on_drift=drifts.append)
+    assert (tracker.update(1010) == 1.0 and scale.offset == 1005)     # Half of a 1 g error taken in
+    assert (tracker.update(1050) == 4.5 and scale.offset == 1005)     # A load, not drift
+    assert (tracker.update(1012, last_grams=0.0) == 0.7 and tracker.skipped == 2)  # Still settling
+    tracker.update(1015)
+    assert (drifts == [] and tracker.drift == 1.0)
+    tracker.update(1020)
+    assert (drifts == [tracker.drift] and tracker.drift == 1.5)
+    tracker.update(1025)
+    assert (len(drifts) == 1)                                         # Reported only once
+
+    # Nothing is read or corrected while paused
+    scale = DriftingScale()
+    tracker = ZeroTracker(scale, interval=0.01).start()
+    time.sleep(0.1)
+    assert (scale.reads == 0 and tracker.drift == 0)
+    tracker.resume()
+    time.sleep(0.2)
+    tracker.pause()
+    assert (tracker.updates > 5 and scale.offset > 1000)
+    offset, reads = (scale.offset, scale.reads)
+    time.sleep(0.1)
+    assert (scale.offset == offset and scale.reads <= reads + 1)
+    tracker.stop()
+    print("***PASSED test for zero tracker***")
+except:
+    print("***FAILED test for zero tracker***")
+
+
+class CalibrationRig:
+    """Local stand-in for a load cell on a test rig: raw = 8000 - 420 * grams, with alternating noise"""
+    def __init__(self):
+        self.grams = 0
+        self.sign = 1
+        self.OFFSET = 0
+        self.SCALE = 1
+
+    def place(self, grams):
+        self.grams = grams
+
+    def read(self):
+        self.sign = -self.sign
+        return 8000 - 420 * self.grams + 30 * self.sign
+
+    def set_offset(self, offset):
+        self.OFFSET = offset
+
+    def set_scale(self, scale):
+        self.SCALE = scale
+
+# tests for calibration ********************************
+try:
+    rig = CalibrationRig()
+    fit = calibrate_sensor(rig, [100, 500, 1000], rig.place)
+    assert ([g for g, r in fit.points] == [0, 100, 500, 1000])
+    assert (abs(rig.OFFSET - 8000) < 1e-6 and abs(rig.SCALE + 420) < 1e-9)
+    assert (fit.quality['max_residual'] < 1e-6 and rig.quality['points'] == 4)
+
+    # A reading off the line shows up in the residuals
+    fit = CalibrationFit([(0, 8000), (100, 8000 - 42000), (200, 8000 - 84000 + 840)])
+    assert (fit.quality['max_residual'] > 0.5 and abs(fit.grams(fit.offset)) < 1e-9)
+    try:
+        CalibrationFit([(100, 50000), (100, 50010)])
+        assert (False)
+    except ValueError:
+        pass
+    assert (settle_time(100, [(0.0, 60), (0.1, 101.5), (0.2, 99.2), (0.3, 100.4)]) == 0.2)
+    assert (settle_time(100, [(0.0, 60), (0.1, 90)]) is None)
+    print("***PASSED test for calibration***")
+except:
+    print("***FAILED test for calibration***")
+
+# tests for weight trace *******************************
+try:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "order.wtr")
+        chip = types.SimpleNamespace(get_offset=lambda: 100, get_scale=lambda: 2, MAX_CAP=15000, MIN_CAP=0)
+        recorder = TraceRecorder(path, chip, order_id="9")
+        for raw in [100, 102, 98]:
+            recorder.sample(raw)
+        recorder.annotate('lanes', channels=[0, 3])
+        for raw in [300, 302, 298, 300]:
+            recorder.sample(raw)
+        recorder.close()
+
+        header, records = read_trace(path)
+        assert (header['order_id'] == "9" and header['offset'] == 100 and header['scale'] == 2)
+        assert ([r for t, r in records] == [100, 102, 98, {'kind': 'lanes', 'channels': [0, 3]}, 300, 302, 298, 300])
+        assert ([t for t, r in records] == sorted([t for t, r in records]))
+
+        # The replay reads as the calibrated sensor did and passes on the annotations
+        fired = []
+        sensor = ReplaySensor(path, on_annotation=fired.append)
+        assert (sensor.read_average(3) == 100 and fired == [] and sensor.OFFSET == 100)
+        assert (sensor.get_grams(4, verbose=False) == 100 and fired == [{'kind': 'lanes', 'channels': [0, 3]}])
+        try:
+            sensor.read()
+            assert (False)
+        except EOFError:
+            pass
+
+        # A trace cut short by a crash is read up to its last whole record
+        with open(path, "rb") as f:
+            data = f.read()
+        for cut, whole in [(5, records[:-1]), (13 * 2 + 3, records[:-3])]:
+            with open(path, "wb") as f:
+                f.write(data[:len(data) - cut])
+            assert (read_trace(path)[1] == whole)
+        with open(path, "wb") as f:
+            f.write(data[:len(data) - 13 * 4 - 5])                      # Inside the annotation
+        assert (read_trace(path)[1] == records[:3])
+    print("***PASSED test for weight trace***")
+except:
+    print("***FAILED test for weight trace***")
+
+# tests for platform speed profiles ********************
+try:
+    limits = [0, 500, 2000, 14000]                                      # As in PLAT_SPEED_PROFILES
+    assert ([profile_index(limits, load) for load in [0, 0.1, 500, 500.1, 2000, 14000, 20000]] == [0, 1, 1, 2, 2, 3, 3])
+    assert (profile_index(limits, 5, empty_tol=5) == 0 and profile_index(limits, 5.1, empty_tol=5) == 1)
+    assert (profile_index(limits, -3, empty_tol=5) == 0)               # Zero drift below empty
+    print("***PASSED test for platform speed profiles***")
+except:
+    print("***FAILED test for platform speed profiles***")
+
+# tests for topology ***********************************
+try:
+    with open(TOPOLOGY_FILE, "r") as f:
+        info = json.load(f)
+    topology = Topology(info)
+    assert (topology.num_lanes == 6 and topology.channels[(2, 2)] == 4 and topology.parallel_groups[0] == [0, 3])
+    assert (topology.native_tables()[2][4] == [1, 4, 5, 6, 7])
+
+    def broken(change):
+        bad = copy.deepcopy(info)
+        change(bad)
+        try:
+            Topology(bad)
+            return False
+        except TopologyError:
+            return True
+
+    assert (broken(lambda t: t.update(version=2)))
+    assert (broken(lambda t: t['lanes'][1].pop('pins')))
+    assert (broken(lambda t: t['lanes'][1].update(channel=7)))                  # Gap in the channels
+    assert (broken(lambda t: t['lanes'][1].update(row=4)))                      # Row without a position
+    assert (broken(lambda t: t['lanes'][1].update(row=1)))                      # Two lanes at row 1 column 1
+    assert (broken(lambda t: t['lanes'][4].update(column=3)))                   # Gap in the columns of row 2
+    assert (broken(lambda t: t['lanes'][1].update(expander=2)))
+    assert (broken(lambda t: t['lanes'][1].update(pins=[4, 5, 6])))
+    assert (broken(lambda t: t['lanes'][1].update(pins=[4, 5, 6, 16])))
+    assert (broken(lambda t: t['lanes'][1].update(pins=[3, 4, 5, 6])))          # Shares pin 3 with lane 0
+    assert (broken(lambda t: t['lanes'][1].update(expander="0")))
+    assert (broken(lambda t: t['lanes'][1].update(pins=[4, 5, 6, "7"])))
+    assert (broken(lambda t: t['lanes'][1].update(pins=[4, 5, 6, 7.0])))
+    assert (broken(lambda t: t['lanes'][4].update(column="2")))
+    assert (broken(lambda t: t['rows'][0].update(position="high")))
+    print("***PASSED test for topology***")
+except:
+    print("***FAILED test for topology***")
+
+# tests for cabinets ***********************************
+try:
+    with tempfile.TemporaryDirectory() as tmp:
+        second = copy.deepcopy(info)
+        second['expanders'] = [{'address': 34, 'pin_base': 300}, {'address': 35, 'pin_base': 400}]
+        with open(os.path.join(tmp, "topology_pi2.json"), "w") as f:
+            json.dump(second, f)
+        path = os.path.join(tmp, "cabinets.json")
+
+        def cabinets(change=None):
+            bank = [{'name': "pi1", 'topology': TOPOLOGY_FILE, 'state_dir': ".",
+                     'platform': {'address': 97, 'channel': 0}, 'hx711': {'dout': 17, 'sck': 18}},
+                    {'name': "pi2", 'topology': "topology_pi2.json", 'state_dir': "pi2",
+                     'platform': {'address': 97, 'channel': 1}, 'hx711': {'dout': 22, 'sck': 23}}]
+            if change is not None:
+                change(bank[1])
+            with open(path, "w") as f:
+                json.dump({'version': 1, 'cabinets': bank}, f)
+            return load_cabinets(path)
+
+        pi1, pi2 = cabinets()
+        assert (pi2.topology.expanders == [(34, 300), (35, 400)] and pi2.path("inventory.json") == os.path.join("pi2", "inventory.json"))
+        assert (pi2.device('platform') == "pi2/platform")
+
+        def shared(change):
+            try:
+                cabinets(change)
+                return False
+            except TopologyError:
+                return True
+
+        assert (shared(lambda c: c.update(topology=TOPOLOGY_FILE)))            # Same expander addresses
+        assert (shared(lambda c: c['hx711'].update(sck=17)))
+        assert (shared(lambda c: c['platform'].update(channel=0)))
+        assert (shared(lambda c: c['platform'].update(channel=2)))
+        assert (shared(lambda c: c.update(name="pi1", state_dir="pi2")))
+        assert (shared(lambda c: c.update(state_dir="./")))
+        assert (shared(lambda c: c.pop('name')))
+        second['expanders'][0]['pin_base'] = 110                                # Overlaps 100..115 of pi1
+        with open(os.path.join(tmp, "topology_pi2.json"), "w") as f:
+            json.dump(second, f)
+        assert (shared(None))
+
+        assert ([c.name for c in load_cabinets(os.path.join(tmp, "missing.json"), "solo")] == ["solo"])
+    print("***PASSED test for cabinets***")
+except:
+    print("***FAILED test for cabinets***")
@@ -0,0 +1,279 @@
+"""
+Weight sampling that keeps working while motors are stepping. Movers (the platform stepper and the
+lane rotations) report when they start and stop and at what step rate. A background thread reads
+the HX711 continuously and tags every sample taken during motion. Samples are low-pass filtered
+by a critically damped filter (it never overshoots a step, so a settled reading is the weight and not
+a transient above it), with a notch at the frequency the stepper vibration aliases to at the HX711
+sample rate. estimate() gives a weight from the filtered samples, and whether it has been flat for two
+windows in a row and so is steady enough to trust while the machine is still moving.
+"""
+
+import collections
+import math
+import threading
+import time
+
+LOWPASS_HZ = 1.0                # Cutoff of the low-pass filter on the weight samples
+NOTCH_Q = 2.0                   # Quality factor of the step-frequency notch (higher is narrower)
+SETTLE_SAMPLES = 4              # Filtered samples skipped after a window starts or the motion changes
+MIN_SAMPLES = 4                 # Filtered samples each of the two windows of a valid estimate needs
+WINDOW_SAMPLES = 8              # Latest filtered samples an estimate is taken over
+MAX_SPREAD = 0.5                # Grams the filtered samples of a valid estimate may spread (std. dev.), and
+                                # the most its mean may differ from the window before it
+SPIKE_GRAMS = 2000              # Samples further than this from the median of the latest raw samples are glitches
+SPIKE_WINDOW = 5                # Raw samples the glitch median is taken over--a real step passes after 3 samples
+BUFFER_SAMPLES = 1024           # Samples kept for estimates
+MAX_READ_ERRORS = 5             # HX711 read errors in a row after which sampling stops (the sensor is dead)
+
+
+def alias_frequency(freq:float, sample_hz:float) -> float:
+    """Frequency that a vibration at freq shows up at when sampled at sample_hz"""
+    freq = freq % sample_hz
+    return sample_hz - freq if freq > sample_hz / 2 else freq
+
+
+class Biquad:
+    """Second-order IIR filter (transposed direct form II)"""
+
+    def __init__(self, b0:float, b1:float, b2:float, a1:float, a2:float):
+        self.b0, self.b1, self.b2, self.a1, self.a2 = b0, b1, b2, a1, a2
+        self.z1 = 0.0
+        self.z2 = 0.0
+
+    @classmethod
+    def critical(cls, cutoff:float, sample_hz:float):
+        """Critically damped low-pass (two identical one-pole stages) with its -3 dB point at cutoff"""
+        # Each stage sits higher so that the pair is -3 dB at cutoff (1 / sqrt(2^(1/2) - 1))
+        p = math.exp(-2 * math.pi * cutoff * 1.5538 / sample_hz)
+        return cls((1 - p) ** 2, 0.0, 0.0, -2 * p, p * p)
+
+    @classmethod
+    def notch(cls, freq:float, sample_hz:float, q:float=NOTCH_Q):
+        w = 2 * math.pi * freq / sample_hz
+        alpha = math.sin(w) / (2 * q)
+        a0 = 1 + alpha
+        return cls(1 / a0, -2 * math.cos(w) / a0, 1 / a0, -2 * math.cos(w) / a0, (1 - alpha) / a0)
+
+    def reset(self, x:float):
+        """Sets the state as if x had been the input forever, so there is no start-up transient"""
+        y = x * (self.b0 + self.b1 + self.b2) / (1 + self.a1 + self.a2)
+        self.z2 = self.b2 * x - self.a2 * y
+        self.z1 = self.b1 * x - self.a1 * y + self.z2
+
+    def process(self, x:float) -> float:
+        y = self.b0 * x + self.z1
+        self.z1 = self.b1 * x - self.a1 * y + self.z2
+        self.z2 = self.b2 * x - self.a2 * y
+        return y
+
+
+def _mean_spread(values:list):
+    mean = sum(values) / len(values)
+    return mean, math.sqrt(sum([(v - mean) ** 2 for v in values]) / len(values))
+
+
+class Motion:
+    """Which motors are stepping right now, and at what step rates"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sources = {}               # Source name -> step rate (Hz)
+        self.changed = 0.0              # Monotonic time motion last started or stopped
+
+    def begin(self, source:str, step_hz:float):
+        with self.lock:
+            self.sources[source] = step_hz
+            self.changed = time.monotonic()
+
+    def end(self, source:str):
+        with self.lock:
+            self.sources.pop(source, None)
+            self.changed = time.monotonic()
+
+    def during(self, source:str, step_hz:float):
+        """Context manager marking a source as moving"""
+        return _During(self, source, step_hz)
+
+    @property
+    def moving(self) -> bool:
+        return len(self.sources) > 0
+
+    def step_rates(self) -> list:
+        with self.lock:
+            return list(self.sources.values())
+
+
+class _During:
+    def __init__(self, motion:Motion, source:str, step_hz:float):
+        self.motion = motion
+        self.source = source
+        self.step_hz = step_hz
+
+    def __enter__(self):
+        self.motion.begin(self.source, self.step_hz)
+        return self
+
+    def __exit__(self, *exc):
+        self.motion.end(self.source)
+        return False
+
+
+class MotionSampler:
+    """Reads the weight sensor continuously from a background thread and filters the samples"""
+
+    def __init__(self, sensor, motion:Motion, lowpass_hz:float=LOWPASS_HZ, max_spread:float=MAX_SPREAD):
+        self.sensor = sensor
+        self.motion = motion
+        self.lowpass_hz = lowpass_hz
+        self.max_spread = max_spread
+
+        # (time, grams, filtered grams, moving) of the latest samples
+        self.samples = collections.deque(maxlen=BUFFER_SAMPLES)
+        self.raw = collections.deque(maxlen=SPIKE_WINDOW)  # Latest raw samples, glitches included
+        self.cond = threading.Condition()
+        self.sample_hz = None           # Measured HX711 sample rate
+        self.lowpass = None
+        self.notches = {}               # Step rate -> notch filter for the current motion
+        self.dropped = 0                # Samples dropped as read glitches
+        self.read_errors = 0            # HX711 reads that failed (timed out) and were skipped
+        self.stopping = False
+        self.thread = None
+
+    def start(self):
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping = True
+        if self.thread is not None:
+            self.thread.join()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive() and not self.stopping
+
+    def add_sample(self, t:float, grams:float):
+        """Filters and stores one sample taken at monotonic time t"""
+        with self.cond:
+            last_t = self.samples[-1][0] if self.samples else None
+            if last_t is not None and t > last_t:
+                hz = 1 / (t - last_t)
+                self.sample_hz = hz if self.sample_hz is None else 0.9 * self.sample_hz + 0.1 * hz
+
+            # Glitches are judged against the raw samples around them, never the filtered weight (which
+            # lags a real step), so a heavy item is only held back until most of the window has seen it
+            self.raw.append(grams)
+            median = sorted(self.raw)[len(self.raw) // 2]
+            if abs(grams - median) > SPIKE_GRAMS:
+                self.dropped += 1
+                return
+
+            if self.lowpass is None:
+                if self.sample_hz is None:
+                    self.samples.append((t, grams, grams, self.motion.moving))
+                    return
+                self.lowpass = Biquad.critical(min(self.lowpass_hz, 0.45 * self.sample_hz), self.sample_hz)
+                self.lowpass.reset(self.samples[-1][2])
+
+            filtered = grams
+            for notch in self._notches(grams):
+                filtered = notch.process(filtered)
+            filtered = self.lowpass.process(filtered)
+
+            self.samples.append((t, grams, filtered, self.motion.moving))
+            self.cond.notify_all()
+
+    def estimate(self, since:float=None):
+        """
+        Returns (grams, valid) from the latest filtered samples taken since the given monotonic time
+        (any buffered samples if not given). The estimate is valid once two consecutive windows of
+        samples past the filter transient each agree to within max_spread and their means agree too,
+        whether or not anything is moving--a weight still creeping towards its final value is not.
+        """
+        since = since if since is not None else 0.0
+        with self.cond:
+            window = [s for s in self.samples if s[0] >= since]
+
+        # Skip the filter transient after the window starts and after motion starts or stops
+        start = max(since, self.motion.changed)
+        settled = [s[2] for s in window if s[0] >= start][SETTLE_SAMPLES:][-2 * WINDOW_SAMPLES:]
+
+        if len(window) == 0:
+            return None, False
+        if len(settled) < 2 * MIN_SAMPLES:
+            return window[-1][2], False
+
+        half = len(settled) // 2
+        mean, spread = _mean_spread(settled[half:])
+        prev_mean, prev_spread = _mean_spread(settled[:half])
+        flat = abs(mean - prev_mean) <= self.max_spread
+        return mean, flat and spread <= self.max_spread and prev_spread <= self.max_spread
+
+    def live(self, since:float=0.0) -> bool:
+        """
+        Whether the sensor is still being sampled and its readings since the given time vary. A working
+        HX711 always shows a few counts of noise, so readings that never change come from a dead chip.
+        """
+        with self.cond:
+            grams = set([s[1] for s in self.samples if s[0] >= since])
+        return self.running and len(grams) > 1
+
+    def moving_fraction(self, since:float=0.0) -> float:
+        """Fraction of the samples since the given time that were taken while something was moving"""
+        with self.cond:
+            tags = [s[3] for s in self.samples if s[0] >= since]
+        return sum(tags) / len(tags) if tags else 0.0
+
+    def wait_for_estimate(self, since:float, timeout:float):
+        """Waits up to timeout seconds for a valid estimate from samples taken since the given time"""
+        deadline = time.monotonic() + timeout
+        while True:
+            grams, valid = self.estimate(since)
+            remaining = deadline - time.monotonic()
+            if valid or remaining <= 0:
+                return grams, valid
+            with self.cond:
+                self.cond.wait(remaining)
+
+    def wait_for_sample(self, timeout:float):
+        """Blocks until the next sample has been filtered (or the timeout is up)"""
+        with self.cond:
+            self.cond.wait(max(timeout, 0))
+
+    def _notches(self, grams:float) -> list:
+        # Notches follow the step rates of whatever is moving (cleared once everything stops)
+        rates = self.motion.step_rates()
+        for hz in list(self.notches):
+            if hz not in rates:
+                del self.notches[hz]
+
+        for hz in rates:
+            if hz in self.notches:
+                continue
+            freq = alias_frequency(hz, self.sample_hz)
+            # Vibration that aliases next to DC or Nyquist cannot be notched without hurting the weight
+            if self.lowpass_hz < freq < 0.45 * self.sample_hz:
+                self.notches[hz] = Biquad.notch(freq, self.sample_hz)
+                self.notches[hz].reset(grams)
+        return list(self.notches.values())
+
+    def _run(self):
+        failures = 0
+        while not self.stopping:
+            try:
+                raw = self.sensor.read()
+            except OSError as e:
+                # A single timeout is skipped like a glitch; sampling only ends when the read was aborted
+                # (the order is being stopped) or the chip has stayed silent for MAX_READ_ERRORS reads
+                self.read_errors += 1
+                failures += 1
+                aborting = getattr(self.sensor, 'aborting', None)
+                if (aborting is not None and aborting.is_set()) or failures >= MAX_READ_ERRORS:
+                    print("Weight sampling stopped: {}".format(e))
+                    return
+                continue
+            failures = 0
+            grams = (raw - self.sensor.get_offset()) / self.sensor.get_scale()
+            self.add_sample(time.monotonic(), grams)
@@ -4,40 +4,74 @@
    steps per rotation (STEPS_PER_ROT) depending on the stride angle of the motor.
 */
 
+#include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <cmath>
+#include <condition_variable>
 #include <cstdint>
 #include <iostream>
+#include <map>
+#include <stdexcept>
+#include <mutex>
 #include <string>
 #include <thread>
 #include <vector>
 
+#include <time.h>
+
 #include <mcp23017.h>
 #include <wiringPi.h>
 
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
 
-// Address constants
+// Default topology (the prototype cabinet)--the machine passes its own tables from topology.json
+// to the constructor instead, so these are only used by ItemLaneSystem()
 #define MCP0_ADDR       (0x20)
 #define MCP1_ADDR       (0x21)
 
 #define PIN_BASE0       (100)
 #define PIN_BASE1       (200)
 
-// Pin, step sequence, and multithreading constants
-#define PINS_PER_MCP    (12)
-#define PINS_PER_MOTOR  (4)
+#define NUM_MCPS        (2)
 #define MOTORS_PER_MCP  (3)
 
-#define HALF_STEP_LEN   (8)
+// Pin and step sequence constants
+#define PINS_PER_MCP    (16)
+#define PINS_PER_MOTOR  (4)
 
-#define MAX_WORKERS     (3)
+#define HALF_STEP_LEN   (8)
 
 // Rotation constants for determining steps needed for a full rotation
 #define STEPS_PER_ROT   (400)
-#define MIN_DELAY       (1)
-#define MAX_DELAY       (100)
+#define MIN_DELAY_US    (700)
+#define MAX_DELAY_US    (100000)
+
+// Step rate limits (steps/s) for rotations given as rates--the upper limit is what the coils and
+// the I2C writes of one step can keep up with, get_last_move() reports what was actually achieved
+#define MIN_STEP_RATE   (10.0f)
+#define MAX_STEP_RATE   (2500.0f)
+
+// Ramp constants--every move starts (and ends) at the pull-in delay and accelerates towards the
+// cruise delay given by the speed, so the fastest speeds no longer need to be reached from a stop
+#define START_DELAY_US  (1500)
+#define DEFAULT_ACCEL   (4000.0f)      // Steps per second^2
+
+// Power management constants--how often the idle thread checks for lanes to de-energise and the
+// default amount of time a lane is held after a move under the HOLD_IDLE policy
+#define IDLE_POLL_MS    (50)
+#define DEFAULT_IDLE_MS (500)
 
 using namespace std;
+using steady = chrono::steady_clock;
+
+// What to do with the coils of a lane once a rotation finishes
+enum HoldPolicy {
+    RELEASE   = 0,      // De-energise immediately (no holding torque, no heat)
+    HOLD      = 1,      // Keep the last step energised until the next move or zero_all_pins()
+    HOLD_IDLE = 2       // Keep the last step energised, de-energise once idle for idle_ms
+};
 
 static const int HALF_SEQUENCE[HALF_STEP_LEN][PINS_PER_MOTOR] = { {1, 0, 1, 0},
                                                                   {0, 0, 1, 0},
@@ -48,22 +82,84 @@ static const int HALF_SEQUENCE[HALF_STEP_LEN][PINS_PER_MOTOR] = { {1, 0, 1, 0},
                                                                   {1, 0, 0, 1},
                                                                   {1, 0, 0, 0} };
 
+static const int COILS_OFF[PINS_PER_MOTOR] = {0, 0, 0, 0};
+
 
 // ItemLaneStepper class designed to control a any stepper motor in an item lane
 class ItemLaneSystem {
 public:
-    // Constructor that initializes all of the needed details for the item lanes
-    ItemLaneSystem() {
+    // Constructor for the default (prototype) topology
+    ItemLaneSystem() : ItemLaneSystem({MCP0_ADDR, MCP1_ADDR}, {PIN_BASE0, PIN_BASE1}, default_lanes()) {}
+
+    // Constructor that initializes all of the needed details for the item lanes from topology tables
+    //
+    // Parameters:
+    // - mcp_addrs: I2C address of every MCP23017 expander
+    // - pin_bases: wiringPi pin base given to every expander
+    // - lanes:     for every channel, {expander index, coil pin 1, coil pin 2, coil pin 3, coil pin 4}
+    //              with the coil pins numbered on the expander (0 to 15)
+    ItemLaneSystem(vector<int> mcp_addrs, vector<int> pin_bases, vector<vector<int>> lanes)
+        : num_mcps(mcp_addrs.size()), num_lanes(lanes.size()), shadow(mcp_addrs.size(), 0),
+          pin_writes(mcp_addrs.size(), 0), mcp_locks(mcp_addrs.size()), lane_mcp(lanes.size()),
+          lane_pins(lanes.size(), vector<int>(PINS_PER_MOTOR)), lane_bits_mask(lanes.size()),
+          lane_bit(lanes.size(), vector<uint16_t>(PINS_PER_MOTOR)), moving(lanes.size(), false),
+          last_move(lanes.size(), steady::now()), energised_since(lanes.size()), energised_ns(lanes.size(), 0),
+          last_moves(lanes.size()) {
+        if(pin_bases.size() != mcp_addrs.size()) {
+            throw invalid_argument("Got " + to_string(mcp_addrs.size()) + " expander addresses but " +
+                                   to_string(pin_bases.size()) + " pin bases");
+        }
+
+        // Precompute the expander, the wiringPi pins and the shadow register bits of every lane so that
+        // stepping never has to work them out
+        for(int ch = 0; ch < num_lanes; ch++) {
+            if((lanes[ch].size() != PINS_PER_MOTOR + 1) || (lanes[ch][0] < 0) || (lanes[ch][0] >= num_mcps)) {
+                throw invalid_argument("Lane " + to_string(ch) + " needs a valid expander and " +
+                                       to_string(PINS_PER_MOTOR) + " pins");
+            }
+
+            lane_mcp[ch] = lanes[ch][0];
+            lane_bits_mask[ch] = 0;
+            for(int i = 0; i < PINS_PER_MOTOR; i++) {
+                int pin = lanes[ch][i + 1];
+                if((pin < 0) || (pin >= PINS_PER_MCP)) {
+                    throw invalid_argument("Lane " + to_string(ch) + " has pin " + to_string(pin) + " out of range");
+                }
+
+                lane_pins[ch][i] = pin_bases[lane_mcp[ch]] + pin;
+                lane_bit[ch][i] = 1 << pin;
+                lane_bits_mask[ch] |= lane_bit[ch][i];
+            }
+        }
+
         // Prepare the iface for the GPIO pins coming out of the Pi w/ the MCP23017 expander boards
         wiringPiSetup();
-        mcp23017Setup(PIN_BASE0, MCP0_ADDR);
-        mcp23017Setup(PIN_BASE1, MCP1_ADDR);
+        for(int i = 0; i < num_mcps; i++) {
+            mcp23017Setup(pin_bases[i], mcp_addrs[i]);
+        }
+
+        // Set all of the lane pins to output mode and drive them low once so that the shadow
+        // registers start out matching the real state of the expanders
+        for(int ch = 0; ch < num_lanes; ch++) {
+            for(int i = 0; i < PINS_PER_MOTOR; i++) {
+                pinMode(lane_pins[ch][i], OUTPUT);
+                digitalWrite(lane_pins[ch][i], 0);
+            }
+        }
 
-        // Set all of the relevant pins to output mode
-        for(int i = 0; i < PINS_PER_MCP; i++) {
-            pinMode(PIN_BASE0 + i, OUTPUT);
-            pinMode(PIN_BASE1 + i, OUTPUT);
+        idle_worker = thread(&ItemLaneSystem::idle_loop, this);
+    }
+
+    // Stop the idle thread and leave every lane de-energised
+    ~ItemLaneSystem() {
+        {
+            lock_guard<mutex> guard(idle_lock);
+            stopping = true;
         }
+        idle_cv.notify_all();
+        idle_worker.join();
+
+        zero_all_pins();
     }
 
     // Rotate one motor either cw or ccw at a given speed for a specific amount of rotations
@@ -73,9 +169,28 @@ public:
     // - direction: 'cw' for clockwise or 'ccw' for counterclockwise movement
     // - speed:     used to determine how quickly each step takes--bounded between [0, 1.00]
     // - rotations: number of rotations to undertake
-    void rotate(int channel, string direction, float speed, float rotations) {
-        int base_pin = this->channel_to_base(channel);     // Convert digit channel to base pin addr.
-        int step_sleep = this->speed_to_delay(speed);      // Convert speed to step sleep amount (ms)
+    // - accel:     acceleration (steps/s^2) used to ramp up to and down from the cruise speed--a
+    //              value of 0 disables the ramp and runs the whole move at the cruise speed
+    void rotate(int channel, string direction, float speed, float rotations, float accel = DEFAULT_ACCEL) {
+        this->rotate_at(channel, direction, 1e6f / this->speed_to_delay(speed), rotations, accel);
+    }
+
+    // Rotate one motor either cw or ccw at a step rate for a specific amount of rotations. Steps are
+    // timed against absolute deadlines, so time spent writing the pins does not slow the motor down
+    //
+    // Parameters:
+    // - channel:   motor to move in the system--maps 0 through 5 to the appropriate base pin for a motor
+    // - direction: 'cw' for clockwise or 'ccw' for counterclockwise movement
+    // - step_rate: cruise speed in half-steps per second--bounded between [MIN_STEP_RATE, MAX_STEP_RATE]
+    // - rotations: number of rotations to undertake
+    // - accel:     acceleration (steps/s^2) used to ramp up to and down from the cruise speed--a
+    //              value of 0 disables the ramp and runs the whole move at the cruise speed
+    void rotate_at(int channel, string direction, float step_rate, float rotations, float accel = DEFAULT_ACCEL) {
+        if((channel < 0) || (channel >= num_lanes)) {
+            cout << "Unknown lane channel " << channel << ", staying idle..." << endl;
+            return;
+        }
+
         int step_count = int(rotations * STEPS_PER_ROT);   // Convert rotations to number of steps
 
         // Set rotation direction
@@ -90,55 +205,116 @@ public:
             return;
         }
 
+        // Precompute the per-step delays (us) for the whole move before any pins are touched
+        step_rate = min(max(step_rate, MIN_STEP_RATE), MAX_STEP_RATE);
+        vector<unsigned int> step_sleep = this->build_delay_table(step_count, (unsigned int) lround(1e6 / step_rate), accel);
+
+        this->set_moving(channel, true);
+
+        struct timespec start, deadline, now;
+        clock_gettime(CLOCK_MONOTONIC, &start);
+        deadline = start;
+        int late_steps = 0;
+        int64_t max_late_ns = 0;
+        int steps_taken = 0;
+
         for(int j = 0; j < step_count; j++) {
+            // An abort (from another thread) stops the move between steps
+            if(aborting.load()) {
+                break;
+            }
+
             // Change the index of the step we want depending on the direction
             int cur_step = (dir ? step_count - j - 1 : j);
 
-            // Inner loop runs through the pins in order to determine which value is placed per pin
-            for(int i = 0; i < PINS_PER_MOTOR; i++) {
-                digitalWrite(base_pin + i, HALF_SEQUENCE[cur_step % HALF_STEP_LEN][i]);
+            // Only the coil pins that differ from the shadow register are written out
+            this->write_coils(channel, HALF_SEQUENCE[cur_step % HALF_STEP_LEN]);
+
+            // Sleep until the absolute time of the next step. A step that is already late is taken
+            // straight away; once a whole step behind, the schedule restarts from now instead of
+            // bursting steps to catch up (which would stall the motor)
+            add_ns(deadline, (int64_t) step_sleep[j] * 1000);
+            clock_gettime(CLOCK_MONOTONIC, &now);
+            int64_t late_ns = diff_ns(now, deadline);
+            if(late_ns > 0) {
+                late_steps++;
+                max_late_ns = max(max_late_ns, late_ns);
+                if(late_ns > (int64_t) step_sleep[j] * 1000) {
+                    deadline = now;
+                }
+            } else {
+                clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, &deadline, NULL);
             }
-
-            delay(step_sleep);
+            steps_taken++;
         }
 
-        // Reset all pins back to digital low
-        for(int i = 0; i < PINS_PER_MOTOR; i++) {
-            digitalWrite(base_pin + i, 0);
+        clock_gettime(CLOCK_MONOTONIC, &now);
+        this->record_move(channel, steps_taken, diff_ns(now, start), step_rate, late_steps, max_late_ns);
+
+        // Reset all pins back to digital low unless the policy asks for holding torque (an aborted
+        // move is always released)
+        if ((hold_policy.load() == RELEASE) || aborting.load()) {
+            this->write_coils(channel, COILS_OFF);
         }
+
+        this->set_moving(channel, false);
     }
 
     // Rotate a number of stepper motors using arrays sent in to each of the arguments with
-    // corresponding entries belonging to different channels (up to MAX_WORKERS amount)
+    // corresponding entries belonging to different channels
     //
-    // NOTE: the machine prototype uses the following number scheme for the lanes:
-    //
-    //  [0] [3]
-    //  [1] [4]
-    //  [2] [5]
-    //
-    // Channels 0 and 3, 1 and 4, and 2 and 5 are the pairs that are able to run in parallel,
-    // so we should pick channels that have the same modulus value out of 3 to run in this manner
+    // NOTE: only lanes on different expanders really run in parallel (lanes on one expander take
+    // turns writing it)--the parallel-safe groups of a cabinet are listed by topology.py
     //
     // Parameters:
     // - channels:   Vector of numbered channels of motors to run
     // - directions: Vector of directions the corresponding motors will turn
     // - speeds:     Vector of speeds for the corresponding motor (bounded between 0.0 and 1.0)
     // - rotations:  Vector of the # of rotations the corresponding motors should take
-    void rotate_n(vector<int> channels, vector<string> directions, vector<float> speeds, vector<float> rotations) {
+    // - accels:     Vector of ramp accelerations (steps/s^2) for the corresponding motor--left empty,
+    //               every motor uses the default acceleration
+    void rotate_n(vector<int> channels, vector<string> directions, vector<float> speeds, vector<float> rotations,
+                  vector<float> accels = {}) {
         size_t num_chans = channels.size();
 
-        if((num_chans != directions.size()) && (num_chans != speeds.size()) && (num_chans != rotations.size())) {
+        if(num_chans != speeds.size()) {
             cout << "Mismatched lengths of lists for channels, directions, speeds, and rotations, staying idle..." << endl;
             return;
         }
 
-        for(int i = 0; i < num_chans; i++) {
-            workers[i] = thread(&ItemLaneSystem::rotate, this, channels[i], directions[i],
-                                                              speeds[i], rotations[i]);
+        vector<float> step_rates(num_chans);
+        for(size_t i = 0; i < num_chans; i++) {
+            step_rates[i] = 1e6f / this->speed_to_delay(speeds[i]);
         }
 
-        for(int i = 0; i < num_chans; i++) {
+        this->rotate_n_at(channels, directions, step_rates, rotations, accels);
+    }
+
+    // Same as rotate_n with the speed of each motor given as a step rate (half-steps per second)
+    void rotate_n_at(vector<int> channels, vector<string> directions, vector<float> step_rates, vector<float> rotations,
+                     vector<float> accels = {}) {
+        size_t num_chans = channels.size();
+
+        if((num_chans != directions.size()) || (num_chans != step_rates.size()) || (num_chans != rotations.size()) ||
+           (num_chans > (size_t) num_lanes)) {
+            cout << "Mismatched lengths of lists for channels, directions, step rates, and rotations, staying idle..." << endl;
+            return;
+        }
+
+        if(accels.empty()) {
+            accels.assign(num_chans, DEFAULT_ACCEL);
+        } else if(accels.size() != num_chans) {
+            cout << "Mismatched length of list for accelerations, staying idle..." << endl;
+            return;
+        }
+
+        vector<thread> workers(num_chans);
+        for(size_t i = 0; i < num_chans; i++) {
+            workers[i] = thread(&ItemLaneSystem::rotate_at, this, channels[i], directions[i],
+                                                                 step_rates[i], rotations[i], accels[i]);
+        }
+
+        for(size_t i = 0; i < num_chans; i++) {
             workers[i].join();
         }
     }
@@ -146,39 +322,320 @@ public:
     // Set all of the pins on all expansion boards connecting to the motors to digital low--this
     // is recommended to run once a rotation is complete to avoid stray power draw
     void zero_all_pins() {
-        for(int i = 0; i < PINS_PER_MCP; i++) {
-            digitalWrite(PIN_BASE0 + i, 0);
-            digitalWrite(PIN_BASE1 + i, 0);
+        for(int i = 0; i < num_lanes; i++) {
+            this->write_coils(i, COILS_OFF);
+        }
+    }
+
+    // Choose what happens to the coils of a lane after a rotation (see HoldPolicy)
+    //
+    // Parameters:
+    // - policy:  0 (RELEASE), 1 (HOLD), or 2 (HOLD_IDLE)
+    // - idle_ms: time a lane is held after its last move before it is de-energised (HOLD_IDLE only)
+    void set_hold_policy(int policy, int idle_ms = DEFAULT_IDLE_MS) {
+        if ((policy < RELEASE) || (policy > HOLD_IDLE)) {
+            cout << "Invalid hold policy chosen, keeping the current policy..." << endl;
+            return;
+        }
+
+        // Read by the rotating threads and the idle thread without a lock, so both are atomic (the idle
+        // time is set first so the idle thread never applies a new policy with the old time)
+        hold_idle_ms.store(max(idle_ms, 0));
+        hold_policy.store((HoldPolicy) policy);
+
+        if (policy == RELEASE) {
+            zero_all_pins();
+        }
+    }
+
+    // Returns the total number of seconds that any coil of the lane on the channel has been energised
+    double get_energised_time(int channel) {
+        this->check_channel(channel);
+        lock_guard<mutex> guard(mcp_locks[lane_mcp[channel]]);
+
+        int64_t total = energised_ns[channel];
+        if (this->lane_bits(channel) != 0) {
+            total += chrono::duration_cast<chrono::nanoseconds>(steady::now() - energised_since[channel]).count();
+        }
+
+        return total / 1e9;
+    }
+
+    // Returns the number of pin writes actually sent out over I2C since the system was created
+    uint64_t get_pin_writes() {
+        uint64_t total = 0;
+        for(int i = 0; i < num_mcps; i++) {
+            lock_guard<mutex> guard(mcp_locks[i]);
+            total += pin_writes[i];
+        }
+
+        return total;
+    }
+
+    // Stops every rotation in progress within one step, and makes new rotations return straight
+    // away until clear_abort() is called--safe to call from any thread while a rotation is running
+    void abort() {
+        aborting.store(true);
+    }
+
+    void clear_abort() {
+        aborting.store(false);
+    }
+
+    bool is_aborted() {
+        return aborting.load();
+    }
+
+    // Returns the timing of the last rotation of the lane on the channel: "steps", "seconds", the
+    // achieved "rate" and requested cruise "target_rate" (steps/s), the number of steps that were
+    // taken late ("late_steps") and by how much the latest one was ("max_late_us")
+    map<string, double> get_last_move(int channel) {
+        this->check_channel(channel);
+        lock_guard<mutex> guard(mcp_locks[lane_mcp[channel]]);
+        return last_moves[channel];
+    }
+
+    // Returns the number of lanes in the topology
+    int get_num_lanes() {
+        return num_lanes;
+    }
+
+    // Returns the wiringPi pins driving the coils of the lane on the channel
+    vector<int> get_lane_pins(int channel) {
+        this->check_channel(channel);
+        return lane_pins[channel];
+    }
+
+    // Returns the last value written to the output pins of an expander (bit n is pin n)
+    uint16_t get_shadow_register(int mcp) {
+        if((mcp < 0) || (mcp >= num_mcps)) {
+            throw out_of_range("Unknown expander " + to_string(mcp));
         }
+        lock_guard<mutex> guard(mcp_locks[mcp]);
+        return shadow[mcp];
     }
 
 private:
-    thread workers[MAX_WORKERS];           // Private threads for use in running simultaneous motors
+    int num_mcps;
+    int num_lanes;
+
+    // Shadow registers of the expander output pins--guarded per expander so that lanes on
+    // different boards never wait on each other
+    vector<uint16_t> shadow;
+    vector<uint64_t> pin_writes;
+    vector<mutex> mcp_locks;
+
+    // Lookup tables from the topology: expander, wiringPi pins and shadow register bits of every lane
+    vector<int> lane_mcp;
+    vector<vector<int>> lane_pins;
+    vector<uint16_t> lane_bits_mask;
+    vector<vector<uint16_t>> lane_bit;
+
+    // Per-lane power bookkeeping (guarded by the lock of the lane's expander)
+    vector<char> moving;
+    vector<steady::time_point> last_move;
+    vector<steady::time_point> energised_since;
+    vector<int64_t> energised_ns;
+    vector<map<string, double>> last_moves;
+
+    // Hold policy and the idle thread that enforces it
+    atomic<HoldPolicy> hold_policy{RELEASE};
+    atomic<int> hold_idle_ms{DEFAULT_IDLE_MS};
+    bool stopping = false;
+    atomic<bool> aborting{false};
+    mutex idle_lock;
+    condition_variable idle_cv;
+    thread idle_worker;
+
+    // Builds the lane table of the default topology: MOTORS_PER_MCP lanes on each expander, in order
+    static vector<vector<int>> default_lanes() {
+        vector<vector<int>> lanes;
+        for(int ch = 0; ch < NUM_MCPS * MOTORS_PER_MCP; ch++) {
+            int first = (ch % MOTORS_PER_MCP) * PINS_PER_MOTOR;
+            lanes.push_back({ch / MOTORS_PER_MCP, first, first + 1, first + 2, first + 3});
+        }
+        return lanes;
+    }
 
-    // Maps sequential, positive integer channels to the appropriate base pin address for the motor
-    // that is at that place (i.e. 0 to 100, 1 to 104, 2 to 108, 3 to 200, 4 to 204, 5 to 208, etc.)
-    int channel_to_base(int channel) {
-       return PIN_BASE0 + (PIN_BASE0 * ((int) (channel / MOTORS_PER_MCP))) +
-                ((channel % MOTORS_PER_MCP) * PINS_PER_MOTOR);
+    // Raises out_of_range (IndexError in Python) for a channel that is not in the topology
+    void check_channel(int channel) {
+        if((channel < 0) || (channel >= num_lanes)) {
+            throw out_of_range("Unknown lane channel " + to_string(channel));
+        }
     }
 
-    // Converts speed into delay amount for the purposes of rotation
-    int speed_to_delay(float speed) {
-        return int(MIN_DELAY + MAX_DELAY * (1 - speed));
+    // Returns the bits of the shadow register that belong to the lane on the channel
+    uint16_t lane_bits(int channel) {
+        return shadow[lane_mcp[channel]] & lane_bits_mask[channel];
+    }
+
+    // Drives the coils of a lane to the given pattern, writing only the pins that changed and
+    // keeping the energised-time counter of the lane up to date
+    void write_coils(int channel, const int pattern[PINS_PER_MOTOR]) {
+        lock_guard<mutex> guard(mcp_locks[lane_mcp[channel]]);
+        this->write_coils_locked(channel, pattern);
+    }
+
+    // Same as write_coils, for callers that already hold the lock of the lane's expander
+    void write_coils_locked(int channel, const int pattern[PINS_PER_MOTOR]) {
+        int mcp = lane_mcp[channel];
+
+        bool was_energised = (this->lane_bits(channel) != 0);
+
+        for(int i = 0; i < PINS_PER_MOTOR; i++) {
+            uint16_t bit = lane_bit[channel][i];
+            bool cur = (shadow[mcp] & bit) != 0;
+
+            if (cur != (pattern[i] != 0)) {
+                digitalWrite(lane_pins[channel][i], pattern[i]);
+                shadow[mcp] ^= bit;
+                pin_writes[mcp]++;
+            }
+        }
+
+        bool is_energised = (this->lane_bits(channel) != 0);
+        if (!was_energised && is_energised) {
+            energised_since[channel] = steady::now();
+        } else if (was_energised && !is_energised) {
+            energised_ns[channel] += chrono::duration_cast<chrono::nanoseconds>(steady::now() - energised_since[channel]).count();
+        }
+    }
+
+    // Adds ns nanoseconds to a timespec
+    static void add_ns(struct timespec &t, int64_t ns) {
+        ns += t.tv_nsec;
+        t.tv_sec += ns / 1000000000;
+        t.tv_nsec = ns % 1000000000;
+    }
+
+    // Returns a - b in nanoseconds
+    static int64_t diff_ns(const struct timespec &a, const struct timespec &b) {
+        return (int64_t) (a.tv_sec - b.tv_sec) * 1000000000 + (a.tv_nsec - b.tv_nsec);
+    }
+
+    // Keeps the timing of the last rotation of a lane for get_last_move()
+    void record_move(int channel, int steps, int64_t elapsed_ns, float target_rate, int late_steps, int64_t max_late_ns) {
+        lock_guard<mutex> guard(mcp_locks[lane_mcp[channel]]);
+        map<string, double> &move = last_moves[channel];
+        move["steps"] = steps;
+        move["seconds"] = elapsed_ns / 1e9;
+        move["rate"] = elapsed_ns > 0 ? steps / (elapsed_ns / 1e9) : 0.0;
+        move["target_rate"] = target_rate;
+        move["late_steps"] = late_steps;
+        move["max_late_us"] = max_late_ns / 1e3;
+    }
+
+    // Marks a lane as moving (so the idle thread leaves it alone) or as idle as of now
+    void set_moving(int channel, bool state) {
+        lock_guard<mutex> guard(mcp_locks[lane_mcp[channel]]);
+        moving[channel] = state;
+        last_move[channel] = steady::now();
+    }
+
+    // Background loop that de-energises held lanes once they have been idle long enough
+    void idle_loop() {
+        unique_lock<mutex> idle_guard(idle_lock);
+
+        while (!stopping) {
+            idle_cv.wait_for(idle_guard, chrono::milliseconds(IDLE_POLL_MS));
+
+            if (stopping || (hold_policy.load() != HOLD_IDLE)) {
+                continue;
+            }
+
+            for(int i = 0; i < num_lanes; i++) {
+                lock_guard<mutex> guard(mcp_locks[lane_mcp[i]]);
+
+                if (!moving[i] && (this->lane_bits(i) != 0) &&
+                    (steady::now() - last_move[i] > chrono::milliseconds(hold_idle_ms.load()))) {
+                    this->write_coils_locked(i, COILS_OFF);
+                }
+            }
+        }
+    }
+
+    // Converts speed into the cruise delay amount (us) for the purposes of rotation
+    unsigned int speed_to_delay(float speed) {
+        speed = min(max(speed, 0.0f), 1.0f);
+        return (unsigned int) (MIN_DELAY_US + (MAX_DELAY_US - MIN_DELAY_US) * (1 - speed));
+    }
+
+    // Builds the table of per-step delays (us) for a move of step_count steps. The motor starts
+    // at the pull-in delay, accelerates at a constant rate until it reaches the cruise delay, and
+    // mirrors the same ramp to decelerate into the final step. Short moves that cannot reach the
+    // cruise speed get a triangular profile instead.
+    vector<unsigned int> build_delay_table(int step_count, unsigned int cruise_delay, float accel) {
+        vector<unsigned int> table(max(step_count, 0), cruise_delay);
+
+        if((accel <= 0) || (cruise_delay >= START_DELAY_US)) {
+            return table;
+        }
+
+        // Speeds in steps/s at the start of the ramp and while cruising
+        double v0 = 1e6 / START_DELAY_US;
+        double vc = 1e6 / cruise_delay;
+        int ramp_len = (int) ceil((vc * vc - v0 * v0) / (2.0 * accel));
+
+        // Precompute the ramp once, then index into it from both ends of the move
+        vector<unsigned int> ramp(min(ramp_len, (step_count + 1) / 2));
+        for(size_t i = 0; i < ramp.size(); i++) {
+            ramp[i] = max(cruise_delay, (unsigned int) (1e6 / sqrt(v0 * v0 + 2.0 * accel * i)));
+        }
+
+        for(size_t i = 0; i < ramp.size(); i++) {
+            table[i] = ramp[i];
+            table[step_count - i - 1] = ramp[i];
+        }
+
+        return table;
     }
 };
 
+// Rotations release the GIL so that Python threads (bus arbiter, status display, telemetry) keep
+// running while the lanes move
 PYBIND11_MODULE(ItemLaneSystem, m) {
     pybind11::class_<ItemLaneSystem>(m, "ItemLaneSystem")
         .def(pybind11::init<>())
-        .def("rotate", &ItemLaneSystem::rotate)
-        .def("rotate_n", &ItemLaneSystem::rotate_n)
-        .def("zero_all_pins", &ItemLaneSystem::zero_all_pins);
+        .def(pybind11::init<vector<int>, vector<int>, vector<vector<int>>>(),
+             pybind11::arg("mcp_addrs"), pybind11::arg("pin_bases"), pybind11::arg("lanes"))
+        .def("rotate", &ItemLaneSystem::rotate,
+             pybind11::arg("channel"), pybind11::arg("direction"), pybind11::arg("speed"),
+             pybind11::arg("rotations"), pybind11::arg("accel") = DEFAULT_ACCEL,
+             pybind11::call_guard<pybind11::gil_scoped_release>())
+        .def("rotate_n", &ItemLaneSystem::rotate_n,
+             pybind11::arg("channels"), pybind11::arg("directions"), pybind11::arg("speeds"),
+             pybind11::arg("rotations"), pybind11::arg("accels") = vector<float>(),
+             pybind11::call_guard<pybind11::gil_scoped_release>())
+        .def("rotate_at", &ItemLaneSystem::rotate_at,
+             pybind11::arg("channel"), pybind11::arg("direction"), pybind11::arg("step_rate"),
+             pybind11::arg("rotations"), pybind11::arg("accel") = DEFAULT_ACCEL,
+             pybind11::call_guard<pybind11::gil_scoped_release>())
+        .def("rotate_n_at", &ItemLaneSystem::rotate_n_at,
+             pybind11::arg("channels"), pybind11::arg("directions"), pybind11::arg("step_rates"),
+             pybind11::arg("rotations"), pybind11::arg("accels") = vector<float>(),
+             pybind11::call_guard<pybind11::gil_scoped_release>())
+        .def("get_last_move", &ItemLaneSystem::get_last_move)
+        .def("zero_all_pins", &ItemLaneSystem::zero_all_pins)
+        .def("abort", &ItemLaneSystem::abort)
+        .def("clear_abort", &ItemLaneSystem::clear_abort)
+        .def("is_aborted", &ItemLaneSystem::is_aborted)
+        .def("set_hold_policy", &ItemLaneSystem::set_hold_policy,
+             pybind11::arg("policy"), pybind11::arg("idle_ms") = DEFAULT_IDLE_MS)
+        .def("get_energised_time", &ItemLaneSystem::get_energised_time)
+        .def("get_pin_writes", &ItemLaneSystem::get_pin_writes)
+        .def("get_shadow_register", &ItemLaneSystem::get_shadow_register)
+        .def("get_num_lanes", &ItemLaneSystem::get_num_lanes)
+        .def("get_lane_pins", &ItemLaneSystem::get_lane_pins);
+
+    m.attr("RELEASE") = (int) RELEASE;
+    m.attr("HOLD") = (int) HOLD;
+    m.attr("HOLD_IDLE") = (int) HOLD_IDLE;
+    m.attr("MAX_STEP_RATE") = MAX_STEP_RATE;
 }
 
 // Test execution to see that motors can work independently and together
 int main() {
-    ItemLaneSystem sys = ItemLaneSystem();
+    ItemLaneSystem sys;
 
     for(int i = 0; i < 6; i++) {
         cout << "Running motor " << i << "..." << endl;
@@ -201,4 +658,10 @@ int main() {
     
     cout << "Running motors 0 (twice cw) and 5 (once ccw) together..." << endl;
     sys.rotate_n({0, 5}, {"cw", "ccw"}, {1.0, 1.0}, {2.0, 1.0});
+
+    cout << "Running motor 0 at " << MAX_STEP_RATE << " steps/s..." << endl;
+    sys.rotate_at(0, "cw", MAX_STEP_RATE, 2.0);
+    map<string, double> move = sys.get_last_move(0);
+    cout << "Achieved " << move["rate"] << " steps/s, " << move["late_steps"] << " late steps (max "
+         << move["max_late_us"] << " us)" << endl;
 }
@@ -21,5 +21,24 @@ rots = [1.0, 1.0, 1.0]
 print("Rtoating 3 (ch 0/1/2) together with rotate_n")
 sys.rotate_n(chans, dirs, spds, rots)
 
+# Speeds can also be given as step rates (half-steps per second), which are timed to the microsecond
+print("Rotating 1 (ch 4) at {} steps/s with rotate_at".format(ils.MAX_STEP_RATE))
+sys.rotate_at(4, "cw", ils.MAX_STEP_RATE, 2.0)
+sys.rotate_n_at([0, 3], ["cw", "cw"], [1000.0, 2000.0], [1.0, 1.0])
+move = sys.get_last_move(4)
+print("Channel 4 achieved {:.0f} steps/s ({:.0f} late steps, up to {:.0f} us late)".format(
+    move["rate"], move["late_steps"], move["max_late_us"]))
+
 sys.zero_all_pins()
 
+# The expanders are shadowed in the module, so only pins that actually change get written over I2C
+print("Pin writes sent: {}".format(sys.get_pin_writes()))
+for ch in range(6):
+    print("Channel {} energised for {:.2f}s".format(ch, sys.get_energised_time(ch)))
+
+# Keep the coils energised between moves and release them after half a second of idling
+sys.set_hold_policy(ils.HOLD_IDLE, 500)
+sys.rotate(0, "cw", 1.0, 1.0)
+time.sleep(1)
+sys.set_hold_policy(ils.RELEASE)
+
@@ -2,6 +2,7 @@
 
 import time
 import math
+import threading
 import board
 from adafruit_motor import stepper
 from adafruit_motorkit import MotorKit
@@ -33,11 +34,38 @@ MIDPT = 0.5
 POWER = 4
 SLP_MIN = 0.02325
 
+# Step rate (steps/s) a ramped linear rotation starts from and slows back down to
+RAMP_START_SPEED = 100
+
+# Priority of step writes on a shared I2C bus arbiter (most urgent, see i2c_bus.MOTOR)
+BUS_PRIORITY = 0
+
+# One MotorKit per HAT address--both channels of a HAT may drive platforms of different cabinets,
+# and a second MotorKit on the same address would reset the PCA9685 under the other one
+_KITS = {}
+_KITS_LOCK = threading.Lock()
+
+def motor_kit(address:int=I2C_ADDR) -> MotorKit:
+    with _KITS_LOCK:
+        if address not in _KITS:
+            _KITS[address] = MotorKit(i2c=board.I2C(), address=address)
+        return _KITS[address]
+
 class PlatformStepper:
     # Perform setup and check whether the position we are loading from is correct or not relative
     # to the expected neutral position of the stepper motor
-    def __init__(self, channel:int):
-        self.kit = MotorKit(i2c=board.I2C(), address=I2C_ADDR)
+    #
+    # The optional bus is an i2c_bus.BusArbiter shared with the other devices on the I2C bus (steps
+    # are transactions on its device name), and the optional motion is a motion_sampler.Motion told
+    # when (and how fast) the platform is stepping. A platform on another HAT is given its address,
+    # and platforms of other cabinets keep their position in their own pos_file.
+    def __init__(self, channel:int, bus=None, motion=None, address:int=I2C_ADDR, pos_file:str=None,
+                 device:str='platform'):
+        self.kit = motor_kit(address)
+        self.bus = bus
+        self.device = device
+        self.motion = motion
+        self.aborting = threading.Event()  # Set by abort() to stop a move between steps
         self.step_channel = None
         self.position = None
         self.pos_file = None
@@ -49,8 +77,10 @@ class PlatformStepper:
             exit(1)
         
         self.step_channel = self.kit.stepper1 if channel == 0 else self.kit.stepper2
-        self.pos_file = PLAT0_FILE if channel == 0 else PLAT1_FILE
-        self.pos_loc = PLAT0_LOC if channel == 0 else PLAT1_LOC
+        if pos_file is None:
+            pos_file = PLAT0_FILE if channel == 0 else PLAT1_FILE
+        self.pos_file = pos_file
+        self.pos_loc = Path(pos_file)
 
         # Check if the file for storing postition exists and initialize if not so
         if not self.pos_loc.is_file():
@@ -80,13 +110,16 @@ class PlatformStepper:
     # -rotations: number of rotations to undertake
     # -glide: forces the rotations to accelerate and decelerate gently--note that enabling
     #         this option uses a different speed scale that is bounded by [0, 70]
-    def rotate(self, direction:str, speed:int, rotations:float, glide:bool=False):
+    # -accel: acceleration (steps/s^2) of a linear ramp from RAMP_START_SPEED up to the speed and back
+    #         down at the end of a rotation without glide--0 runs the whole rotation at the speed
+    def rotate(self, direction:str, speed:int, rotations:float, glide:bool=False, accel:float=0):
         if (glide) and (speed > MAX_GLIDE_SPEED):
             print("Glide caps the speed limit to ", MAX_GLIDE_SPEED)
             exit(1)
 
         step_sleep = 1 / speed
         step_count = (int) (rotations * DOUBLE_STEP)
+        start_speed = min(speed, RAMP_START_SPEED)
         dir_mode = None
 
         if direction == 'cw':
@@ -97,15 +130,23 @@ class PlatformStepper:
             print("Unexpected direction--should be \'cw\' or \'ccw\'")
             exit(1)
 
+        # Glide spends most of its steps near the cruise rate of speed / SLP_MIN
+        self.begin_motion(speed / SLP_MIN if glide else speed)
         try:
             for i in range(step_count):
-                self.step_channel.onestep(direction=dir_mode, style=stepper.DOUBLE)
+                if self.aborting.is_set():
+                    break
+                self.onestep(dir_mode)
                 self.position = self.position + (1 if direction == 'cw' else -1)
                 
                 # Perform motion smoothing if the glide flag is enabled
                 if glide:
                     ii = i / step_count
                     step_sleep = (1 / speed) * (SLP_MAX * math.pow(ii - MIDPT, POWER) + SLP_MIN)
+                elif accel > 0:
+                    # Constant acceleration: the rate grows with the square root of the steps from the nearer end
+                    edge = min(i, step_count - 1 - i)
+                    step_sleep = 1 / min(speed, math.sqrt(start_speed ** 2 + 2 * accel * edge))
 
                 time.sleep(step_sleep)
             
@@ -118,22 +159,57 @@ class PlatformStepper:
 
             exit(1)
 
+        finally:
+            self.end_motion()
+
+    # Reports the step rate (Hz) of the platform while it moves, if anything is listening
+    def begin_motion(self, step_hz:float):
+        if self.motion is not None:
+            self.motion.begin('platform', step_hz)
+
+    def end_motion(self):
+        if self.motion is not None:
+            self.motion.end('platform')
+
+    # Takes one double step, as a single transaction on the shared bus if there is one
+    def onestep(self, dir_mode):
+        if self.bus is None:
+            self.step_channel.onestep(direction=dir_mode, style=stepper.DOUBLE)
+        else:
+            with self.bus.transaction(self.device, BUS_PRIORITY):
+                self.step_channel.onestep(direction=dir_mode, style=stepper.DOUBLE)
+
     # Resets the position of the stepper motor back to the currently-defined zero position
     def reset_position(self):
-        if self.position > 0:
-            while self.position > 0:
-                self.step_channel.onestep(direction=stepper.BACKWARD, style=stepper.DOUBLE)
-                self.position = self.position - 1
-                time.sleep(0.01)
-        elif self.position < 0:
-            while self.position < 0:
-                self.step_channel.onestep(direction=stepper.FORWARD, style=stepper.DOUBLE)
-                self.position = self.position + 1
-                time.sleep(0.01)
+        self.begin_motion(100)
+        try:
+            if self.position > 0:
+                while self.position > 0 and not self.aborting.is_set():
+                    self.onestep(stepper.BACKWARD)
+                    self.position = self.position - 1
+                    time.sleep(0.01)
+            elif self.position < 0:
+                while self.position < 0 and not self.aborting.is_set():
+                    self.onestep(stepper.FORWARD)
+                    self.position = self.position + 1
+                    time.sleep(0.01)
+
+        # A failed step (e.g. an I2C error) must not leave the platform reported as moving, and the
+        # steps already taken are still saved
+        finally:
+            self.end_motion()
 
-        with open(self.pos_file, "w") as f:
-            print(self.position)
-            f.write(str(self.position))
+            with open(self.pos_file, "w") as f:
+                print(self.position)
+                f.write(str(self.position))
+
+    # Stops a rotation or reset in progress (from another thread) after the current step--the position
+    # stays tracked, and moves return straight away until clear_abort() is called
+    def abort(self):
+        self.aborting.set()
+
+    def clear_abort(self):
+        self.aborting.clear()
 
     # Sets the CURRENT position of the stepper motor as the new zero position--if you want to move
     # the motor's position back to the original position, call reset_position() instead!
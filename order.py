@@ -0,0 +1,172 @@
+"""
+Order payloads and the items in them. An order is parsed and validated in a single pass before any
+motor moves, so a malformed order is rejected up front instead of failing in the middle of a vend.
+"""
+
+import json
+import math
+
+from lane_model import base_step_hz
+from topology import TOPOLOGY
+
+# Lane channels by row and column, and platform stepper motor positions by row (see topology.json)
+MOTOR_CHANNELS = TOPOLOGY.motor_channels
+ROW_POSITIONS = TOPOLOGY.row_positions
+ZERO_POS = TOPOLOGY.zero_position
+
+WEIGHT_VAR_TOL = 0.2                # Fraction of weight variation tolerated
+
+
+class OrderError(ValueError):
+  """Raised when an order payload is malformed"""
+  def __init__(self, message, order_id=None):
+    super().__init__(message)
+    self.order_id = order_id              # ID of the rejected order, if it could be read
+
+
+def _to_int(info:dict, field:str, low:int, high:int) -> int:
+  """Reads an integer field (also accepting digit strings such as '2') and checks its range"""
+  value = info.get(field)
+  if isinstance(value, str) and value.strip().isdecimal():
+    value = int(value)
+  if isinstance(value, bool) or not isinstance(value, int):
+    raise OrderError("'{}' must be an integer, got {!r}".format(field, value))
+  if value < low or value > high:
+    raise OrderError("'{}' must be between {} and {}, got {}".format(field, low, high, value))
+  return value
+
+def _to_float(info:dict, field:str) -> float:
+  """Reads a positive, finite number field"""
+  value = info.get(field)
+  if isinstance(value, str):
+    try:
+      value = float(value)
+    except ValueError:
+      pass
+  if isinstance(value, bool) or not isinstance(value, (int, float)) or not (value > 0 and math.isfinite(value)):
+    raise OrderError("'{}' must be a positive number, got {!r}".format(field, value))
+  return float(value)
+
+
+# Holds all of the information related to an item that is ordered
+class Item():
+  __slots__ = ('key', 'name', 'quantity', 'weight', 'volume', 'row', 'column', 'channel', 'expander',
+               'row_pos', 'min_weight', 'max_weight')
+
+  def __init__(self, info:dict, key=None, topology=TOPOLOGY):
+    if not isinstance(info, dict):
+      raise OrderError("Item must be an object, got {!r}".format(info))
+
+    self.key = key                    # Position of the item in the order list
+    self.name = info.get('name')
+    self.quantity = _to_int(info, 'quantity', 1, 1 << 16)  # Amount to be dispensed
+    self.weight = _to_float(info, 'weight')                # Weight of one unit
+    self.volume = _to_float(info, 'volume')                # Volume of one unit
+    self.row = _to_int(info, 'row', 1, len(topology.motor_channels))
+    self.column = _to_int(info, 'column', 1, len(topology.motor_channels[self.row-1]))
+
+    # Everything the dispense path needs is worked out once here, from the topology of the cabinet
+    # the item is ordered from
+    self.channel = topology.channels[(self.row, self.column)]
+    self.expander = topology.expander_of[self.channel]
+    self.row_pos = topology.row_positions[self.row]
+    self.min_weight = self.weight * (1 - WEIGHT_VAR_TOL)
+    self.max_weight = self.weight * (1 + WEIGHT_VAR_TOL)
+
+  def __repr__(self):
+    return "Item({}, row={}, column={}, quantity={})".format(self.name, self.row, self.column, self.quantity)
+
+  def decrement(self):
+    """Decrement item quantity and return new value"""
+    self.quantity = self.quantity - 1
+    return self.quantity
+
+  def get_lane_speed(self, model=None, count:int=1):
+    """
+    Determines the step rate (steps/s) of the item lane stepper motors based on the weight of the
+    items held (count of them, when the lane stock is known). With a LaneSpeedModel the stall
+    history of the lane slows it down further.
+    """
+    if model is None:
+      return base_step_hz(self.weight, self.volume, count)
+    return model.step_hz(self.channel, self.weight, self.volume, count)
+
+  def get_lane_rotations(self):
+    """
+    Determines the expected number of rotations to drop one item given the volume of the item.
+    """
+    pass
+
+
+class Order():
+  """Holds the information associated with an order (i.e. the list of items to dispense)"""
+  def __init__(self, ID, items:list):
+
+    def schedule_order(order):
+      """Determines the order in which items should be dispensed based on location
+      Returns sorted list of item objects.
+      """
+      return sorted(order, key=lambda i: i.row)
+
+    self.ID = ID
+    self.items = schedule_order(items)  # list of sorted items to dispense
+
+  def remove_item(self, item:Item):
+    """Removes an item from the list of items"""
+    self.items.remove(item)
+
+
+def parse_order(payload, topology=TOPOLOGY) -> Order:
+  """Reads and validates a JSON order payload in a single pass, against the topology of the cabinet
+  it is for. Returns an Order, or raises OrderError describing the first problem found.
+  """
+  try:
+    info = json.loads(payload)
+  except ValueError as e:
+    raise OrderError("Payload is not valid JSON: {}".format(e))
+
+  if not isinstance(info, dict) or 'orderID' not in info:
+    raise OrderError("Payload is missing 'orderID'")
+
+  order_list = info.get('orderList')
+  if isinstance(order_list, dict):
+    entries = order_list.items()
+  elif isinstance(order_list, list):
+    entries = enumerate(order_list)
+  else:
+    raise OrderError("'orderList' must be an object or a list", info['orderID'])
+
+  items = []
+  for key, item_info in entries:
+    try:
+      items.append(Item(item_info, key=str(key), topology=topology))
+    except OrderError as e:
+      raise OrderError("Item {}: {}".format(key, e), info['orderID'])
+
+  if len(items) == 0:
+    raise OrderError("Order has no items", info['orderID'])
+
+  return Order(info['orderID'], items)
+
+def parse_payload(payload, topology=TOPOLOGY):
+  """Reads JSON payload and organizes information in Item dataclass.
+  Returns a list of item objects.
+  """
+  return parse_order(payload, topology).items
+
+
+def main():
+  # Benchmark of the parse path with a typical order
+  import timeit
+
+  payload = json.dumps({'orderID': 'bench', 'orderList': {
+      '0': {'UID': 1, 'name': 'Cheetos', 'quantity': 2, 'weight': 99.2233, 'volume': 1840.103, 'row': 1, 'column': 1},
+      '1': {'UID': 2, 'name': 'Hershey', 'quantity': 1, 'weight': 45, 'volume': 46.512, 'row': 1, 'column': 2},
+      '2': {'UID': 3, 'name': 'Skittles', 'quantity': 1, 'weight': 61.5, 'volume': 34.806, 'row': 2, 'column': 1}}})
+
+  runs = 20000
+  elapsed = timeit.timeit(lambda: parse_order(payload), number=runs)
+  print("parse_order: {:.1f} us per order ({} runs)".format(elapsed / runs * 1e6, runs))
+
+if __name__ == '__main__':
+  main()
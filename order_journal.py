@@ -0,0 +1,142 @@
+"""
+Append-only journal of the orders handled by the machine, kept in SQLite (WAL mode) so that an order
+interrupted by a crash or power loss can be resumed or refunded on the next start, and so that
+orders redelivered by the broker are never vended twice.
+
+Progress is written into an open transaction and committed in groups at the points where the
+machine state is worth keeping (after each drop cycle, at delivery, at the end of an order).
+"""
+
+import sqlite3
+import threading
+import time
+
+JOURNAL_FILE = "orders.db"
+
+# Order states
+QUEUED = "QUEUED"               # Received and waiting for the hardware
+DISPENSING = "DISPENSING"       # Items are being dropped
+SUCCESS = "SUCCESS"             # Every item was dispensed
+FAILED = "FAILED"               # The vend stopped before every item was dispensed
+REFUNDED = "REFUNDED"           # Interrupted order that was reported for a refund on restart
+
+FINISHED = (SUCCESS, FAILED, REFUNDED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    order_id TEXT PRIMARY KEY,
+    payload  TEXT NOT NULL,
+    status   TEXT NOT NULL,
+    created  REAL NOT NULL,
+    updated  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    order_id TEXT NOT NULL,
+    key      TEXT NOT NULL,
+    ordered  INTEGER NOT NULL,
+    dropped  INTEGER NOT NULL DEFAULT 0,
+    on_plat  INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (order_id, key)
+);
+"""
+
+
+class OrderJournal:
+    """SQLite-backed record of every order and how far along it got"""
+
+    def __init__(self, path:str=JOURNAL_FILE):
+        # The journal is shared by the MQTT thread, the hardware worker, and the pickup monitor
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+        # Every known order ID and its state, so duplicate checks never touch the disk
+        self.states = dict(self.conn.execute("SELECT order_id, status FROM orders"))
+        self.in_txn = False
+
+    def seen(self, order_id) -> bool:
+        """Checks whether an order has already been journaled"""
+        return str(order_id) in self.states
+
+    def status(self, order_id) -> str:
+        """Returns the journaled state of an order (None if it has never been seen)"""
+        return self.states.get(str(order_id))
+
+    def record_order(self, order_id, payload:str, items:list) -> bool:
+        """
+        Journals a newly received order and its items (committed immediately, since the broker
+        considers the order delivered from here on). Returns False if the order is a duplicate.
+        """
+        order_id = str(order_id)
+        with self.lock:
+            if order_id in self.states:
+                return False
+
+            now = time.time()
+            self._begin()
+            self.conn.execute("INSERT INTO orders VALUES (?, ?, ?, ?, ?)", (order_id, payload, QUEUED, now, now))
+            self.conn.executemany("INSERT INTO items (order_id, key, ordered) VALUES (?, ?, ?)",
+                                  [(order_id, str(i.key), i.quantity) for i in items])
+            self.states[order_id] = QUEUED
+            self._commit()
+        return True
+
+    def set_status(self, order_id, status:str, commit:bool=True):
+        """Moves an order to a new state"""
+        order_id = str(order_id)
+        with self.lock:
+            self._begin()
+            self.conn.execute("UPDATE orders SET status = ?, updated = ? WHERE order_id = ?",
+                              (status, time.time(), order_id))
+            self.states[order_id] = status
+            if commit:
+                self._commit()
+
+    def item_dropped(self, order_id, key):
+        """Records one unit of an item landing on the platform (committed with the next group)"""
+        with self.lock:
+            self._begin()
+            self.conn.execute("UPDATE items SET dropped = dropped + 1, on_plat = on_plat + 1 "
+                              "WHERE order_id = ? AND key = ?", (str(order_id), str(key)))
+
+    def platform_cleared(self, order_id):
+        """Records that the items of an order on the platform were picked up"""
+        with self.lock:
+            self._begin()
+            self.conn.execute("UPDATE items SET on_plat = 0 WHERE order_id = ?", (str(order_id),))
+            self._commit()
+
+    def commit(self):
+        """Commits every change made since the last commit as one group"""
+        with self.lock:
+            self._commit()
+
+    def progress(self, order_id) -> dict:
+        """Returns {item key: (ordered, dropped, on_plat)} for an order"""
+        with self.lock:
+            rows = self.conn.execute("SELECT key, ordered, dropped, on_plat FROM items WHERE order_id = ?",
+                                     (str(order_id),))
+            return {r[0]: (r[1], r[2], r[3]) for r in rows}
+
+    def unfinished(self) -> list:
+        """Returns (order ID, payload) for every order that was interrupted, oldest first"""
+        with self.lock:
+            rows = self.conn.execute("SELECT order_id, payload FROM orders WHERE status IN (?, ?) "
+                                     "ORDER BY created", (QUEUED, DISPENSING))
+            return list(rows)
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def _begin(self):
+        if not self.in_txn:
+            self.conn.execute("BEGIN")
+            self.in_txn = True
+
+    def _commit(self):
+        if self.in_txn:
+            self.conn.execute("COMMIT")
+            self.in_txn = False
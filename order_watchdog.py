@@ -0,0 +1,127 @@
+"""
+Time limits for a single order. Every order gets an overall deadline, and each phase of dispensing
+(waiting for the platform to be cleared, moving, dropping, delivering) gets a budget of its own,
+capped by what is left of the overall deadline. A background thread watches the deadline of the
+current phase; when it passes, the abort hooks are called (stopping the lane motors, the platform and
+any HX711 read that is waiting on the chip) and the next checkpoint raises OrderAborted naming the
+phase that overran.
+"""
+
+import contextlib
+import threading
+import time
+
+ORDER_BUDGET = 600.0            # Seconds an order may take from start to delivery
+
+# Seconds each phase may take every time it runs (capped by what is left of ORDER_BUDGET)
+PHASE_BUDGETS = {
+    'prepare': 10.0,            # Stock and lane checks, planning
+    'pickup_wait': 300.0,       # Waiting for the platform to be cleared
+    'move': 30.0,               # Moving the platform to a row
+    'drop': 60.0,               # Dropping one batch of items, jam retries included
+    'deliver': 30.0,            # Returning the platform and starting the pickup monitor
+}
+DEFAULT_PHASE_BUDGET = 30.0
+
+
+class OrderAborted(Exception):
+    """Raised at a checkpoint once the watchdog has fired"""
+
+    def __init__(self, phase:str, elapsed:float, budget:float):
+        super().__init__("Phase '{}' overran its {:.1f} second budget".format(phase, budget))
+        self.phase = phase
+        self.elapsed = elapsed          # Seconds into the order when the watchdog fired
+        self.budget = budget            # Seconds the phase was given (less if the order deadline was closer)
+
+
+class OrderWatchdog:
+    """Deadline for one order, split into phase budgets and enforced from a background thread"""
+
+    def __init__(self, budget:float=ORDER_BUDGET, phases:dict=PHASE_BUDGETS, abort_hooks:list=None):
+        """
+        :param abort_hooks: callables run (from the watchdog thread) when a deadline passes--each
+                            should make a blocking motor or sensor call return early
+        """
+        self.budget = budget
+        self.phases = phases
+        self.abort_hooks = list(abort_hooks) if abort_hooks is not None else []
+
+        self.cond = threading.Condition()
+        self.start_time = None
+        self.phase_name = None
+        self.phase_budget = None
+        self.deadline = None            # Monotonic deadline of the current phase
+        self.fired = None               # OrderAborted once the watchdog has fired
+        self.durations = {}             # Phase -> seconds spent in it
+        self.stopping = False
+        self.thread = None
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.deadline = self.start_time + self.budget
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+    def remaining(self) -> float:
+        """Seconds left in the current phase"""
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    @contextlib.contextmanager
+    def phase(self, name:str):
+        """Runs a block as a phase of the order, raising OrderAborted when it (or an inner phase) overran"""
+        self.check()
+        now = time.monotonic()
+        budget = self.phases.get(name, DEFAULT_PHASE_BUDGET)
+        with self.cond:
+            outer = (self.phase_name, self.phase_budget, self.deadline)
+            self.phase_name = name
+            self.deadline = min(now + budget, self.start_time + self.budget, outer[2])
+            self.phase_budget = self.deadline - now
+            self.cond.notify_all()
+
+        try:
+            yield self
+        except Exception as e:
+            # Errors from calls cut short by an abort hook are reported as the abort
+            if self.fired is not None and not isinstance(e, OrderAborted):
+                raise self.fired from e
+            raise
+        finally:
+            with self.cond:
+                self.phase_name, self.phase_budget, self.deadline = outer
+                self.durations[name] = self.durations.get(name, 0.0) + time.monotonic() - now
+                self.cond.notify_all()
+        self.check()
+
+    def check(self):
+        """Checkpoint: raises OrderAborted if the watchdog has fired"""
+        if self.fired is not None:
+            raise self.fired
+
+    def report(self) -> dict:
+        return {name: round(seconds, 3) for name, seconds in self.durations.items()}
+
+    def _run(self):
+        with self.cond:
+            while not self.stopping and self.fired is None:
+                remaining = self.deadline - time.monotonic()
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                    continue
+
+                name = self.phase_name if self.phase_name is not None else 'order'
+                budget = self.phase_budget if self.phase_budget is not None else self.budget
+                self.fired = OrderAborted(name, time.monotonic() - self.start_time, budget)
+
+        if self.fired is not None:
+            print("Order watchdog fired: {}".format(self.fired))
+            for hook in self.abort_hooks:
+                hook()
@@ -0,0 +1,121 @@
+"""
+Watches the weight on the platform in the background after a delivery and reports when the items
+have been taken, so nothing else has to block while the customer reaches in.
+"""
+
+import threading
+import time
+
+# Pickup states
+PENDING = "PENDING"             # Items are still (at least partly) on the platform
+RECEIVED = "RECEIVED"           # All of the delivered weight has been removed
+CANCELLED = "CANCELLED"         # Monitoring was stopped before the items were taken
+
+POLL_INTERVAL = 0.25            # Seconds between weight checks
+PICKUP_SAMPLES = 4              # HX711 samples averaged per weight check
+PICKUP_TIMEOUT = 120            # Seconds before the customer is reported as not picking up
+PARTIAL_STEP = 5                # Grams that must come off the platform to report a partial pickup
+
+
+class PickupMonitor:
+    """
+    Polls the weight sensor from a background thread until the expected weight has been removed
+    from the platform. Callbacks are run from the monitor thread:
+    - on_partial(removed): some, but not all, of the weight has been removed
+    - on_timeout(removed): nothing conclusive happened within the timeout (monitoring continues)
+    - on_complete(state, removed): the items were taken or monitoring was cancelled
+    Readings the sensor cannot vouch for (see WeightSensor_HX711.read_grams) are skipped, never taken
+    as an empty platform. If the starting weight cannot be read, it is taken from the first good
+    reading; until then nothing can be detected and the pickup simply times out.
+    """
+
+    def __init__(self, sensor, expected_weight:float, timeout:float=PICKUP_TIMEOUT,
+                 poll_interval:float=POLL_INTERVAL, num_samples:int=PICKUP_SAMPLES,
+                 on_complete=None, on_partial=None, on_timeout=None):
+        self.sensor = sensor
+        self.expected_weight = expected_weight      # Minimum grams to be removed for a pickup
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.num_samples = num_samples
+
+        self.on_complete = on_complete
+        self.on_partial = on_partial
+        self.on_timeout = on_timeout
+
+        self.state = PENDING
+        self.removed = 0                # Grams removed from the platform so far
+        self.samples = []               # Every weight reading taken, in grams
+        self.baseline = None            # Grams on the platform when monitoring started
+        self.bad_reads = 0              # Readings skipped as failed or untrustworthy
+        self.timed_out = False
+
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Takes the starting weight of the platform and starts monitoring"""
+        self.baseline = self._read()
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        """Stops monitoring without the items being taken"""
+        self._cancel.set()
+
+    def wait(self, timeout:float=None) -> str:
+        """Blocks for up to timeout seconds for monitoring to finish and returns the current state"""
+        self._done.wait(timeout)
+        return self.state
+
+    @property
+    def pending(self) -> bool:
+        return self.state == PENDING
+
+    def _run(self):
+        reported = 0
+
+        # Waiting on the cancel event doubles as the sleep between polls
+        while not self._cancel.wait(self.poll_interval):
+            # A read that timed out (or was aborted) or cannot be trusted is skipped, the monitor keeps going
+            grams = self._read()
+            if grams is not None:
+                if self.baseline is None:
+                    self.baseline = grams
+                self.samples.append(grams)
+                self.removed = self.baseline - grams
+
+                if self.removed >= self.expected_weight:
+                    self._finish(RECEIVED)
+                    return
+
+                if self.removed - reported >= PARTIAL_STEP:
+                    reported = self.removed
+                    if self.on_partial is not None:
+                        self.on_partial(self.removed)
+
+            if not self.timed_out and time.monotonic() - self.started > self.timeout:
+                self.timed_out = True
+                if self.on_timeout is not None:
+                    self.on_timeout(self.removed)
+
+        self._finish(CANCELLED)
+
+    def _read(self):
+        """Returns the grams on the platform, or None if the sensor failed or gave no valid samples"""
+        try:
+            grams = self.sensor.read_grams(self.num_samples, verbose=False)
+        except OSError as e:
+            grams = None
+            print("Pickup weight check failed: {}".format(e))
+        if grams is None:
+            self.bad_reads += 1
+        return grams
+
+    def _finish(self, state:str):
+        self.state = state
+        if self.on_complete is not None:
+            self.on_complete(state, self.removed)
+        self._done.set()
@@ -0,0 +1,96 @@
+"""
+Capacity accounting for the platform. PlatformLoad keeps the items on the platform together with
+running totals of their weight and volume, so capacity checks never re-sum the items. plan_loads
+splits an order into platform loads ahead of time (first-fit decreasing bin packing over weight and
+volume), so the trips to hand items over mid-order are known before anything is dropped.
+profile_index picks the platform speed profile for a load.
+"""
+
+import bisect
+import math
+
+
+class PlatformLoad:
+    """The items on the platform, with running totals of their weight, minimum weight and volume"""
+
+    def __init__(self, items:list=()):
+        self.items = []
+        self.weight = 0.0               # Nominal grams on the platform
+        self.min_weight = 0.0           # Grams on the platform if every item is at its lightest
+        self.volume = 0.0
+        self.extend(items)
+
+    def append(self, item):
+        self.items.append(item)
+        self.weight += item.weight
+        self.min_weight += item.min_weight
+        self.volume += item.volume
+
+    def extend(self, items:list):
+        for item in items:
+            self.append(item)
+
+    def clear(self):
+        self.items = []
+        self.weight = 0.0
+        self.min_weight = 0.0
+        self.volume = 0.0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __repr__(self):
+        return "PlatformLoad({} items, {:.1f} g, {:.1f} volume)".format(len(self.items), self.weight, self.volume)
+
+
+def profile_index(limits:list, load:float, empty_tol:float=0) -> int:
+    """
+    Index of the speed profile for a load, given the upper load limit of every profile in increasing
+    order. Loads up to empty_tol count as an empty platform and loads over the last limit get the last
+    profile.
+    """
+    if load <= empty_tol:
+        load = 0
+    return min(bisect.bisect_left(limits, load), len(limits) - 1)
+
+def units_that_fit(item, weight:float, volume:float) -> int:
+    """Number of units of an item that fit in the given weight and volume"""
+    return max(min(math.floor(weight / item.weight), math.floor(volume / item.volume)), 0)
+
+def plan_loads(items:list, max_weight:float, max_volume:float, used_weight:float=0, used_volume:float=0):
+    """
+    Splits the units of the items into platform loads, heaviest items first, each placed in the first
+    load with room for it. The first load starts with used_weight and used_volume already on the
+    platform, and is empty when none of the items fit next to what is there (the platform has to be
+    cleared first). Returns a list of {item: units} (one per trip), or None if a single unit of an item
+    does not fit on an empty platform.
+    """
+    loads = [{}]
+    room = [[max_weight - used_weight, max_volume - used_volume]]
+
+    for item in sorted(items, key=lambda i: (i.weight, i.volume), reverse=True):
+        left = item.quantity
+        for load, free in zip(loads, room):
+            if left <= 0:
+                break
+            units = min(units_that_fit(item, free[0], free[1]), left)
+            if units > 0:
+                load[item] = load.get(item, 0) + units
+                free[0] -= units * item.weight
+                free[1] -= units * item.volume
+                left -= units
+
+        per_load = units_that_fit(item, max_weight, max_volume)
+        if left > 0 and per_load == 0:
+            return None
+        while left > 0:
+            units = min(per_load, left)
+            loads.append({item: units})
+            room.append([max_weight - units * item.weight, max_volume - units * item.volume])
+            left -= units
+
+    # Only the first trip can be empty, and it is kept so that loads[0] is always the current trip
+    return loads
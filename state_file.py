@@ -0,0 +1,35 @@
+"""
+Crash-safe writes of the controller's state files (calibration, inventory, lane model, lane health, the
+MQTT outbox).
+"""
+
+import json
+import os
+
+
+def atomic_write_json(path:str, obj, indent:int=None):
+    """Writes obj as JSON to path so that a crash or power cut leaves either the old or the new file"""
+    atomic_write(path, json.dumps(obj, indent=indent))
+
+
+def atomic_write(path:str, text:str):
+    """Writes text to path so that a crash or power cut leaves either the old or the new file"""
+    # Write to a temporary file first, flushed to the card before it replaces the old file
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+    # Make the rename itself durable
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
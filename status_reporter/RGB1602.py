@@ -7,8 +7,8 @@ Source: https://www.waveshare.net/w/upload/5/5b/LCD1602-RGB-Module-demo.zip
 
 # -*- coding: utf-8 -*-
 import time
-from smbus import SMBus
-b = SMBus(1)
+
+I2C_BUS = 1
 
 #Device I2C Arress
 LCD_ADDRESS   =  (0x7c>>1)
@@ -60,7 +60,12 @@ LCD_5x8DOTS = 0x00
 
 
 class RGB1602:
-  def __init__(self, col, row):
+  def __init__(self, col, row, bus=None):
+    # The bus is opened here rather than at import so that a fake SMBus can be passed in for tests
+    if bus is None:
+      from smbus import SMBus
+      bus = SMBus(I2C_BUS)
+    self._bus = bus
     self._row = row
     self._col = col
     self._showfunction = LCD_4BITMODE | LCD_1LINE | LCD_5x8DOTS;
@@ -68,13 +73,13 @@ class RGB1602:
 
         
   def command(self,cmd):
-    b.write_byte_data(LCD_ADDRESS,0x80,cmd)
+    self._bus.write_byte_data(LCD_ADDRESS,0x80,cmd)
 
   def write(self,data):
-    b.write_byte_data(LCD_ADDRESS,0x40,data)
+    self._bus.write_byte_data(LCD_ADDRESS,0x40,data)
     
   def setReg(self,reg,data):
-    b.write_byte_data(RGB_ADDRESS,reg,data)
+    self._bus.write_byte_data(RGB_ADDRESS,reg,data)
 
 
   def setRGB(self,r,g,b):
@@ -0,0 +1,124 @@
+"""
+Background status display for the RGB1602 LCD. Callers update a 16x2 framebuffer and return at once;
+a background thread diffs the framebuffer against what is on the screen and only writes the cells
+that changed, at a capped refresh rate, so the dispense path never waits on I2C.
+"""
+
+import threading
+import time
+
+try:
+    from status_reporter import RGB1602
+except ImportError:
+    import RGB1602
+
+COLS = 16
+ROWS = 2
+MAX_FPS = 4                     # Most screen updates per second
+
+# Characters outside ASCII that the LCD character ROM (A00) can show
+CHAR_MAP = {'•': 0xA5, '·': 0xA5, '°': 0xDF}
+UNKNOWN_CHAR = ord('?')
+
+
+def char_code(c:str) -> int:
+    """Returns the LCD character code for a character"""
+    code = ord(c)
+    if 32 <= code < 127:
+        return code
+    return CHAR_MAP.get(c, UNKNOWN_CHAR)
+
+
+class StatusDisplay:
+    """Framebuffer for the LCD that is rendered from a background thread"""
+
+    def __init__(self, lcd=None, bus=None, cols:int=COLS, rows:int=ROWS, max_fps:float=MAX_FPS):
+        """
+        :param lcd: RGB1602-compatible display to draw on (created on the given bus if not given)
+        :param bus: SMBus-compatible bus for the display, e.g. a fake that records writes
+        """
+        self.lcd = lcd if lcd is not None else RGB1602.RGB1602(cols, rows, bus=bus)
+        self.cols = cols
+        self.rows = rows
+        self.min_interval = 1 / max_fps
+
+        self.frame = [[ord(' ')] * cols for r in range(rows)]      # What should be on the screen
+        self.shown = [[None] * cols for r in range(rows)]          # What was last written (None = unknown)
+        self.color = None
+        self.shown_color = None
+
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread = None
+        self.cells_written = 0
+
+    def set_line(self, row:int, text:str):
+        """Replaces one line of the framebuffer (padded or cut to the width of the screen)"""
+        codes = [char_code(c) for c in str(text)[:self.cols].ljust(self.cols)]
+        with self.lock:
+            self.frame[row] = codes
+        self.wake.set()
+
+    def show(self, *lines):
+        """Replaces the whole framebuffer, one string per line"""
+        for row in range(self.rows):
+            self.set_line(row, lines[row] if row < len(lines) else "")
+
+    def set_color(self, r:int, g:int, b:int):
+        with self.lock:
+            self.color = (r, g, b)
+        self.wake.set()
+
+    def render(self) -> int:
+        """Writes the cells that differ from what is on the screen. Returns the number written"""
+        with self.lock:
+            frame = [list(line) for line in self.frame]
+            color = self.color
+
+        if color is not None and color != self.shown_color:
+            self.lcd.setRGB(*color)
+            self.shown_color = color
+
+        written = 0
+        for row in range(self.rows):
+            col = 0
+            while col < self.cols:
+                if frame[row][col] == self.shown[row][col]:
+                    col += 1
+                    continue
+
+                # Position the cursor once per run of changed cells, it advances on every write
+                self.lcd.setCursor(col, row)
+                while col < self.cols and frame[row][col] != self.shown[row][col]:
+                    self.lcd.write(frame[row][col])
+                    self.shown[row][col] = frame[row][col]
+                    written += 1
+                    col += 1
+
+        self.cells_written += written
+        return written
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        while not self.stopping:
+            self.wake.wait()
+            self.wake.clear()
+            start = time.monotonic()
+            try:
+                self.render()
+            except OSError as e:
+                print("Status display write failed: {}".format(e))
+
+            # Cap the refresh rate--updates made in the meantime are merged into the next render
+            time.sleep(max(0, self.min_interval - (time.monotonic() - start)))
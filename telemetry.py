@@ -0,0 +1,130 @@
+"""
+Telemetry publisher for fleet monitoring. Events (order timings, drop results, motor step counts,
+downsampled weight traces) are queued in memory and sent from a background thread as compressed
+batches on their own topic, at a low QoS and a capped rate, so the control loop never waits on the
+network. Queued events are dropped (oldest first) rather than blocking when the queue is full.
+
+The client only needs a paho-style publish(topic, payload=..., qos=...) method, so any stand-in
+that records its calls can be used in place of a real MQTT client.
+"""
+
+import collections
+import json
+import threading
+import time
+import zlib
+
+TELEMETRY_QOS = 0
+BATCH_SIZE = 50                 # Events per published batch
+FLUSH_INTERVAL = 5.0            # Seconds after which a partial batch is sent anyway
+MAX_RATE = 1.0                  # Batches per second allowed on average
+BURST = 3                       # Batches that may be sent back to back
+MAX_QUEUE = 1000                # Events kept while waiting to be sent
+TRACE_POINTS = 50               # Points kept when downsampling a weight trace
+
+
+def downsample(samples:list, max_points:int=TRACE_POINTS) -> list:
+    """Reduces a list of numbers to at most max_points by averaging equal-sized buckets"""
+    if len(samples) <= max_points:
+        return list(samples)
+
+    step = len(samples) / max_points
+    points = []
+    for i in range(max_points):
+        bucket = samples[int(i * step):int((i + 1) * step)]
+        points.append(sum(bucket) / len(bucket))
+    return points
+
+def encode_batch(events:list) -> bytes:
+    return zlib.compress(json.dumps(events, separators=(',', ':')).encode())
+
+def decode_batch(payload:bytes) -> list:
+    """Turns a published telemetry payload back into its list of events"""
+    return json.loads(zlib.decompress(payload).decode())
+
+
+class TelemetryPublisher:
+    """Batches, compresses, and rate limits telemetry events on a separate topic"""
+
+    def __init__(self, client, topic:str, qos:int=TELEMETRY_QOS, batch_size:int=BATCH_SIZE,
+                 flush_interval:float=FLUSH_INTERVAL, max_rate:float=MAX_RATE, burst:int=BURST,
+                 max_queue:int=MAX_QUEUE):
+        self.client = client
+        self.topic = topic
+        self.qos = qos
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_rate = max_rate
+        self.burst = burst
+
+        self.queue = collections.deque(maxlen=max_queue)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread = None
+
+        self.tokens = burst             # Token bucket for the publish rate
+        self.last_refill = time.monotonic()
+        self.sent = 0                   # Batches published
+        self.dropped = 0                # Events lost because the queue was full
+
+    def emit(self, kind:str, **fields):
+        """Queues an event--never blocks on the network"""
+        fields['kind'] = kind
+        fields['t'] = round(time.time(), 3)
+        with self.lock:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(fields)
+            full = len(self.queue) >= self.batch_size
+
+        if full:
+            self.wake.set()
+
+    def trace(self, name:str, samples:list, **fields):
+        """Queues a downsampled weight trace"""
+        self.emit('trace', name=name, n=len(samples), points=[round(p, 2) for p in downsample(samples)], **fields)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops the background thread after sending whatever is still queued"""
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def flush(self) -> bool:
+        """Sends one batch if the rate limit allows it. Returns whether anything was sent"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.max_rate)
+        self.last_refill = now
+        if self.tokens < 1:
+            return False
+
+        with self.lock:
+            batch = [self.queue.popleft() for i in range(min(self.batch_size, len(self.queue)))]
+        if len(batch) == 0:
+            return False
+
+        self.tokens -= 1
+        self.client.publish(self.topic, payload=encode_batch(batch), qos=self.qos)
+        self.sent += 1
+        return True
+
+    def _run(self):
+        while not self.stopping:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+
+            # Keep sending full batches while the rate limit allows it
+            while self.flush() and len(self.queue) >= self.batch_size:
+                pass
+
+        # Send what is left on the way out, ignoring the rate limit
+        while len(self.queue) > 0:
+            self.tokens = 1
+            self.flush()
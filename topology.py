@@ -0,0 +1,118 @@
+"""
+Machine topology: where each row sits, and which channel, expander and pins drive the lane at every
+row and column. The topology is read from topology.json once at import and turned into lookup tables,
+so the rest of the code (and the native ItemLaneSystem, through native_tables()) never works out
+channels or pins with arithmetic. A bigger cabinet only needs a new topology file.
+
+Lanes with the same slot on different expanders can turn together (see dispense_planner); those
+groups are precomputed too.
+"""
+
+import json
+import os
+
+TOPOLOGY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "topology.json")
+TOPOLOGY_VERSION = 1
+
+PINS_PER_LANE = 4               # Coil pins of one lane stepper (ItemLaneSystem.cpp PINS_PER_MOTOR)
+PINS_PER_EXPANDER = 16          # Output pins of one MCP23017
+
+
+class TopologyError(ValueError):
+    """Raised when a topology file cannot be used"""
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class Topology:
+    """Lookup tables built from a topology description"""
+
+    def __init__(self, info:dict):
+        if info.get('version') != TOPOLOGY_VERSION:
+            raise TopologyError("Unsupported topology version {!r}".format(info.get('version')))
+
+        try:
+            self.zero_position = info.get('zero_position', 0)
+            self.row_positions = {int(r['row']): float(r['position']) for r in info['rows']}
+            self.expanders = [(int(e['address']), int(e['pin_base'])) for e in info['expanders']]
+            lanes = sorted(info['lanes'], key=lambda lane: lane['channel'])
+        except (KeyError, TypeError, ValueError) as e:
+            raise TopologyError("Malformed topology: {}".format(e))
+
+        self.channels = {}              # (row, column) -> channel
+        self.lane_positions = {}        # Channel -> (row, column)
+        self.expander_of = {}           # Channel -> expander index
+        self.lane_pins = {}             # Channel -> expander pins of the coils
+        self.slot_of = {}               # Channel -> position of the lane among its expander's lanes
+
+        for i, lane in enumerate(lanes):
+            try:
+                ch, row, col, exp = lane['channel'], lane['row'], lane['column'], lane['expander']
+                pins = list(lane['pins'])
+            except (KeyError, TypeError) as e:
+                raise TopologyError("Malformed lane {!r}: missing or invalid {}".format(lane, e))
+            if not all([_is_int(v) for v in [ch, row, col, exp] + pins]):
+                raise TopologyError("Lane {!r} has a channel, row, column, expander or pin that is not an integer".format(lane))
+            if ch != i:
+                raise TopologyError("Lane channels must run from 0 without gaps, missing {}".format(i))
+            if row not in self.row_positions:
+                raise TopologyError("Lane {} is in row {} which has no position".format(ch, row))
+            if (row, col) in self.channels:
+                raise TopologyError("Row {} column {} has two lanes".format(row, col))
+            if not 0 <= exp < len(self.expanders):
+                raise TopologyError("Lane {} is on unknown expander {}".format(ch, exp))
+            if len(pins) != PINS_PER_LANE or not all([0 <= p < PINS_PER_EXPANDER for p in pins]):
+                raise TopologyError("Lane {} needs {} expander pins, got {}".format(ch, PINS_PER_LANE, pins))
+
+            self.channels[(row, col)] = ch
+            self.lane_positions[ch] = (row, col)
+            self.expander_of[ch] = exp
+            self.lane_pins[ch] = list(pins)
+            self.slot_of[ch] = sum([1 for c in self.expander_of if self.expander_of[c] == exp]) - 1
+
+        for exp in range(len(self.expanders)):
+            used = [p for ch in self.lane_pins if self.expander_of[ch] == exp for p in self.lane_pins[ch]]
+            if len(set(used)) != len(used):
+                raise TopologyError("Lanes share pins on expander {}".format(exp))
+
+        # Row -> channels of its lanes by column (columns counted from 1 without gaps)
+        self.rows = sorted(self.row_positions)
+        if self.rows != list(range(1, len(self.rows) + 1)):
+            raise TopologyError("Rows must run from 1 without gaps, got {}".format(self.rows))
+        self.motor_channels = []
+        for row in self.rows:
+            cols = sorted([c for r, c in self.channels if r == row])
+            if cols != list(range(1, len(cols) + 1)):
+                raise TopologyError("Columns of row {} must run from 1 without gaps".format(row))
+            self.motor_channels.append([self.channels[(row, c)] for c in cols])
+
+        # Lanes in the same slot are on different expanders, so every group can turn together
+        slots = max(self.slot_of.values(), default=-1) + 1
+        self.parallel_groups = [[ch for ch in self.slot_of if self.slot_of[ch] == s] for s in range(slots)]
+
+    @property
+    def num_lanes(self) -> int:
+        return len(self.lane_positions)
+
+    def native_tables(self) -> tuple:
+        """
+        Arguments for the ItemLaneSystem constructor: expander addresses, expander pin bases, and
+        for every channel [expander, coil pins...]
+        """
+        return ([addr for addr, base in self.expanders], [base for addr, base in self.expanders],
+                [[self.expander_of[ch]] + self.lane_pins[ch] for ch in range(self.num_lanes)])
+
+
+def load_topology(path:str=TOPOLOGY_FILE) -> Topology:
+    try:
+        with open(path, "r") as f:
+            info = json.load(f)
+    except ValueError as e:
+        raise TopologyError("{} is not valid JSON: {}".format(path, e))
+    return Topology(info)
+
+
+# Loaded once, every module uses the same tables
+TOPOLOGY = load_topology()
@@ -0,0 +1,95 @@
+"""
+Attributes a change in weight on the platform to the set of items that most likely caused it.
+
+Every combination of N expected weights is summed once into a sorted index, so matching an
+observed change only has to look at the handful of sums near it instead of all 2^N combinations.
+Each weight comes with a tolerance that is treated as two standard deviations of its variation,
+which turns the distance between the observed change and a combination into a likelihood.
+"""
+
+import bisect
+import math
+
+
+class SubsetIndex:
+    """Sorted index of the subset sums of a group of expected weights"""
+
+    def __init__(self, weights:list, tolerances:list, empty_tol:float):
+        """
+        :param weights: expected weight (grams) of each item
+        :param tolerances: allowed variation (grams) around each expected weight
+        :param empty_tol: allowed variation (grams) when nothing was added (sensor noise)
+        """
+        self.size = len(weights)
+        self.full_mask = (1 << self.size) - 1
+
+        entries = []
+        for mask in range(1 << self.size):
+            total = 0
+            margin = 0
+            for i in range(self.size):
+                if mask & (1 << i):
+                    total += weights[i]
+                    margin += tolerances[i]
+            entries.append((total, margin if mask else empty_tol, mask))
+        entries.sort()
+
+        self.sums = [e[0] for e in entries]
+        self.margins = [e[1] for e in entries]
+        self.masks = [e[2] for e in entries]
+        self.max_margin = max(self.margins)
+
+    def unambiguous(self) -> bool:
+        """Checks that no two subsets have overlapping tolerance windows"""
+        for k in range(1, len(self.sums)):
+            if self.sums[k] - self.margins[k] <= self.sums[k-1] + self.margins[k-1]:
+                return False
+
+        return True
+
+    def attribute(self, delta:float, pending:int=None):
+        """
+        Finds the subset that most likely produced the observed change in weight.
+        :param delta: observed change in weight (grams)
+        :param pending: bit mask of the items that could still have dropped (default all of them)
+        :return (mask, confidence), where mask is None if no subset is within its tolerance and
+                confidence is the share of the likelihood held by the chosen subset
+        """
+        if pending is None:
+            pending = self.full_mask
+
+        lo = bisect.bisect_left(self.sums, delta - self.max_margin)
+        hi = bisect.bisect_right(self.sums, delta + self.max_margin)
+
+        best = None
+        best_score = 0
+        total_score = 0
+        for k in range(lo, hi):
+            if self.masks[k] & ~pending:
+                continue
+
+            err = delta - self.sums[k]
+            sigma = self.margins[k] / 2
+            score = math.exp(-0.5 * (err / sigma) ** 2) if sigma > 0 else float(err == 0)
+            total_score += score
+
+            if abs(err) <= self.margins[k] and score > best_score:
+                best = self.masks[k]
+                best_score = score
+
+        if best is None:
+            return (None, 0.0)
+
+        return (best, best_score / total_score)
+
+def mask_to_indices(mask:int) -> list:
+    """Returns the positions of the set bits of a subset mask"""
+    indices = []
+    i = 0
+    while mask:
+        if mask & 1:
+            indices.append(i)
+        mask >>= 1
+        i += 1
+
+    return indices
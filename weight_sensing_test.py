@@ -1,8 +1,8 @@
-from torch import true_divide
 from weight_sensor import *
 from movement import platform_stepper as ps
 import time
 import csv
+from os.path import exists as path_exists
 
 def test_round_dif_items(num_trials:int, sensor):
     total_error = 0
@@ -198,11 +198,11 @@ def time_to_zero(sensor, num_items:int, trials_per_item:int=3):
             input("Place the item on the platform. Press any key to continue.\n>")
             start = time.time()
             # let the item sit for three seconds
-            while (time.time < start + 3):
+            while (time.time() < start + 3):
                 pass
             input("Remove the item from the platform. Press any key to continue.\n>")
             start = time.time()
-            while (sensor.get_grams > 0):
+            while (sensor.get_grams(verbose=False) > 0):
                 pass
             elapsed_time = time.time() - start
             print("\tElapsed time to return to zero: {}".format(elapsed_time))
@@ -212,6 +212,22 @@ def time_to_zero(sensor, num_items:int, trials_per_item:int=3):
         print("-----Now testing with item {}.-----".format(i))
         trial()
     
+def record_trace(sensor, reference:float, seconds:float, path:str):
+    """Records raw readings for a known mass placed on the platform, appending them to a trace CSV
+    for `python3 calibration.py` (columns: time since placement, raw reading, reference grams).
+    """
+    new_file = not path_exists(path)
+    rows = []
+    start = time.monotonic()
+    while (time.monotonic() - start < seconds):
+        rows.append([round(time.monotonic() - start, 4), sensor.read(), reference])
+
+    with open(path, 'a', newline='') as f:
+        write = csv.writer(f)
+        if new_file:
+            write.writerow(['time', 'raw', 'reference'])
+        write.writerows(rows)
+
 def get_grams_continuous(sensor):
     """Continuously reads the weight in grams that is on the platform."""
     sensor.calibrate()
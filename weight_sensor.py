@@ -5,10 +5,25 @@
 # HX711 datasheet: https://cdn.sparkfun.com/datasheets/Sensors/ForceFlex/hx711_english.pdf
 # Adapted from https://github.com/j-dohnalek/hx711py/blob/master/hx711.py
 
-import RPi.GPIO as GPIO
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None     # Off the Pi only trace replay (weight_trace.ReplaySensor) is available
+import threading
 import time
 from movement.lane_stepper import *
 
+READ_TIMEOUT = 0.5      # Seconds to wait for the HX711 to have data (it samples at 10 or 80 Hz)
+READY_POLL = 0.001      # Seconds between checks for data--the wait must leave the CPU to the stepper loops
+
+class SensorTimeout(OSError):
+    """Raised when the HX711 has no data within the read timeout, or a wait for it is aborted"""
+    pass
+
+class SensorFault(OSError):
+    """Raised when the HX711 gives readings that cannot come from a working load cell"""
+    pass
+
 class WeightSensor_HX711:
 
     def __init__(self, dout, pd_sck, gain=128, MAX_CAP=100, MIN_CAP=0):
@@ -24,8 +39,15 @@ class WeightSensor_HX711:
         self.MAX_CAP = MAX_CAP
         self.MIN_CAP = MIN_CAP
         self.scale_ready = False
+        self.quality = {}          # Metrics of the last calibration (saved with it)
 
         self.prev_read = 0         # Holds a previous read value for comparison
+        self.recorder = None       # Optional weight_trace.TraceRecorder logging every raw reading
+        self.read_timeout = READ_TIMEOUT
+        self.aborting = threading.Event()   # Set by abort() to end a wait for the chip straight away
+
+        # Serializes reads so that background monitors and the dispense path can share the chip
+        self.lock = threading.RLock()
 
         # Setup the gpio pin numbering system
         GPIO.setmode(GPIO.BCM)
@@ -44,6 +66,26 @@ class WeightSensor_HX711:
         self.set_gain(gain)
         #time.sleep(1)
 
+    def __getstate__(self):
+        # Locks cannot be pickled, so drop it from the saved calibration state
+        state = self.__dict__.copy()
+        state.pop('lock', None)
+        state.pop('aborting', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        self.aborting = threading.Event()
+        self.read_timeout = state.get('read_timeout', READ_TIMEOUT)
+
+    def abort(self):
+        """Makes reads waiting on the chip (and new ones, until clear_abort()) raise SensorTimeout"""
+        self.aborting.set()
+
+    def clear_abort(self):
+        self.aborting.clear()
+
     def is_ready(self):
         """
         Returns if data is ready.
@@ -114,21 +156,29 @@ class WeightSensor_HX711:
         return: 24 bit value read from HX711
         """
         byte_vals = []
-        while not self.is_ready():
-            pass
-
-        # Read 3 bytes
-        for i in range(3):
-            count = 0
-            # Read 8 bits (MSB)
-            for ii in range(8):
-                count <<= 1
-                count |= self.read_bit()
-            byte_vals.append(count)
-
-        for i in range(self.GAIN):
-            GPIO.output(self.PD_SCK, True)
-            GPIO.output(self.PD_SCK, False)
+        with self.lock:
+            # A chip that never has data (unplugged, powered down) must not hang the caller
+            deadline = time.monotonic() + self.read_timeout
+            while not self.is_ready():
+                # Sleeps between checks (waking at once on an abort) rather than spinning, since the
+                # sampler thread waits here for the whole of an order, platform moves included
+                if self.aborting.wait(READY_POLL):
+                    raise SensorTimeout("HX711 read aborted")
+                if time.monotonic() > deadline:
+                    raise SensorTimeout("HX711 had no data within {} seconds".format(self.read_timeout))
+
+            # Read 3 bytes
+            for i in range(3):
+                count = 0
+                # Read 8 bits (MSB)
+                for ii in range(8):
+                    count <<= 1
+                    count |= self.read_bit()
+                byte_vals.append(count)
+
+            for i in range(self.GAIN):
+                GPIO.output(self.PD_SCK, True)
+                GPIO.output(self.PD_SCK, False)
 
         # Combine bytes (MSB)
         value = ((byte_vals[0] << 16) | (byte_vals[1] << 8) | byte_vals[2])
@@ -136,6 +186,9 @@ class WeightSensor_HX711:
         # Convert from 2's complement
         value = -(value & 0x800000) + (value & 0x7fffff)
 
+        if self.recorder is not None:
+            self.recorder.sample(value)
+
         return int(value)
 
     def warmup(self, minutes=3):
@@ -179,25 +232,42 @@ class WeightSensor_HX711:
         else:
             return 0
 
-    def get_grams(self, num_samples=16):
+    def get_grams(self, num_samples=16, verbose=True):
         """
         :param times: Set value to calculate average,
         be aware that high number of times will have a
         slower runtime speed.
+        :param verbose: print every sample (disable for background polling)
         :return float weight in grams
         """
+        grams = self.read_grams(num_samples, verbose)
+        return grams if grams is not None else 0
+
+    def read_grams(self, num_samples=16, verbose=False):
+        """
+        Same as get_grams, but returns None instead of 0 when the reading cannot be trusted: every
+        sample was outside MIN_CAP..MAX_CAP, or (with several samples) every raw value was the same,
+        as a stuck chip returns while a working one always shows a few counts of noise.
+        """
         s = 0
         samples = 0
+        raws = set()
         for i in range(num_samples):
-            val = (self.read()-self.OFFSET)/self.SCALE
+            raw = self.read()
+            raws.add(raw)
+            val = (raw-self.OFFSET)/self.SCALE
             # Account for extreme outliers
             if (val > self.MIN_CAP and val < self.MAX_CAP):
                 samples += 1
                 s += val
-            print("val: {}".format(val))
-        print("Num samples: {}".format(samples))
-        grams = s/samples if samples > 0 else 0
-        print("grams: {}".format(grams))
+            if verbose:
+                print("val: {}".format(val))
+        grams = s/samples if samples > 0 else None
+        if num_samples > 1 and len(raws) == 1:
+            grams = None
+        if verbose:
+            print("Num samples: {}".format(samples))
+            print("grams: {}".format(grams))
         return grams
 
     def calc_offset(self, num_samples=16):
@@ -230,17 +300,23 @@ class WeightSensor_HX711:
         while not self.is_ready():
             pass
         readyCheck = input("Remove any items from platform. Press any key when ready.")
-        offset = self.read_average(num_samples)
+        zero_reads = [self.read() for i in range(num_samples)]
+        offset = sum(zero_reads) / num_samples
         print("Value at zero (offset): {}".format(offset))
         self.set_offset(offset)
         print("Please place an item of known weight on the scale.")
         item_weight = input("Please enter the item's weight in grams.\n>")
         measured_weight = (self.read_average()-self.get_offset())
-        print("Measured weight: ".format(measured_weight))
+        print("Measured weight: {}".format(measured_weight))
         scale = (measured_weight)/float(item_weight)
         self.set_scale(scale)
         print("Scale adjusted for grams: {}".format(scale))
 
+        # Spread of the raw readings at zero, in grams, tells how far a single read can be trusted
+        noise = (sum([(r - offset) ** 2 for r in zero_reads]) / num_samples) ** 0.5
+        self.quality = {'zero_noise': abs(noise / scale), 'reference_weight': float(item_weight),
+                        'num_samples': num_samples}
+
 
     def power_down(self):
         """
@@ -0,0 +1,220 @@
+"""
+Raw weight traces. TraceRecorder logs every HX711 reading with a monotonic timestamp, along with
+annotations of what the machine was doing (lanes fired, platform moving, items expected), to a
+compact binary file. ReplaySensor plays a trace back as a WeightSensor_HX711, as fast as the
+consumer reads or at a chosen speed, so drop detection and filtering can be run on a laptop:
+
+    python3 weight_trace.py <trace file> [speed]
+
+File layout (little endian): b"WTRC", u16 version, u32 header length, JSON header (calibration and
+start time), then records. A sample is u8 0, f64 seconds since the start, i32 raw reading (13 bytes).
+An annotation is u8 1, f64 seconds since the start, u16 length, JSON {"kind": ..., fields...}.
+"""
+
+import json
+import struct
+import threading
+import time
+
+from weight_sensor import WeightSensor_HX711
+
+TRACE_MAGIC = b"WTRC"
+TRACE_VERSION = 1
+
+SAMPLE = 0
+ANNOTATION = 1
+
+_PREAMBLE = struct.Struct("<4sHI")
+_SAMPLE = struct.Struct("<Bdi")
+_ANNOTATION = struct.Struct("<BdH")
+
+FLUSH_SAMPLES = 256             # Samples buffered before they are written out
+
+
+class TraceRecorder:
+    """Appends raw samples and annotations to a trace file. Safe to call from several threads"""
+
+    def __init__(self, path:str, sensor=None, **header):
+        """
+        :param sensor: sensor whose calibration (offset, scale) is saved in the header
+        :param header: anything else to keep in the header, e.g. order_id
+        """
+        if sensor is not None:
+            header.update(offset=sensor.get_offset(), scale=sensor.get_scale(), max_cap=sensor.MAX_CAP,
+                          min_cap=sensor.MIN_CAP)
+        header['created'] = time.time()
+        meta = json.dumps(header).encode()
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.buffer = []
+        self.num_samples = 0
+        self.file = open(path, "wb")
+        self.file.write(_PREAMBLE.pack(TRACE_MAGIC, TRACE_VERSION, len(meta)) + meta)
+
+    def sample(self, raw:int):
+        t = time.monotonic() - self.start
+        with self.lock:
+            self.buffer.append(_SAMPLE.pack(SAMPLE, t, raw))
+            self.num_samples += 1
+            if len(self.buffer) >= FLUSH_SAMPLES:
+                self._flush()
+
+    def annotate(self, kind:str, **fields):
+        """Records what the machine is doing at this moment (written out straight away)"""
+        t = time.monotonic() - self.start
+        fields['kind'] = kind
+        data = json.dumps(fields, separators=(',', ':'), default=str).encode()
+        with self.lock:
+            self.buffer.append(_ANNOTATION.pack(ANNOTATION, t, len(data)) + data)
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.file.close()
+
+    def _flush(self):
+        self.file.write(b"".join(self.buffer))
+        self.file.flush()
+        self.buffer = []
+
+
+def read_trace(path:str):
+    """Returns (header, records) of a trace, where each record is (t, raw) for a sample or (t, fields) for an annotation"""
+    with open(path, "rb") as f:
+        data = f.read()
+
+    magic, version, meta_len = _PREAMBLE.unpack_from(data, 0)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION:
+        raise ValueError("{} is not a version {} weight trace".format(path, TRACE_VERSION))
+    pos = _PREAMBLE.size
+    header = json.loads(data[pos:pos + meta_len].decode())
+    pos += meta_len
+
+    records = []
+    while pos < len(data):
+        if data[pos] == SAMPLE:
+            if pos + _SAMPLE.size > len(data):
+                break                   # Cut short by a crash
+            kind, t, raw = _SAMPLE.unpack_from(data, pos)
+            records.append((t, raw))
+            pos += _SAMPLE.size
+        else:
+            if pos + _ANNOTATION.size > len(data):
+                break
+            kind, t, length = _ANNOTATION.unpack_from(data, pos)
+            pos += _ANNOTATION.size
+            if pos + length > len(data):
+                break
+            records.append((t, json.loads(data[pos:pos + length].decode())))
+            pos += length
+    return header, records
+
+
+class ReplaySensor(WeightSensor_HX711):
+    """
+    WeightSensor_HX711 that reads its samples from a trace instead of the HX711. Everything built on
+    read() (get_grams, detect_change, read_average) works unchanged.
+    """
+
+    def __init__(self, path:str, speed:float=None, on_annotation=None):
+        """
+        :param speed: replay speed relative to real time (None replays as fast as samples are read)
+        :param on_annotation: called with each annotation's fields as the replay passes it
+        """
+        header, records = read_trace(path)
+        self.GAIN = 1
+        self.OFFSET = header.get('offset', 0)
+        self.SCALE = header.get('scale', 1)
+        self.MAX_CAP = header.get('max_cap', 100)
+        self.MIN_CAP = header.get('min_cap', 0)
+        self.scale_ready = True
+        self.quality = {}
+        self.prev_read = 0
+        self.lock = threading.RLock()
+        self.recorder = None
+        self.read_timeout = None
+        self.aborting = threading.Event()
+        self.PD_SCK = None
+        self.DOUT = None
+
+        self.header = header
+        self.records = records
+        self.speed = speed
+        self.on_annotation = on_annotation
+        self.pos = 0
+        self.now = 0.0                  # Trace time of the last sample read
+        self.started = None
+
+    @property
+    def done(self) -> bool:
+        return self.pos >= len(self.records)
+
+    def is_ready(self):
+        return not self.done
+
+    def read(self):
+        """Returns the next sample of the trace, raising EOFError at the end"""
+        with self.lock:
+            while not self.done:
+                t, record = self.records[self.pos]
+                self.pos += 1
+                if isinstance(record, dict):
+                    if self.on_annotation is not None:
+                        self.on_annotation(record)
+                    continue
+
+                if self.speed is not None:
+                    if self.started is None:
+                        self.started = time.monotonic() - t / self.speed
+                    time.sleep(max(0, self.started + t / self.speed - time.monotonic()))
+                self.now = t
+                return record
+        raise EOFError("End of weight trace")
+
+    def set_gain(self, gain=128):
+        pass
+
+    def power_down(self):
+        pass
+
+    def power_up(self):
+        pass
+
+
+def main():
+    # Replay a trace and list the weight changes between lane firings: python3 weight_trace.py trace.wtr [speed]
+    import sys
+
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    sensor = ReplaySensor(sys.argv[1], speed)
+    header = sensor.header
+    samples = sum([1 for t, r in sensor.records if not isinstance(r, dict)])
+    duration = sensor.records[-1][0] if sensor.records else 0
+    print("{}: {} samples over {:.1f}s ({:.0f} Hz), header {}".format(
+        sys.argv[1], samples, duration, samples / duration if duration > 0 else 0, header))
+
+    # Re-baseline whenever lanes fire, then report every settled change of more than a gram
+    fired = []
+    sensor.on_annotation = lambda fields: fired.append(fields) if fields['kind'] == 'lanes' else None
+    start = time.monotonic()
+    changes = []
+    try:
+        while True:
+            grams = sensor.get_grams(4, verbose=False)
+            if fired:
+                fired.clear()
+                sensor.set_prev_read(grams)
+            elif abs(grams - sensor.prev_read) > 1:
+                changes.append((round(sensor.now, 2), round(grams - sensor.prev_read, 1)))
+                sensor.set_prev_read(grams)
+    except EOFError:
+        pass
+    elapsed = time.monotonic() - start
+    print("Replayed in {:.2f}s ({:.0f}x real time), weight changes over 1 g: {}".format(
+        elapsed, duration / elapsed if elapsed > 0 else 0, changes))
+
+if __name__ == '__main__':
+    main()
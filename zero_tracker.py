@@ -0,0 +1,124 @@
+"""
+Keeps the load cell zeroed while the platform is empty. Between orders a background thread reads
+the empty platform and moves the sensor OFFSET a small step towards each reading, so slow drift
+(temperature, creep) is tared away instead of building up in detect_change baselines. Readings that
+are far from zero or unsteady are ignored, and drift well beyond what is normal is reported.
+
+The tracker must be paused whenever something may be on the platform (dispensing, waiting for a
+pickup) and resumed once it is known to be empty.
+"""
+
+import threading
+
+TRACK_INTERVAL = 1.0            # Seconds between zero checks
+TRACK_SAMPLES = 8               # HX711 samples averaged per zero check
+ZERO_ALPHA = 0.05               # Fraction of each zero error taken into the offset (slow EMA)
+ZERO_BAND = 2.0                 # Grams from zero beyond which a reading is taken to be a load, not drift
+STABLE_BAND = 0.5               # Grams two readings in a row may differ by for the platform to count as still
+DRIFT_LIMIT = 5.0               # Grams of total drift since the tracker started that are reported
+
+
+class ZeroTracker:
+    """
+    Slowly corrects the offset of a WeightSensor_HX711 while the platform is empty.
+    on_drift(grams) is called from the tracker thread the first time the total correction goes
+    beyond drift_limit.
+    """
+
+    def __init__(self, sensor, interval:float=TRACK_INTERVAL, num_samples:int=TRACK_SAMPLES,
+                 alpha:float=ZERO_ALPHA, zero_band:float=ZERO_BAND, stable_band:float=STABLE_BAND,
+                 drift_limit:float=DRIFT_LIMIT, on_drift=None):
+        self.sensor = sensor
+        self.interval = interval
+        self.num_samples = num_samples
+        self.alpha = alpha
+        self.zero_band = zero_band
+        self.stable_band = stable_band
+        self.drift_limit = drift_limit
+        self.on_drift = on_drift
+
+        self.start_offset = sensor.get_offset()
+        self.drift_flagged = False
+        self.updates = 0                # Offset corrections made
+        self.skipped = 0                # Readings ignored as a load, as unsteady, or failed
+
+        self.lock = threading.Lock()    # Held while a reading is turned into a correction
+        self._active = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def drift(self) -> float:
+        """Grams the zero has moved since the tracker started"""
+        return (self.sensor.get_offset() - self.start_offset) / self.sensor.get_scale()
+
+    def start(self, paused:bool=True):
+        """Starts the tracker thread, paused unless the platform is known to be empty"""
+        if not paused:
+            self._active.set()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def pause(self):
+        """Stops correcting the offset. Once this returns no correction is in progress"""
+        with self.lock:
+            self._active.clear()
+
+    def resume(self):
+        """Starts correcting the offset again--only call when the platform is empty"""
+        self._active.set()
+
+    def stop(self):
+        self._stop.set()
+        self._active.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def update(self, raw:float, last_grams:float=None):
+        """
+        Takes one averaged raw reading of the empty platform into the offset, unless it is too far
+        from zero or too far from the last reading. Returns the reading in grams.
+        """
+        offset = self.sensor.get_offset()
+        grams = (raw - offset) / self.sensor.get_scale()
+
+        if abs(grams) > self.zero_band or (last_grams is not None and abs(grams - last_grams) > self.stable_band):
+            self.skipped += 1
+            return grams
+
+        self.sensor.set_offset(offset + self.alpha * (raw - offset))
+        self.updates += 1
+
+        drift = self.drift
+        if not self.drift_flagged and abs(drift) > self.drift_limit:
+            self.drift_flagged = True
+            print("Load cell zero has drifted {:.1f} grams".format(drift))
+            if self.on_drift is not None:
+                self.on_drift(drift)
+        return grams
+
+    def _run(self):
+        last_grams = None
+        while not self._stop.is_set():
+            if not self._active.is_set():
+                last_grams = None
+                self._active.wait()
+                continue
+
+            try:
+                raw = self.sensor.read_average(self.num_samples)
+            except OSError as e:
+                # A chip timeout (or a read cut short by an order watchdog) loses one check, not the tracker
+                print("Zero tracking read failed: {}".format(e))
+                self.skipped += 1
+                last_grams = None
+                self._stop.wait(self.interval)
+                continue
+
+            with self.lock:
+                # A pause that came in during the read means the platform may no longer be empty
+                if self._active.is_set():
+                    last_grams = self.update(raw, last_grams)
+
+            self._stop.wait(self.interval)